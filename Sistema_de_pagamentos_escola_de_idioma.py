@@ -1,11 +1,21 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog, simpledialog
-import psycopg2
 import locale
-import pandas as pd
 import os
 import sys # For checking OS platform
-import decimal # Import decimal
+from bisect import bisect_left
+from collections import OrderedDict
+from database import get_pool, close_pool, setup_schema, ensure_year_partition, partition_years, prune_change_log, is_connection_error
+from instrumentation import configure_logging, logger, recorder, span, timed
+from jobs import JobRunner
+from importer import import_file
+from local_cache import local_cache_for
+from search_cache import SearchCache
+from money import format_brl, to_money
+from notifications import ChangeListener
+from offline import OfflineStore, offline_queue_for, replay
+from repository import (PaymentsRepository, DebtorsRepository, SummaryRepository, StudentPayment, ConcurrentUpdateError, MONTH_CODES, MONTH_NAMES, MONTH_INDEX,
+                        AGING_BUCKETS, aging_bucket, days_overdue, format_overdue, matches_search, load_sample_data as load_sample_rows)
 
 # Configurar locale para formato brasileiro (Best effort)
 try:
@@ -20,6 +30,28 @@ except:
 PAID_MARK = " ✅"
 DEBTOR_MARK = " ❌" # Used for Pendente or Em Negociação
 
+# Above this many rows a grid switches to virtual scrolling (only the visible rows become tree items)
+VIRTUAL_GRID_THRESHOLD = int(os.environ.get("PAGAMENTOS_VIRTUAL_THRESHOLD", "2000"))
+
+# Search-as-you-type: the search runs this long after the last keystroke
+SEARCH_DEBOUNCE_MS = 300
+
+# Other instances' changes (LISTEN/NOTIFY) are applied this often; above this many changed
+# students at once, both tabs are reloaded instead of patched row by row
+CHANGE_POLL_MS = 500
+REMOTE_PATCH_LIMIT = 50
+
+# Desempenho tab (latency per operation, see instrumentation.py): toggled with F12, shown at
+# launch if PAGAMENTOS_PERF_TAB is set; refreshed this often while it is the selected tab
+PERF_TAB_AT_START = bool(os.environ.get("PAGAMENTOS_PERF_TAB"))
+PERF_REFRESH_MS = 2000
+
+# Offline mode (see offline.py): while the server is unreachable the tabs run on the local copy and
+# changes are queued; reconnecting is tried this often. PAGAMENTOS_OFFLINE=1 starts offline without
+# trying the server (e.g. to try the app without Postgres); "Reconectar" goes online from there.
+RECONNECT_MS = 15000
+OFFLINE_AT_START = os.environ.get("PAGAMENTOS_OFFLINE") == "1"
+
 class StudentPaymentApp:
     def __init__(self, root):
         self.root = root
@@ -43,6 +75,16 @@ class StudentPaymentApp:
         hsb = ttk.Scrollbar(root, orient=tk.HORIZONTAL, command=self.canvas.xview) # Coloca no root para ficar abaixo de tudo
         hsb.pack(side=tk.BOTTOM, fill=tk.X)
 
+        # --- Barra de status: progresso das tarefas em segundo plano ---
+        self.status_bar = ttk.Frame(root, padding=(5, 2))
+        self.status_bar.pack(side=tk.BOTTOM, fill=tk.X, before=hsb)
+        self.status_label = ttk.Label(self.status_bar, text="")
+        self.status_label.pack(side=tk.LEFT, padx=5)
+        self.progress_bar = ttk.Progressbar(self.status_bar, mode='indeterminate', length=180)
+        self.cancel_jobs_button = ttk.Button(self.status_bar, text="Cancelar", command=self.cancel_jobs)
+        self.reconnect_button = ttk.Button(self.status_bar, text="Reconectar", command=lambda: self.try_reconnect(manual=True))
+        self.connection_label = ttk.Label(self.status_bar, text="", foreground="#b00020") # Offline mode / changes waiting to be sent
+
         # --- Pack Canvas AFTER scrollbars (to allow hsb to be below) ---
         self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
 
@@ -71,15 +113,36 @@ class StudentPaymentApp:
         # self.notebook = ttk.Notebook(self.content_frame) # <-- Pai mudou para self.content_frame
         # self.notebook.pack(fill=tk.BOTH, expand=True, padx=10, pady=10) # <-- Pack inicial
 
-        self.conn = None
-        self.cursor = None
-        self.selected_student_info = None # Store info of selected student for status buttons
-
-        self.month_codes_ordered = ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"]
-        self.month_names_map = {
-            'jan': 'Janeiro', 'feb': 'Fevereiro', 'mar': 'Março', 'apr': 'Abril', 'may': 'Maio', 'jun': 'Junho',
-            'jul': 'Julho', 'aug': 'Agosto', 'sep': 'Setembro', 'oct': 'Outubro', 'nov': 'Novembro', 'dec': 'Dezembro'
-        }
+        self.selected_student_info = None # StudentPayment of the selected row (for the status buttons)
+        self.selected_debtor_info = None # DebtorRecord of the selected debtor row, as the form was filled from it
+
+        # --- Background jobs: every database call runs off the Tk thread (see jobs.py) ---
+        self.jobs = JobRunner(root, cancel_hook=lambda ident: None if self.offline else get_pool().cancel_queries(ident), on_activity=self.show_job_activity)
+
+        # --- Data access (all SQL lives in repository.py) ---
+        self.payments_repo = PaymentsRepository()
+        self.debtors_repo = DebtorsRepository()
+        self.summary_repo = SummaryRepository()
+        # Local replica of the year (see local_cache.py): views are served from it after a delta sync
+        self.local_cache = local_cache_for(self.payments_repo.year)
+        # Offline mode: changes made while the server is unreachable are journaled here (None = unavailable)
+        self.offline_queue = offline_queue_for()
+        self.offline = False; self.offline_store = None; self.reconnect_after_id = None
+
+        self.month_codes_ordered = list(MONTH_CODES)
+        self.month_names_map = dict(MONTH_NAMES)
+
+        # Search term currently applied to each tab (used to decide if a changed row stays visible)
+        self.payment_filter = None
+        self.debtor_filter = None
+        # Devedores tab: aging bucket shown (None = all) and order (due date, most overdue first, or ID)
+        self.debtor_aging = None
+        self.debtor_by_aging = False
+
+        # Recent complete search results per tab, so typing is mostly answered from memory
+        self.payment_search = SearchCache(lambda student: (student.id, student.student_name))
+        self.debtor_search = SearchCache(lambda debt: (debt.id, debt.student_name))
+        self.search_after_ids = {} # tab -> pending debounced search (root.after id)
 
         # --- Setup Notebook for Tabs ---
         # >> ESTA É A CRIAÇÃO CORRETA DO NOTEBOOK <<
@@ -88,18 +151,30 @@ class StudentPaymentApp:
 
         self.payments_tab = ttk.Frame(self.notebook)
         self.debtors_tab = ttk.Frame(self.notebook)
+        self.summary_tab = ttk.Frame(self.notebook)
+        self.performance_tab = ttk.Frame(self.notebook)
 
         self.notebook.add(self.payments_tab, text="Pagamentos")
         self.notebook.add(self.debtors_tab, text="Devedores")
+        self.notebook.add(self.summary_tab, text="Resumo")
+        self.notebook.add(self.performance_tab, text="Desempenho")
 
         # --- Setup content for each tab ---
         self.setup_payments_tab()
         self.setup_debtors_tab() # Restore this setup
+        self.setup_summary_tab()
+        self.setup_performance_tab()
+        # The summary is cheap to read (a few pre-aggregated rows), so it is simply re-read whenever shown
+        self.notebook.bind('<<NotebookTabChanged>>', lambda e: self.load_summary_data() if self.notebook.select() == str(self.summary_tab) else None)
+        self.notebook.bind('<<NotebookTabChanged>>', lambda e: self.refresh_performance_tab() if self.notebook.select() == str(self.performance_tab) else None, add='+')
+        if not PERF_TAB_AT_START: self.notebook.hide(self.performance_tab)
+        self.root.bind('<F12>', lambda e: self.toggle_performance_tab())
 
         # --- Initialize Database and Load Initial Data ---
-        self.setup_database()
-        self.load_payment_data() # Initial load for payments tab
-        self.load_debtor_data()  # Initial load for debtors tab
+        # Both tabs load once the tables are checked/created; then other instances' changes start flowing in
+        self.change_listener = None
+        if OFFLINE_AT_START and self.offline_queue is not None: self.go_offline(announce=False)
+        else: self.connect_database()
 
     # --- Funções Auxiliares para Rolagem ---
     def on_frame_configure(self, event=None):
@@ -149,71 +224,202 @@ class StudentPaymentApp:
         #      self.canvas.xview_scroll(delta, "units")
 
 
-    # --- Currency Formatting ---
+    # --- Currency Formatting (Decimal end to end, see money.py) ---
     def format_currency(self, value):
-        if value is None: return "0,00"
-        try: return f"{float(value):.2f}".replace('.', ',')
-        except (ValueError, TypeError): return "0,00"
+        return format_brl(value)
 
-    # --- Sua função parse_currency CORRIGIDA ---
     def parse_currency(self, value):
-        if value is None: return 0.0
-        if isinstance(value, (int, float, decimal.Decimal)):
-            try: return float(value)
-            except ValueError: print(f"Aviso: Não foi possível converter o valor numérico para float: {value}"); return 0.0
-        if isinstance(value, str):
-            try:
-                cleaned = value.replace(PAID_MARK, '').replace(DEBTOR_MARK, '').strip()
-                if not cleaned: return 0.0
-                # Lógica para formato brasileiro (1.234,56)
-                cleaned = cleaned.replace('.', '') # Remove separadores de milhar (.)
-                cleaned = cleaned.replace(',', '.') # Substitui vírgula decimal (,) por ponto (.)
-                return float(cleaned)
-            except ValueError:
-                    print(f"Aviso: Não foi possível interpretar a string de moeda: {value}")
-                    return 0.0
-        else:
-            print(f"Aviso: Tipo inesperado para parse_currency: {type(value)}, valor: {value}")
-            return 0.0
+        """Table/form text or a DB value -> Decimal; raises ValueError for text that is not an amount."""
+        return to_money(value)
 
 
     # --- Database Setup and Connection ---
-    def setup_database(self):
-        """Set up database tables (student_payments and student_debtors)"""
-        try:
-            conn, cursor = self.connect_to_db()
-            if not conn: return
-
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS student_payments (
-                    id INT PRIMARY KEY, payment_day INT, student_name VARCHAR(50), course VARCHAR(15),
-                    discount DECIMAL(10,2), jan DECIMAL(10,2), feb DECIMAL(10,2), mar DECIMAL(10,2),
-                    apr DECIMAL(10,2), may DECIMAL(10,2), jun DECIMAL(10,2), jul DECIMAL(10,2),
-                    aug DECIMAL(10,2), sep DECIMAL(10,2), oct DECIMAL(10,2), nov DECIMAL(10,2), dec DECIMAL(10,2)
-                )""")
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS student_debtors (
-                    id INT, student_name VARCHAR(50), course VARCHAR(15), month VARCHAR(20), amount DECIMAL(10,2),
-                    status VARCHAR(50) DEFAULT 'Pendente', comment TEXT DEFAULT '',
-                    FOREIGN KEY (id) REFERENCES student_payments(id) ON DELETE CASCADE,
-                    PRIMARY KEY (id, month)
-                )""")
-            conn.commit()
-            conn.close()
-            print("Database tables checked/created.")
-        except Exception as e:
-            messagebox.showerror("Database Error", f"Error setting up database: {str(e)}")
-
-    def connect_to_db(self):
-        try:
-            # VERIFIQUE ESTAS CREDENCIAIS
-            self.conn = psycopg2.connect(host="localhost", database="postgres", user="postgres", password="123", client_encoding="utf8")
-            self.cursor = self.conn.cursor()
-            return self.conn, self.cursor
-        except Exception as e:
-            messagebox.showerror("Database Error", f"Could not connect: {str(e)}")
-            self.conn, self.cursor = None, None
-            return None, None
+    def setup_database(self, on_ready=None):
+        """Set up (or migrate) the database tables (students and student_months) in the background.
+
+        On an up-to-date database this is a quick catalog check (see setup_schema), so the data loads start right away."""
+        def work(job):
+            setup_schema(get_pool())
+            prune_change_log(get_pool()) # Entries older than a month only matter to replicas unused since
+            return partition_years(get_pool())
+        def done(years):
+            logger.info("Database tables checked/created.")
+            self.set_year_choices(years)
+            if on_ready: on_ready()
+        self.jobs.submit(work, on_done=done,
+                         on_error=lambda e: self.report_error("Database Error", "Error setting up database", e),
+                         write=True, label="Verificando tabelas...")
+
+    def connect_database(self):
+        """Checks the tables, sends the changes queued offline (if any), then loads both tabs and starts
+        listening. Both are write jobs, so queued changes reach the server before any new save."""
+        self.setup_database()
+        self.replay_offline_queue(then=lambda: (self.load_payment_data(self.payment_filter), self.load_debtor_data(self.debtor_filter),
+                                                self.start_change_listener()))
+
+    # --- Offline Mode (see offline.py) ---
+    def go_offline(self, announce=True):
+        """Switches the tabs to the local copy after the server became unreachable; changes are queued."""
+        if self.offline: return
+        self.offline = True; self.offline_store = OfflineStore(self.local_cache, self.offline_queue)
+        logger.warning("Database unreachable: working offline on the local copy.")
+        self.show_connection_state()
+        if announce:
+            messagebox.showwarning("Modo Offline", "Sem conexão com o banco de dados.\n\nO aplicativo continua funcionando com a última cópia local dos dados. "
+                                   "As alterações feitas agora ficam guardadas neste computador e são enviadas ao servidor quando a conexão voltar.\n\n"
+                                   "Se você estava gravando algo, repita a operação.")
+        self.payment_search.clear(); self.debtor_search.clear()
+        self.load_payment_data(self.payment_filter); self.load_debtor_data(self.debtor_filter)
+        if not OFFLINE_AT_START: self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        if self.reconnect_after_id is None: self.reconnect_after_id = self.root.after(RECONNECT_MS, self.try_reconnect)
+
+    def try_reconnect(self, manual=False):
+        """While offline: checks in the background whether the server is back; if so, goes online
+        (queued changes are sent, then the tabs reload)."""
+        if self.reconnect_after_id is not None: self.root.after_cancel(self.reconnect_after_id); self.reconnect_after_id = None
+        if not self.offline: return
+        def probe(job):
+            with get_pool().connection() as conn, conn.cursor() as cur: cur.execute("SELECT 1")
+        def back(_):
+            logger.info("Database reachable again: leaving offline mode.")
+            self.offline = False; self.offline_store = None
+            self.show_connection_state(); self.connect_database()
+        def still_down(e):
+            logger.info("Database still unreachable: %s", e)
+            if manual: messagebox.showinfo("Reconectar", f"O banco de dados continua inacessível.\n\n{e}")
+            if not OFFLINE_AT_START: self.schedule_reconnect()
+        self.jobs.submit(probe, on_done=back, on_error=still_down, group='reconnect', label="Verificando conexão...")
+
+    def replay_offline_queue(self, force=False, then=None):
+        """Sends the changes made offline to the server, in order and in batches (see offline.replay), then
+        runs ``then``. Changes the server rejects as conflicts are put to the user first."""
+        queue = self.offline_queue
+        def work(job):
+            if queue is None or not len(queue): return None
+            return replay(queue, force=force, progress=lambda done, total: job.report(done, total, f"Enviando alterações feitas offline ({done}/{total})..."))
+        def done(result):
+            self.show_connection_state()
+            if self.offline: return # The connection dropped meanwhile (e.g. the schema check failed first)
+            if result is not None and result.conflicts: self.resolve_offline_conflicts(result.conflicts, then); return
+            if result is not None and result.applied:
+                messagebox.showinfo("Sincronização", f"{result.applied} alterações feitas offline foram enviadas ao servidor.")
+            if then: then()
+        def failed(e):
+            if self.offline and is_connection_error(e): logger.info("Offline changes not sent: %s", e); return # Still queued
+            self.report_error("Erro DB", "Erro ao enviar as alterações feitas offline", e)
+            if then and not self.offline: then() # The rest stays queued; the tabs still show the server's data
+        self.jobs.submit(work, on_done=done, on_error=failed, on_progress=self.show_job_progress,
+                         write=True, label="Enviando alterações feitas offline...")
+
+    def resolve_offline_conflicts(self, conflicts, then=None):
+        """Asks whether offline changes the server rejected (the records changed there meanwhile) overwrite it or are discarded."""
+        lines = "\n".join(f"• {change.describe()}: {change.conflict}" for change in conflicts[:10])
+        if len(conflicts) > 10: lines += f"\n• ... e mais {len(conflicts) - 10}"
+        if messagebox.askyesno("Conflitos ao Sincronizar", f"{len(conflicts)} alterações feitas offline não foram gravadas porque os registros foram alterados no servidor enquanto você estava sem conexão:\n\n{lines}\n\n"
+                               "Sobrescrever com as suas alterações?\n(Não = descartá-las e manter os dados do servidor)", icon='warning'):
+            self.replay_offline_queue(force=True, then=then); return
+        def discarded(_):
+            logger.info("Discarded %d conflicting offline changes.", len(conflicts))
+            self.show_connection_state()
+            if then: then()
+        self.jobs.submit(lambda job: self.offline_queue.remove([change.seq for change in conflicts]), on_done=discarded,
+                         on_error=lambda e: self.report_error("Erro", "Erro ao descartar as alterações", e), write=True, label="Descartando alterações...")
+
+    def show_connection_state(self):
+        """Status bar note while offline, or while changes made offline wait to be sent."""
+        pending = len(self.offline_queue) if self.offline_queue is not None else 0
+        if self.offline: text = "Modo offline: sem conexão com o banco" + (f" ({pending} alterações aguardando envio)" if pending else "")
+        else: text = f"{pending} alterações feitas offline aguardando envio" if pending else ""
+        self.reconnect_button.pack_forget(); self.connection_label.pack_forget()
+        if self.offline: self.reconnect_button.pack(side=tk.RIGHT, padx=5)
+        if text: self.connection_label.config(text=text); self.connection_label.pack(side=tk.RIGHT, padx=5)
+
+    def repo_for(self, repo):
+        """``repo``, or the offline store standing in for it while the server is unreachable."""
+        return self.offline_store if self.offline else repo
+
+    # --- Live Updates From Other Instances (see notifications.py) ---
+    def start_change_listener(self):
+        if self.change_listener is not None: return
+        self.change_listener = ChangeListener().start()
+        self.root.after(CHANGE_POLL_MS, self.apply_remote_changes)
+
+    def apply_remote_changes(self):
+        """Patches the rows other instances changed since the last poll (reloads when too many changed)."""
+        if self.change_listener is None: return
+        changes = self.change_listener.drain()
+        student_ids = sorted(changes.ids_for(self.payments_repo.year)) if changes else []
+        if changes.everything or len(student_ids) > REMOTE_PATCH_LIMIT:
+            logger.info("Remote changes: reloading both tabs.")
+            self.payment_search.clear(); self.debtor_search.clear()
+            self.load_payment_data(self.payment_filter); self.load_debtor_data(self.debtor_filter)
+        elif student_ids:
+            def fetch(job):
+                return [(student_id, self.fetch_student_rows(student_id)) for student_id in student_ids]
+            def done(results):
+                for student_id, fetched in results: self.refresh_student_rows(student_id, fetched)
+                logger.info("Remote changes: %d students updated.", len(results))
+            self.jobs.submit(fetch, on_done=done, on_error=lambda e: logger.error("Error applying remote changes: %s", e),
+                             label="Aplicando alterações de outros usuários...")
+        if (changes.everything or student_ids) and self.notebook.select() == str(self.summary_tab): self.load_summary_data()
+        self.root.after(CHANGE_POLL_MS, self.apply_remote_changes)
+
+    # --- Background Job Feedback ---
+    def show_job_activity(self, jobs):
+        """Shows/hides the status bar progress indicator as background jobs start and finish."""
+        self.show_connection_state() # A finished save may have queued a change
+        if not jobs:
+            self.progress_bar.stop(); self.progress_bar.pack_forget(); self.cancel_jobs_button.pack_forget()
+            self.status_label.config(text=""); return
+        label = jobs[-1].label or "Processando..."
+        self.status_label.config(text=label if len(jobs) == 1 else f"{label} (+{len(jobs) - 1})")
+        if not self.progress_bar.winfo_ismapped():
+            self.progress_bar.config(mode='indeterminate', value=0)
+            self.progress_bar.pack(side=tk.LEFT, padx=5); self.progress_bar.start(15)
+        if any(not job.write for job in jobs): self.cancel_jobs_button.pack(side=tk.LEFT, padx=5)
+        else: self.cancel_jobs_button.pack_forget() # Writes are never cancelled
+
+    def show_job_progress(self, done, total=None, message=None):
+        """Switches the progress bar to determinate mode for jobs that report how far they are."""
+        if total:
+            self.progress_bar.stop(); self.progress_bar.config(mode='determinate', maximum=total, value=done)
+        if message: self.status_label.config(text=message)
+
+    def cancel_jobs(self):
+        """Cancels running loads/exports (their queries are interrupted on the server)."""
+        self.jobs.cancel_all()
+        logger.info("Background jobs cancelled by user.")
+
+    def report_error(self, title, message, error):
+        """on_error handler for background jobs: logs the traceback and shows the error.
+
+        A lost connection switches to offline mode instead, when available (see go_offline)."""
+        if self.offline_queue is not None and is_connection_error(error):
+            logger.warning("%s: %s", message, error)
+            if not self.offline: self.go_offline()
+            else: messagebox.showwarning(title, f"{message}: operação indisponível no modo offline (sem conexão com o banco).")
+            return
+        logger.error("%s: %s", message, error, exc_info=error)
+        messagebox.showerror(title, f"{message}: {error}")
+
+    def save_error_handler(self, title, message, student_id, month_name=None, overwrite=None):
+        """on_error handler for saves checked against the row as it was read (optimistic concurrency).
+
+        On a ConcurrentUpdateError (another station saved the same row first; nothing was written)
+        the user may overwrite with their own data (``overwrite()`` resubmits without the check);
+        otherwise the row is reloaded so it shows the current data. Other errors go to report_error."""
+        def handle(error):
+            if not isinstance(error, ConcurrentUpdateError):
+                self.report_error(title, message, error); return
+            what = f"O registro do aluno ID {student_id}" + (f" em {month_name}" if month_name else "")
+            if overwrite is not None and messagebox.askyesno("Conflito de Edição", f"{what} foi alterado em outra estação depois que você o abriu. Suas alterações NÃO foram gravadas.\n\nSobrescrever com os seus dados?\n(Não = descartar e mostrar os dados atuais)", icon='warning'):
+                overwrite(); return
+            self.jobs.submit(lambda job: self.fetch_student_rows(student_id, month_name),
+                             on_done=lambda fetched: self.refresh_student_rows(student_id, fetched, month_name),
+                             on_error=lambda e: self.report_error("Erro DB", "Erro ao recarregar o registro", e), label="Recarregando registro...")
+        return handle
 
     # --- Payments Tab Setup ---
     def setup_payments_tab(self):
@@ -233,7 +439,7 @@ class StudentPaymentApp:
         self.create_payments_table()
 
         # Status Buttons Frame
-        self.status_button_frame = ttk.LabelFrame(self.payments_main_frame, text="Definir Status Mensal (Selecione Aluno Acima)", padding=5)
+        self.status_button_frame = ttk.LabelFrame(self.payments_main_frame, text="Definir Status Mensal (Selecione Aluno Acima; Ctrl/Shift para vários)", padding=5)
         self.status_button_frame.pack(fill=tk.X, pady=5)
         self.create_status_buttons()
 
@@ -274,22 +480,213 @@ class StudentPaymentApp:
         self.debtors_button_frame.pack(fill=tk.X, pady=5)
         self.create_debtors_buttons()
 
+    # --- Summary Tab Setup ---
+    def setup_summary_tab(self):
+        """Totals of the selected year per month and per course (read from the month_summary table)."""
+        self.summary_main_frame = ttk.Frame(self.summary_tab, padding=10)
+        self.summary_main_frame.pack(fill=tk.BOTH, expand=True)
+
+        header = ttk.Frame(self.summary_main_frame, padding=5)
+        header.pack(fill=tk.X, pady=5)
+        self.summary_total_label = ttk.Label(header, text="", font=('TkDefaultFont', 10, 'bold'))
+        self.summary_total_label.pack(side=tk.LEFT, padx=5)
+        ttk.Button(header, text="Atualizar", command=self.load_summary_data).pack(side=tk.RIGHT, padx=5)
+
+        tables = ttk.Frame(self.summary_main_frame)
+        tables.pack(fill=tk.BOTH, expand=True, pady=5)
+        self.summary_month_tree = self.create_summary_table(tables, "Por Mês", "Mês")
+        self.summary_course_tree = self.create_summary_table(tables, "Por Curso", "Curso")
+
+    def create_summary_table(self, parent, title, label_heading):
+        frame = ttk.LabelFrame(parent, text=title, padding=5)
+        frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=5)
+        tree = ttk.Treeview(frame, columns=("label", "billed", "received", "outstanding", "open_count"), show='headings', height=13)
+        tree.heading("label", text=label_heading); tree.column("label", width=110)
+        tree.heading("billed", text="Faturado"); tree.column("billed", width=110, anchor=tk.E)
+        tree.heading("received", text="Recebido"); tree.column("received", width=110, anchor=tk.E)
+        tree.heading("outstanding", text="Em Aberto"); tree.column("outstanding", width=110, anchor=tk.E)
+        tree.heading("open_count", text="Pendências"); tree.column("open_count", width=80, anchor=tk.CENTER)
+        vsb = ttk.Scrollbar(frame, orient="vertical", command=tree.yview)
+        tree.configure(yscrollcommand=vsb.set)
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True); vsb.pack(side=tk.RIGHT, fill=tk.Y)
+        tree.tag_configure('total', font=('TkDefaultFont', 9, 'bold'))
+        return tree
+
+    def load_summary_data(self):
+        """Reads the year's totals in a background job and fills the Resumo tab."""
+        if self.offline:
+            self.summary_total_label.config(text="Resumo indisponível no modo offline (os totais vêm do servidor)."); return
+        repo = self.summary_repo
+        def fetch(job):
+            return repo.by_month(), repo.by_course(), repo.total()
+
+        def done(result):
+            by_month, by_course, total = result
+            for tree, rows in ((self.summary_month_tree, by_month), (self.summary_course_tree, by_course)):
+                tree.delete(*tree.get_children())
+                for row in rows: tree.insert("", tk.END, values=self.summary_row_values(row))
+                if rows: tree.insert("", tk.END, values=self.summary_row_values(total), tags=('total',))
+            self.summary_total_label.config(text=f"Ano {repo.year}: faturado R$ {self.format_currency(total.billed)} | "
+                                                 f"recebido R$ {self.format_currency(total.received)} | "
+                                                 f"em aberto R$ {self.format_currency(total.outstanding)} ({total.open_count} pendências)")
+
+        self.jobs.submit(fetch, on_done=done,
+                         on_error=lambda e: self.report_error("Database Error", "Error loading summary", e),
+                         group='summary', label="Carregando resumo...")
+
+    def summary_row_values(self, row):
+        return (row.label, self.format_currency(row.billed), self.format_currency(row.received),
+                self.format_currency(row.outstanding), row.open_count)
+
+    # --- Performance Tab (hidden; F12 shows/hides it) ---
+    def setup_performance_tab(self):
+        """Latency of each timed operation (DB calls, table fills, marks, exports) since launch or "Zerar"."""
+        self.performance_after_id = None
+        frame = ttk.Frame(self.performance_tab, padding=10)
+        frame.pack(fill=tk.BOTH, expand=True)
+
+        header = ttk.Frame(frame, padding=5)
+        header.pack(fill=tk.X, pady=5)
+        ttk.Label(header, text="Tempos por operação (ms), do mais custoso ao menos custoso no total. F12 mostra/oculta esta aba.").pack(side=tk.LEFT, padx=5)
+        ttk.Button(header, text="Salvar Trace...", command=self.save_trace).pack(side=tk.RIGHT, padx=5)
+        self.trace_var = tk.BooleanVar(value=recorder.tracing)
+        ttk.Checkbutton(header, text="Gravar trace", variable=self.trace_var, command=self.toggle_trace).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(header, text="Zerar", command=lambda: (recorder.reset(), self.refresh_performance_tab())).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(header, text="Atualizar", command=self.refresh_performance_tab).pack(side=tk.RIGHT, padx=5)
+
+        table = ttk.Frame(frame)
+        table.pack(fill=tk.BOTH, expand=True, pady=5)
+        tree = ttk.Treeview(table, columns=("name", "count", "mean", "p50", "p95", "max", "total"), show='headings', height=20)
+        tree.heading("name", text="Operação"); tree.column("name", width=300)
+        tree.heading("count", text="Chamadas"); tree.column("count", width=80, anchor=tk.E)
+        tree.heading("mean", text="Média"); tree.column("mean", width=90, anchor=tk.E)
+        tree.heading("p50", text="p50"); tree.column("p50", width=90, anchor=tk.E)
+        tree.heading("p95", text="p95"); tree.column("p95", width=90, anchor=tk.E)
+        tree.heading("max", text="Máx."); tree.column("max", width=90, anchor=tk.E)
+        tree.heading("total", text="Total (s)"); tree.column("total", width=90, anchor=tk.E)
+        vsb = ttk.Scrollbar(table, orient="vertical", command=tree.yview)
+        tree.configure(yscrollcommand=vsb.set)
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True); vsb.pack(side=tk.RIGHT, fill=tk.Y)
+        self.performance_tree = tree
+
+    def toggle_performance_tab(self):
+        if self.notebook.tab(self.performance_tab, 'state') == 'hidden':
+            self.notebook.add(self.performance_tab); self.notebook.select(self.performance_tab)
+        else:
+            self.notebook.hide(self.performance_tab)
+
+    def refresh_performance_tab(self):
+        """Redraws the table from the in-memory counters; repeats every PERF_REFRESH_MS while the tab is selected."""
+        if self.performance_after_id is not None:
+            self.root.after_cancel(self.performance_after_id); self.performance_after_id = None
+        ms = lambda seconds: f"{seconds * 1000:.1f}".replace(".", ",")
+        tree = self.performance_tree
+        tree.delete(*tree.get_children())
+        for op in recorder.stats():
+            tree.insert("", tk.END, values=(op.name, op.count, ms(op.mean), ms(op.p50), ms(op.p95), ms(op.max), f"{op.total:.2f}".replace(".", ",")))
+        if self.notebook.select() == str(self.performance_tab):
+            self.performance_after_id = self.root.after(PERF_REFRESH_MS, self.refresh_performance_tab)
+
+    def toggle_trace(self):
+        """Starts keeping every span as a trace event; unchecking discards the events kept so far."""
+        if self.trace_var.get(): recorder.start_trace()
+        else: recorder.stop_trace()
+
+    def save_trace(self):
+        """Writes the events recorded since "Gravar trace" was checked as a Chrome trace (JSON)."""
+        if not recorder.tracing:
+            messagebox.showinfo("Trace", "Marque \"Gravar trace\", repita a operação lenta e então salve o trace."); return
+        file_path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("Trace (JSON)", "*.json"), ("All files", "*.*")],
+                                                 initialfile="pagamentos-trace.json", title="Salvar Trace")
+        if not file_path: return
+        try:
+            count = recorder.dump_trace(file_path, stop=False)
+        except OSError as e:
+            messagebox.showerror("Trace", f"Erro ao salvar o trace: {e}"); return
+        messagebox.showinfo("Trace", f"{count} eventos salvos em:\n{file_path}\n\nAbra em https://ui.perfetto.dev ou chrome://tracing.")
+
     # --- UI Creation Methods (Payments Tab - Reused) ---
     # Nenhuma mudança necessária aqui, os pais estão corretos via setup_payments_tab
     def create_search_bar(self):
         ttk.Label(self.search_frame, text="Buscar por Nome/ID:").pack(side=tk.LEFT, padx=5)
         self.search_var = tk.StringVar()
+        self.search_var.trace_add('write', lambda *args: self.schedule_live_search('payments')) # Busca enquanto digita
         ttk.Entry(self.search_frame, textvariable=self.search_var, width=30).pack(side=tk.LEFT, padx=5)
         ttk.Button(self.search_frame, text="Buscar", command=self.search_students).pack(side=tk.LEFT, padx=5)
         ttk.Button(self.search_frame, text="Mostrar Todos", command=lambda: self.load_payment_data(filter_term=None)).pack(side=tk.LEFT, padx=5)
+        # Year selector: each year is its own partition, so only the chosen year's rows are read
+        self.year_var = tk.StringVar(value=str(self.payments_repo.year))
+        self.year_combo = ttk.Combobox(self.search_frame, textvariable=self.year_var, values=[self.year_var.get()], width=6, state='readonly')
+        self.year_combo.pack(side=tk.RIGHT, padx=5)
+        self.year_combo.bind('<<ComboboxSelected>>', self.change_year)
+        ttk.Label(self.search_frame, text="Ano:").pack(side=tk.RIGHT)
+
+    def set_year_choices(self, years):
+        """Fills the year selector: years with a partition, plus the current one and the next (to start a new year)."""
+        self.available_years = set(years) | {self.payments_repo.year}
+        choices = sorted(self.available_years | {max(self.available_years) + 1})
+        self.year_combo.config(values=[str(year) for year in choices])
+
+    def change_year(self, event=None):
+        """Switches both tabs to the selected year. A year without amounts can start from the previous year's."""
+        year = int(self.year_var.get())
+        if year == self.payments_repo.year: return
+        if self.offline: self.show_year(year); return # Offline the year shows its local copy (if any); changes are queued for it
+        new_repo = PaymentsRepository(year=year)
+
+        def prepare(job):
+            ensure_year_partition(get_pool(), year) # New years get their partition before the first write
+            return new_repo.year_is_empty()
+
+        def prepared(empty):
+            if empty and (year - 1) in self.available_years and messagebox.askyesno(
+                    "Novo Ano", f"O ano {year} ainda não tem valores.\nCopiar os valores mensais de {year - 1} (sem os status)?"):
+                self.jobs.submit(lambda job: new_repo.copy_year_amounts(year - 1), on_done=lambda count: self.show_year(year),
+                                 on_error=lambda e: self.report_error("Database Error", f"Erro ao copiar os valores de {year - 1}", e),
+                                 write=True, label=f"Copiando valores de {year - 1}...")
+            else:
+                self.show_year(year)
+
+        def failed(e):
+            self.year_var.set(str(self.payments_repo.year))
+            self.report_error("Database Error", f"Erro ao abrir o ano {year}", e)
+
+        self.jobs.submit(prepare, on_done=prepared, on_error=failed, write=True, label=f"Abrindo o ano {year}...")
+
+    def show_year(self, year):
+        """Points both repositories at ``year`` and reloads the tabs."""
+        self.payments_repo.year = year; self.debtors_repo.year = year; self.summary_repo.year = year
+        self.local_cache = local_cache_for(year)
+        if self.offline: self.offline_store = OfflineStore(self.local_cache, self.offline_queue)
+        self.available_years.add(year); self.set_year_choices(self.available_years)
+        self.year_var.set(str(year)); self.debtors_year_label.config(text=f"Ano: {year}")
+        self.payment_search.clear(); self.debtor_search.clear()
+        self.clear_payments_form(); self.clear_debtor_form()
+        self.load_payment_data(self.payment_filter); self.load_debtor_data(self.debtor_filter)
+        if self.notebook.select() == str(self.summary_tab): self.load_summary_data()
 
     def search_students(self):
         """Initiates search based on the input field."""
         self.load_payment_data(filter_term=self.search_var.get().strip())
 
+    def schedule_live_search(self, tab):
+        """Debounces typing in a search bar: the search runs SEARCH_DEBOUNCE_MS after the last keystroke."""
+        pending = self.search_after_ids.pop(tab, None)
+        if pending is not None: self.root.after_cancel(pending)
+        self.search_after_ids[tab] = self.root.after(SEARCH_DEBOUNCE_MS, lambda: self.run_live_search(tab))
+
+    def run_live_search(self, tab):
+        self.search_after_ids.pop(tab, None)
+        if tab == 'payments':
+            term = self.search_var.get().strip() or None
+            if term != (self.payment_filter or None): self.load_payment_data(filter_term=term, live=True)
+        else:
+            term = self.search_var_debtors.get().strip() or None
+            if term != (self.debtor_filter or None): self.load_debtor_data(filter_term=term, live=True)
+
     def create_payments_table(self):
         columns = ("id", "payment_day", "student_name", "course", "discount", "jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec")
-        self.payments_tree = ttk.Treeview(self.table_frame, columns=columns, show='headings')
+        self.payments_tree = ttk.Treeview(self.table_frame, columns=columns, show='headings', selectmode='extended')
         self.payments_tree.heading("id", text="ID"); self.payments_tree.column("id", width=50, anchor=tk.CENTER)
         self.payments_tree.heading("payment_day", text="Dia"); self.payments_tree.column("payment_day", width=35, anchor=tk.CENTER)
         self.payments_tree.heading("student_name", text="Aluno"); self.payments_tree.column("student_name", width=150)
@@ -301,6 +698,11 @@ class StudentPaymentApp:
         self.payments_tree.configure(yscrollcommand=vsb.set, xscrollcommand=hsb.set); self.payments_tree.grid(column=0, row=0, sticky='nsew'); vsb.grid(column=1, row=0, sticky='ns'); hsb.grid(column=0, row=1, sticky='ew')
         self.table_frame.grid_columnconfigure(0, weight=1); self.table_frame.grid_rowconfigure(0, weight=1)
         self.payments_tree.bind('<<TreeviewSelect>>', self.on_payment_select)
+        # Row index: student id -> tree item, so mutations patch a single row instead of reloading.
+        # Large result sets use the virtual grid instead; payment_rows points to whichever is active.
+        self.payment_index = TreeRowIndex(self.payments_tree)
+        self.payment_grid = VirtualTreeGrid(self.payments_tree, vsb, jobs=self.jobs, group='payments-pages')
+        self.payment_rows = self.payment_index
 
     def create_status_buttons(self):
         self.month_status_buttons = {}
@@ -312,6 +714,24 @@ class StudentPaymentApp:
             btn.grid(row=row_num, column=col_num, padx=3, pady=3, sticky=tk.EW)
             self.month_status_buttons[month_code] = btn
         for i in range(num_buttons_per_row): self.status_button_frame.grid_columnconfigure(i, weight=1)
+        # Batch mode: the buttons mark the month for every student listed (search filter applied)
+        self.status_all_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self.status_button_frame, text="Aplicar a todos os alunos listados (com valor no mês)", variable=self.status_all_var,
+                        command=lambda: self.set_status_buttons_enabled(self.selected_student_info is not None)).grid(row=2, column=0, columnspan=num_buttons_per_row, sticky=tk.W, padx=3, pady=3)
+
+    def set_status_buttons_enabled(self, enabled):
+        """Month status buttons need a selected student, unless batch mode ("todos") is on."""
+        if not hasattr(self, 'month_status_buttons'): return
+        state = tk.NORMAL if enabled or self.status_all_var.get() else tk.DISABLED
+        for btn in self.month_status_buttons.values(): btn.config(state=state)
+
+    def selected_records(self, rows):
+        """Records behind the selected rows of a tab's row store (placeholder rows of the virtual grid are skipped)."""
+        records = (rows.record_at(item) for item in rows.tree.selection())
+        return [record for record in records if record is not None]
+
+    def selected_student_ids(self):
+        return [student.id for student in self.selected_records(self.payment_rows)]
 
     def create_payments_form(self):
         row = 0
@@ -335,25 +755,39 @@ class StudentPaymentApp:
         ttk.Button(self.button_frame, text="Limpar Campos", command=self.clear_payments_form).pack(side=tk.LEFT, padx=5)
         ttk.Button(self.button_frame, text="Próximo ID", command=self.find_next_id).pack(side=tk.LEFT, padx=5)
         ttk.Button(self.button_frame, text="Exportar Excel", command=self.export_to_excel).pack(side=tk.LEFT, padx=5)
+        ttk.Button(self.button_frame, text="Importar Planilha", command=self.import_spreadsheet).pack(side=tk.LEFT, padx=5)
+        # Shared by both tabs: numeric cells (R$ format, status column/colour) instead of the table's text
+        self.numeric_export_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self.button_frame, text="Valores numéricos", variable=self.numeric_export_var).pack(side=tk.LEFT, padx=5)
 
     # --- UI Creation Methods (Debtors Tab - Restored) ---
     # Nenhuma mudança necessária aqui, os pais estão corretos via setup_debtors_tab
     def create_debtors_search_bar(self):
         ttk.Label(self.search_frame_debtors, text="Buscar Devedor por Nome/ID:").pack(side=tk.LEFT, padx=5)
         self.search_var_debtors = tk.StringVar()
+        self.search_var_debtors.trace_add('write', lambda *args: self.schedule_live_search('debtors')) # Busca enquanto digita
         ttk.Entry(self.search_frame_debtors, textvariable=self.search_var_debtors, width=30).pack(side=tk.LEFT, padx=5)
         ttk.Button(self.search_frame_debtors, text="Buscar", command=self.search_debtors).pack(side=tk.LEFT, padx=5)
         ttk.Button(self.search_frame_debtors, text="Mostrar Todos", command=lambda: self.load_debtor_data(filter_term=None)).pack(side=tk.LEFT, padx=5)
+        ttk.Label(self.search_frame_debtors, text="Atraso (dias):").pack(side=tk.LEFT, padx=(15, 5))
+        self.aging_var = tk.StringVar(value="Todos")
+        aging_combo = ttk.Combobox(self.search_frame_debtors, textvariable=self.aging_var, values=("Todos",) + AGING_BUCKETS, state="readonly", width=9)
+        aging_combo.pack(side=tk.LEFT, padx=5)
+        aging_combo.bind('<<ComboboxSelected>>', lambda event: self.set_debtor_aging(None if self.aging_var.get() == "Todos" else self.aging_var.get()))
+        self.debtors_year_label = ttk.Label(self.search_frame_debtors, text=f"Ano: {self.debtors_repo.year}") # Chosen on the Pagamentos tab
+        self.debtors_year_label.pack(side=tk.RIGHT, padx=5)
 
     def create_debtors_table(self):
-        columns = ("id", "student_name", "course", "month", "amount", "status", "comment")
+        columns = ("id", "student_name", "course", "month", "amount", "status", "overdue", "comment")
         self.debtors_tree = ttk.Treeview(self.debtors_table_frame, columns=columns, show='headings')
-        self.debtors_tree.heading("id", text="ID"); self.debtors_tree.column("id", width=60, anchor=tk.CENTER)
+        # Clicking ID / Atraso orders the list by ID or by due date (most overdue first)
+        self.debtors_tree.heading("id", text="ID ▲", command=lambda: self.set_debtor_order(by_aging=False)); self.debtors_tree.column("id", width=60, anchor=tk.CENTER)
         self.debtors_tree.heading("student_name", text="Aluno"); self.debtors_tree.column("student_name", width=200)
         self.debtors_tree.heading("course", text="Curso"); self.debtors_tree.column("course", width=100)
         self.debtors_tree.heading("month", text="Mês"); self.debtors_tree.column("month", width=100, anchor=tk.CENTER)
         self.debtors_tree.heading("amount", text="Valor"); self.debtors_tree.column("amount", width=100, anchor=tk.E)
         self.debtors_tree.heading("status", text="Status"); self.debtors_tree.column("status", width=100, anchor=tk.CENTER)
+        self.debtors_tree.heading("overdue", text="Atraso (dias)", command=lambda: self.set_debtor_order(by_aging=True)); self.debtors_tree.column("overdue", width=90, anchor=tk.CENTER)
         self.debtors_tree.heading("comment", text="Comentário"); self.debtors_tree.column("comment", width=250)
 
         vsb = ttk.Scrollbar(self.debtors_table_frame, orient="vertical", command=self.debtors_tree.yview)
@@ -370,6 +804,11 @@ class StudentPaymentApp:
         self.debtors_tree.tag_configure('Pendente', background='#ffcdd2') # Light red
         self.debtors_tree.tag_configure('unknown', background='#eeeeee') # Grey for fallback
 
+        # Row index: (student id, month name) -> tree item, kept in the order of the query
+        self.debtor_index = TreeRowIndex(self.debtors_tree, sort_key=self.debtor_sort_key)
+        self.debtor_grid = VirtualTreeGrid(self.debtors_tree, vsb, jobs=self.jobs, group='debtors-pages', sort_key=self.debtor_sort_key)
+        self.debtor_rows = self.debtor_index
+
 
     def create_comment_section(self):
         comment_content = ttk.Frame(self.comment_frame)
@@ -397,196 +836,187 @@ class StudentPaymentApp:
         ttk.Button(self.debtors_button_frame, text="Remover da Lista", command=self.remove_from_debtors).pack(side=tk.LEFT, padx=5)
         ttk.Button(self.debtors_button_frame, text="Limpar Campos", command=self.clear_debtor_form).pack(side=tk.LEFT, padx=5)
         ttk.Button(self.debtors_button_frame, text="Exportar Devedores Excel", command=self.export_debtors_to_excel).pack(side=tk.LEFT, padx=5)
+        ttk.Checkbutton(self.debtors_button_frame, text="Valores numéricos", variable=self.numeric_export_var).pack(side=tk.LEFT, padx=5)
 
 
     # --- Data Loading & Display ---
-    def load_payment_data(self, filter_term=None):
-        print("Loading payment data...")
+    def load_payment_data(self, filter_term=None, live=False):
+        """Fetches the payments grid in a background job; show_payment_data fills the tree when it arrives.
+
+        live=True (search-as-you-type) is answered from payment_search when possible (repeated
+        term, or refinement of a cached result) and suppresses the "not found" popup. Explicit
+        searches ("Buscar", "Mostrar Todos") always hit the database and refresh the cache.
+        """
+        logger.debug("Loading payment data (filter=%r, live=%s)...", filter_term, live)
+        # Ensure payments_tree exists before loading
+        if not hasattr(self, 'payments_tree'):
+            logger.warning("payments_tree not found during load_payment_data")
+            return # Cannot proceed without the tree
+
+        cached = self.payment_search.lookup(filter_term) if live else None
+        if cached is not None:
+            self.jobs.cancel('payments') # An older search still running must not overwrite this result
+            self.show_payment_data(filter_term, cached, len(cached), False, live)
+            return
+
+        def fetch(job):
+            reads = self.synced_reads() or self.payments_repo
+            job.check()
+            # One page past the threshold tells us whether the full set fits in the tree
+            payment_rows = reads.list_payments_page(filter_term, limit=VIRTUAL_GRID_THRESHOLD + 1)
+            job.check()
+            total = reads.count_payments(filter_term) if len(payment_rows) > VIRTUAL_GRID_THRESHOLD else len(payment_rows)
+            empty = not payment_rows and not filter_term and self.is_db_empty()
+            return payment_rows, total, empty
+
+        # A new search supersedes (and interrupts) one that is still running
+        def done(result):
+            payment_rows, total, db_empty = result
+            if len(payment_rows) <= VIRTUAL_GRID_THRESHOLD and (payment_rows or filter_term):
+                self.payment_search.store(filter_term, payment_rows) # Complete result: reusable for refinements
+            self.show_payment_data(filter_term, payment_rows, total, db_empty, live)
+
+        self.jobs.submit(fetch, on_done=done,
+                         on_error=lambda e: self.report_error("Database Error", "Error loading payment data", e),
+                         group='payments', label="Carregando pagamentos...")
+
+    @timed("ui.fill_payments")
+    def show_payment_data(self, filter_term, payment_rows, total, db_empty, live=False):
+        """Fills payments_tree with the result of load_payment_data (runs on the Tk thread)."""
         try:
-            conn, cursor = self.connect_to_db();
-            if not conn: return
-            query = "SELECT * FROM student_payments"; params = ()
-            if filter_term:
-                 if filter_term.isdigit(): query += " WHERE id = %s"; params = (int(filter_term),)
-                 else: query += " WHERE LOWER(student_name) LIKE LOWER(%s)"; params = (f'%{filter_term}%',)
-            query += " ORDER BY id"; cursor.execute(query, params); payment_rows = cursor.fetchall(); conn.close()
-
-            # Ensure payments_tree exists before clearing
-            if hasattr(self, 'payments_tree'):
-                 for item in self.payments_tree.get_children(): self.payments_tree.delete(item)
-            else:
-                print("Warning: payments_tree not found during load_payment_data")
-                return # Cannot proceed without the tree
-
-            if not payment_rows and filter_term: messagebox.showinfo("Busca", f"Nenhum aluno encontrado para '{filter_term}'."); return
-            elif not payment_rows and not filter_term and self.is_db_empty("student_payments"): self.load_sample_data(); return
-
-            for row_data in payment_rows:
-                formatted_row = list(row_data)
-                # Format discount (index 4)
-                formatted_row[4] = self.format_currency(row_data[4])
-                # Format monthly payments (indices 5 to 16)
-                for i in range(len(self.month_codes_ordered)):
-                    col_index = i + 5
-                    if col_index < len(row_data):
-                        formatted_row[col_index] = self.format_currency(row_data[col_index])
-                    else:
-                         # If data is missing for a month, append default
-                         if len(formatted_row) <= col_index:
-                             formatted_row.append("0,00")
-                         else: # Should not happen if DB schema is correct
-                             formatted_row[col_index] = "0,00" # Fallback
-
-                # Ensure the row has the correct number of columns for the tree
-                while len(formatted_row) < len(self.payments_tree['columns']):
-                     formatted_row.append("0,00")
-
-                # Insert into tree, taking only the expected number of columns
-                self.payments_tree.insert('', 'end', values=tuple(formatted_row[:len(self.payments_tree['columns'])]))
-
-            self.apply_existing_marks() # Apply marks after loading base data
-            print("Payment data loaded and marks applied.")
-        except AttributeError as ae:
+            self.payment_rows.clear(); self.payment_filter = filter_term
+
+            if not payment_rows and filter_term:
+                if not live: messagebox.showinfo("Busca", f"Nenhum aluno encontrado para '{filter_term}'.")
+                return
+            elif not payment_rows and not filter_term and db_empty: self.load_sample_data(); return
+
+            if len(payment_rows) > VIRTUAL_GRID_THRESHOLD:
+                # Virtual mode: rows are fetched page by page (keyset pagination) as the user scrolls
+                self.payment_rows = self.switch_grid(self.payment_index, self.payment_grid)
+                reads = self.page_reads(self.payments_repo)
+                self.payment_rows.load(
+                    fetch_page=lambda offset, limit, after_key: reads().list_payments_page(filter_term, limit, offset, after_key),
+                    count_rows=lambda: reads().count_payments(filter_term),
+                    format_row=lambda student: (student.id, self.payment_row_values(student), ()),
+                    first_records=payment_rows, total=total)
+                logger.debug("Payment data loaded in virtual mode (%d rows).", self.payment_rows.total)
+                return
+
+            self.payment_rows = self.switch_grid(self.payment_grid, self.payment_index)
+            # Statuses come pivoted from the same query, so each row is inserted once, already marked
+            for student in payment_rows:
+                self.payment_rows.append(student.id, self.payment_row_values(student), record=student)
+            logger.debug("Payment data loaded with marks (%d rows).", len(payment_rows))
+        except AttributeError:
              # Catch cases where widgets might not be fully initialized yet
-             print(f"Attribute Error during payment load (potential timing issue): {ae}")
-             import traceback; print(traceback.format_exc())
+             logger.exception("Attribute Error during payment load (potential timing issue)")
         except Exception as e:
-            import traceback; error_details = traceback.format_exc(); print(f"Error loading payments: {str(e)}\n{error_details}")
+            logger.exception("Error loading payments")
             messagebox.showerror("Database Error", f"Error loading payment data: {str(e)}")
 
+    def status_mark(self, amount, status):
+        """✅ for 'Pago', ❌ for 'Pendente'/'Em Negociação'; no mark for zero amounts or months without status."""
+        if not amount or amount <= 0: return ""
+        if status == 'Pago': return PAID_MARK
+        if status == 'Pendente' or status == 'Em Negociação': return DEBTOR_MARK
+        return ""
+
+    def payment_row_values(self, student):
+        """Formats a repository StudentPayment (with month statuses) into payments_tree values."""
+        values = [student.id, student.payment_day, student.student_name, student.course, self.format_currency(student.discount)]
+        values.extend(self.format_currency(amount) + self.status_mark(amount, status) for amount, status in zip(student.months, student.statuses))
+        return tuple(values)
+
+    def load_debtor_data(self, filter_term=None, live=False):
+        """Loads data into the Debtors table, showing only 'Pendente' or 'Em Negociação'.
+
+        Like load_payment_data, served from debtor_search when possible."""
+        logger.debug("Loading debtor data (filter=%r, live=%s)...", filter_term, live)
+        # Ensure debtors_tree exists before loading
+        if not hasattr(self, 'debtors_tree'):
+            logger.warning("debtors_tree not found during load_debtor_data")
+            return
 
-    def apply_existing_marks(self):
-        """Applies ✅/❌ marks to the payments_tree based on student_debtors status."""
-        print("Applying existing marks to payments tab...")
-        try:
-            # Ensure payments_tree exists
-            if not hasattr(self, 'payments_tree'):
-                print("Warning: payments_tree not found during apply_existing_marks")
-                return
+        cached = self.debtor_search.lookup(filter_term) if live else None
+        if cached is not None:
+            self.jobs.cancel('debtors')
+            self.show_debtor_data(filter_term, cached, len(cached), live)
+            return
 
-            conn, cursor = self.connect_to_db();
-            if not conn: 
-                return
-            debtor_statuses = {}; cursor.execute("SELECT id, month, status FROM student_debtors");
-            for d_id, d_month, d_status in cursor.fetchall(): debtor_statuses[(d_id, d_month)] = d_status
-            conn.close()
-            # >> NÃO RETORNE AQUI SE debtor_statuses ESTIVER VAZIO <<
-            # Precisamos continuar para aplicar os ✅ padrão para meses pagos.
-            # if not debtor_statuses: print("No debtor statuses found to apply marks."); return
-
-            for item_id_str in self.payments_tree.get_children():
-                current_values = list(self.payments_tree.item(item_id_str, 'values'))
-                if not current_values or len(current_values) < 1: continue
-                try: student_id = int(current_values[0])
-                except (IndexError, ValueError): continue
-
-                new_values = list(current_values); changed = False
-                for i, month_code in enumerate(self.month_codes_ordered):
-                    month_name_full = self.month_names_map[month_code]; col_index_in_tree = i + 5
-                    if col_index_in_tree >= len(current_values): continue
-
-                    # 1. Obtenha o valor como está na árvore AGORA (formatado, sem marca)
-                    current_display_value = str(current_values[col_index_in_tree]).strip()
-
-                    # 2. Parse o valor para verificar se é > 0 (remova marcas potenciais apenas para parse)
-                    value_for_parsing = current_display_value.replace(PAID_MARK, '').replace(DEBTOR_MARK, '').strip()
-                    numeric_value = self.parse_currency(value_for_parsing)
-
-                    # 3. Determine a marca a ser adicionada
-                    mark_to_add = ""
-                    if numeric_value > 0:
-                        db_status = debtor_statuses.get((student_id, month_name_full))
-                        if db_status == 'Pago': mark_to_add = PAID_MARK
-                        elif db_status == 'Pendente' or db_status == 'Em Negociação': mark_to_add = DEBTOR_MARK
-                        
-
-                    # 4. Construa o novo valor adicionando a marca ao valor JÁ FORMATADO da árvore
-                    new_cell_value = current_display_value + mark_to_add
-
-                    # 5. Verifique se o valor realmente mudou (se uma marca foi adicionada/removida)
-                    if current_values[col_index_in_tree] != new_cell_value:
-                        new_values[col_index_in_tree] = new_cell_value
-                        changed = True
-
-                # Atualize a linha na árvore se alguma célula mudou
-                if changed:
-                    try: self.payments_tree.item(item_id_str, values=tuple(new_values))
-                    except Exception as update_err: print(f"Error updating tree item {item_id_str}: {update_err}")
-            print("Finished applying marks.")
-        except AttributeError as ae:
-            print(f"Attribute Error during apply marks (potential timing issue): {ae}")
-            import traceback; print(traceback.format_exc())
-        except Exception as e:
-            import traceback; print(f"Error applying marks: {e}\n{traceback.format_exc()}")
-        
-    def load_debtor_data(self, filter_term=None):
-        """Loads data into the Debtors table, showing only 'Pendente' or 'Em Negociação'."""
-        print("Loading filtered debtor data (Pendente/Em Negociação)...")
+        aging, by_aging = self.debtor_aging, self.debtor_by_aging
+        def fetch(job):
+            reads = self.synced_reads() or self.debtors_repo
+            job.check()
+            # Status filter is mandatory; the search term (ID or name) and aging bucket are optional
+            debtor_rows = reads.list_open_debtors_page(filter_term, limit=VIRTUAL_GRID_THRESHOLD + 1, aging=aging, by_aging=by_aging)
+            job.check()
+            total = reads.count_open_debtors(filter_term, aging=aging) if len(debtor_rows) > VIRTUAL_GRID_THRESHOLD else len(debtor_rows)
+            return debtor_rows, total
+
+        def done(result):
+            debtor_rows, total = result
+            if len(debtor_rows) <= VIRTUAL_GRID_THRESHOLD:
+                self.debtor_search.store(filter_term, debtor_rows)
+            self.show_debtor_data(filter_term, debtor_rows, total, live)
+
+        self.jobs.submit(fetch, on_done=done,
+                         on_error=lambda e: self.report_error("Database Error", "Error loading debtor data", e),
+                         group='debtors', label="Carregando devedores...")
+
+    def synced_reads(self):
+        """The local replica after a delta sync (only rows changed since the last one are read), or None
+        without one. Runs inside background jobs; the loads fall back to the repositories.
+        Offline, the replica as it is (through the offline store)."""
+        if self.offline: return self.offline_store
+        cache = self.local_cache
+        if cache is None: return None
+        cache.sync()
+        return cache
+
+    def page_reads(self, repo):
+        """Where a virtual grid reads its pages, as a function called on each recount and page fetch: the
+        replica the first page came from (offline, the offline store), else ``repo``. Online the replica is
+        delta-synced on every call, since the grid recounts and re-reads right after the app's own writes."""
+        if self.offline: store = self.offline_store; return lambda: store
+        cache = self.local_cache
+        if cache is None or not cache.ready: return lambda: repo
+        def synced(): cache.sync(); return cache # One indexed query when nothing changed
+        return synced
+
+    @timed("ui.fill_debtors")
+    def show_debtor_data(self, filter_term, debtor_rows, total, live=False):
+        """Fills debtors_tree with the result of load_debtor_data (runs on the Tk thread)."""
         try:
-            # Ensure debtors_tree exists before clearing
-            if not hasattr(self, 'debtors_tree'):
-                print("Warning: debtors_tree not found during load_debtor_data")
-                return
-
-            conn, cursor = self.connect_to_db()
-            if not conn: return
-
-            # Base query
-            query = "SELECT id, student_name, course, month, amount, status, comment FROM student_debtors"
-
-            # --- Filtering Logic ---
-            where_clauses = []
-            params = []
-
-            # 1. MANDATORY Status Filter: Only Pending or In Negotiation
-            where_clauses.append("status IN (%s, %s)")
-            params.extend(['Pendente', 'Em Negociação']) # Add statuses to parameters
-
-            # 2. OPTIONAL Search Filter (ID or Name)
-            if filter_term:
-                search_term_lower = f'%{filter_term.lower()}%'
-                if filter_term.isdigit():
-                    where_clauses.append("id = %s")
-                    params.append(int(filter_term))
-                else:
-                    where_clauses.append("LOWER(student_name) LIKE LOWER(%s)")
-                    params.append(search_term_lower)
-
-            # Combine WHERE clauses if any exist
-            if where_clauses:
-                query += " WHERE " + " AND ".join(where_clauses)
-
-            # --- ORDER BY Clause ---
-            # ORDER BY ensures consistent display
-            query += " ORDER BY id, CASE month "
-            for i, code in enumerate(self.month_codes_ordered):
-                 query += f" WHEN '{self.month_names_map[code]}' THEN {i}"
-            query += " ELSE 99 END" # Put unknown months last
-
-            # --- Execute Query ---
-            print(f"Executing Debtor Query: {query}") # For debugging
-            print(f"Parameters: {tuple(params)}")      # For debugging
-            cursor.execute(query, tuple(params)) # Pass parameters as a tuple
-            debtor_rows = cursor.fetchall()
-            conn.close()
-
             # --- Display Results ---
-            self.display_debtor_data(debtor_rows) # Use helper to display
+            if len(debtor_rows) > VIRTUAL_GRID_THRESHOLD:
+                self.debtor_rows.clear()
+                self.debtor_rows = self.switch_grid(self.debtor_index, self.debtor_grid)
+                reads, aging, by_aging = self.page_reads(self.debtors_repo), self.debtor_aging, self.debtor_by_aging
+                self.debtor_rows.load(
+                    fetch_page=lambda offset, limit, after_key: reads().list_open_debtors_page(filter_term, limit, offset, after_key, aging=aging, by_aging=by_aging),
+                    count_rows=lambda: reads().count_open_debtors(filter_term, aging=aging),
+                    format_row=self.debtor_grid_row,
+                    first_records=debtor_rows, total=total)
+            else:
+                self.debtor_rows = self.switch_grid(self.debtor_grid, self.debtor_index)
+                self.display_debtor_data(debtor_rows) # Use helper to display
+            self.debtor_filter = filter_term
 
-            if not debtor_rows and filter_term:
-                 messagebox.showinfo("Busca Devedores", f"Nenhum devedor (Pendente/Em Negociação) encontrado para '{filter_term}'.")
+            if not debtor_rows and filter_term and not live:
+                 messagebox.showinfo("Busca Devedores", f"Nenhum devedor (Pendente/Em Negociação) encontrado para '{filter_term}'"
+                                     + (f" com atraso {self.debtor_aging}." if self.debtor_aging else "."))
             elif not debtor_rows and not filter_term:
-                 print("Nenhum registro com status 'Pendente' ou 'Em Negociação' encontrado.")
+                 logger.debug("Nenhum registro com status 'Pendente' ou 'Em Negociação' encontrado.")
 
 
-            print(f"Filtered debtor data loaded. Found {len(debtor_rows)} entries.")
+            logger.debug("Filtered debtor data loaded. Found %d entries.", len(self.debtor_rows))
 
-        except AttributeError as ae:
-             print(f"Attribute Error during debtor load (potential timing issue): {ae}")
-             import traceback; print(traceback.format_exc())
+        except AttributeError:
+             logger.exception("Attribute Error during debtor load (potential timing issue)")
         except Exception as e:
+             logger.exception("Error loading debtor data")
              messagebox.showerror("Database Error", f"Error loading debtor data: {str(e)}")
-             import traceback; print(traceback.format_exc())
 
         # --- Coloque esta função DENTRO da classe StudentPaymentApp ---
     # --- No mesmo nível de indentação de load_debtor_data, etc. ---
@@ -595,247 +1025,275 @@ class StudentPaymentApp:
         """Clears and populates the debtors_tree with given rows and applies status tags."""
         # Ensure debtors_tree exists
         if not hasattr(self, 'debtors_tree'):
-                print("Warning: debtors_tree not found during display_debtor_data")
+                logger.warning("debtors_tree not found during display_debtor_data")
                 return
 
-        # Clear existing treeview items
-        for item in self.debtors_tree.get_children():
-            try:
-                self.debtors_tree.delete(item)
-            except tk.TclError as e:
-                print(f"Warning: Could not delete item {item} from debtors_tree: {e}")
-
+        # Clear existing treeview items (single Tcl call) and the row index
+        self.debtor_rows.clear()
 
         # Populate treeview
         for row in rows:
             # Ensure row has enough elements (id, name, course, month, amount, status, comment)
             if len(row) < 7:
-                print(f"Skipping incomplete debtor row: {row}")
+                logger.warning("Skipping incomplete debtor row: %s", row)
                 continue
 
-            formatted_row = list(row)
-            # Format amount (index 4)
-            formatted_row[4] = self.format_currency(row[4])
-
-            # Determine tag based on status (index 5)
-            status = formatted_row[5]
-            tag = 'unknown' # Default tag
-            if status == 'Pago': tag = 'Pago'
-            elif status == 'Em Negociação': tag = 'Em Negociação'
-            elif status == 'Pendente': tag = 'Pendente'
-
+            values, tag = self.debtor_row_values(row)
             # Insert row with the determined tag
             try:
-                self.debtors_tree.insert('', 'end', values=tuple(formatted_row[:7]), tags=(tag,))
+                self.debtor_rows.append((row[0], row[3]), values, tags=(tag,), record=row)
             except tk.TclError as e:
-                 print(f"Warning: TclError inserting debtor row: {formatted_row}, Error: {e}")
-            except Exception as insert_error:
-                print(f"Error inserting debtor row: {formatted_row}, Error: {insert_error}")         
-            
-    def is_db_empty(self, table_name):
-        conn, cursor = self.connect_to_db();
-        if not conn: return True
-        try: cursor.execute(f"SELECT 1 FROM {table_name} LIMIT 1"); return cursor.fetchone() is None
+                 logger.warning("TclError inserting debtor row %s: %s", values, e)
+
+    def debtor_row_values(self, row):
+        """Formats a debtor record into debtors_tree values and its status tag."""
+        formatted_row = list(row[:7])
+        # Format amount (index 4)
+        formatted_row[4] = self.format_currency(row[4])
+        # Days overdue as of today, between Status and Comentário
+        formatted_row.insert(6, format_overdue(row.due))
+
+        # Determine tag based on status (index 5)
+        status = formatted_row[5]
+        tag = 'unknown' # Default tag
+        if status == 'Pago': tag = 'Pago'
+        elif status == 'Em Negociação': tag = 'Em Negociação'
+        elif status == 'Pendente': tag = 'Pendente'
+        return tuple(formatted_row), tag
+
+    def debtor_grid_row(self, row):
+        """(key, values, tags) for the virtual debtors grid."""
+        values, tag = self.debtor_row_values(row)
+        return (row[0], row[3]), values, (tag,)
+
+    def debtor_sort_key(self, key, debt):
+        """Position of a debtors_tree row, as the query orders them (see set_debtor_order)."""
+        month = MONTH_INDEX.get(key[1], 99)
+        return (debt.due, key[0], month) if self.debtor_by_aging else (key[0], month)
+
+    # --- Debt Aging (Devedores tab) ---
+    def set_debtor_aging(self, aging):
+        """Shows only the debts of one AGING_BUCKETS bucket (None = all), as of today."""
+        if aging == self.debtor_aging: return
+        self.debtor_aging = aging; self.debtor_search.clear() # Cached results hold the previous bucket
+        self.clear_debtor_form(); self.load_debtor_data(self.debtor_filter)
+
+    def set_debtor_order(self, by_aging):
+        """Orders the Devedores list by due date (most overdue first) or by ID and month."""
+        if by_aging == self.debtor_by_aging: return
+        self.debtor_rows.clear() # Rows placed by the previous order
+        self.debtor_by_aging = by_aging; self.debtor_search.clear()
+        self.debtors_tree.heading("id", text="ID" if by_aging else "ID ▲")
+        self.debtors_tree.heading("overdue", text="Atraso (dias) ▼" if by_aging else "Atraso (dias)")
+        self.clear_debtor_form(); self.load_debtor_data(self.debtor_filter)
+
+    def in_debtor_aging(self, debt):
+        """True if ``debt`` belongs in the aging bucket the Devedores tab shows."""
+        return self.debtor_aging is None or debt.due is None or aging_bucket(days_overdue(debt.due)) == self.debtor_aging
+
+    def switch_grid(self, inactive, active):
+        """Makes `active` (TreeRowIndex or VirtualTreeGrid) own the tree and returns it."""
+        if inactive is not active:
+            inactive.clear()
+            if inactive.is_virtual: inactive.detach()
+            if active.is_virtual: active.attach()
+        return active
+
+    # --- Incremental Row Updates ---
+    def fetch_student_rows(self, student_id, month_name=None):
+        """Reads what refresh_student_rows needs: the student (None if gone) and its open debts.
+
+        Runs inside background jobs, right after the mutation that changed the student.
+        With month_name, only that (student, month) debt is read.
+        """
+        payments, debtors = self.repo_for(self.payments_repo), self.repo_for(self.debtors_repo)
+        student = payments.get_student(student_id)
+        if student is None: return None, []
+        if month_name is not None:
+            debt = debtors.get_debtor(student_id, month_name)
+            return student, [debt] if debt and debt.status in ('Pendente', 'Em Negociação') else []
+        return student, debtors.list_open_debtors(str(student_id))
+
+    @timed("ui.patch_rows")
+    def refresh_student_rows(self, student_id, fetched, month_name=None):
+        """Patches only the affected rows of both trees with the result of fetch_student_rows."""
+        self.payment_search.clear(); self.debtor_search.clear() # Cached results no longer match the database
+        student, open_debts = fetched
+        if student is None:
+            self.remove_student_rows(student_id); return
+
+        if matches_search(self.payment_filter, student.id, student.student_name):
+            self.payment_rows.upsert(student.id, self.payment_row_values(student), record=student)
+        else:
+            self.payment_rows.remove(student.id)
+
+        if month_name is not None:
+            stale_keys = {(student_id, month_name)}
+        else:
+            stale_keys = set(self.debtor_rows.keys_for(student_id))
+
+        for debt in open_debts:
+            if not matches_search(self.debtor_filter, debt.id, debt.student_name) or not self.in_debtor_aging(debt): continue
+            values, tag = self.debtor_row_values(debt)
+            self.debtor_rows.upsert((debt.id, debt.month), values, tags=(tag,), record=debt)
+            stale_keys.discard((debt.id, debt.month))
+        for key in stale_keys:
+            self.debtor_rows.remove(key)
+
+    def remove_student_rows(self, student_id):
+        """Drops a student's row from the payments tab and all of its rows from the debtors tab."""
+        self.payment_search.clear(); self.debtor_search.clear()
+        self.payment_rows.remove(student_id)
+        for key in list(self.debtor_rows.keys_for(student_id)):
+            self.debtor_rows.remove(key)
+
+    def is_db_empty(self):
+        # Called from background jobs (load_payment_data); offline, an empty copy does not offer the sample data
+        if self.offline: return False
+        try: return self.payments_repo.is_empty()
         except Exception: return True
-        finally:
-            if conn: conn.close()
 
     def load_sample_data(self):
         if not messagebox.askyesno("Banco Vazio", "Nenhum dado de pagamento encontrado. Carregar dados de exemplo?"): return
-        try:
-            conn, cursor = self.connect_to_db();
-            if not conn: return
+        def work(job):
             # Ensure tables exist before inserting
-            self.setup_database() # Re-run setup just in case
-
-            conn, cursor = self.connect_to_db(); # Reconnect if setup closed it
-            if not conn: return
-
-            sample_payments=[(1001,10,"Pedro Faleiro Rocha","TQI",0.00,10.00,11.00,11.00,0.00,390.10,390.55,0,0,0,0,0,0),(1002,20,"Isis Silva Pinheiro Aires","SB",20.00,270.18,270.18,270.18,10.00,0,0,0,0,0,0,0,0),(1003,10,"Pedro Motteran Thomaz Vi","FLY1",20.00,329.46,329.46,329.46,0,0,0,10.00,0,0,0,0,0), (1004, 10, "chuleto", "TO1", 0.00, 10.00, 10.00, 10.00, 10.00, 10.00, 10.00, 10.00, 10.00, 10.00, 10.00, 10.00, 10.00)]
-            insert_pay="INSERT INTO student_payments (id, payment_day, student_name, course, discount, jan, feb, mar, apr, may, jun, jul, aug, sep, oct, nov, dec) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) ON CONFLICT (id) DO NOTHING"; cursor.executemany(insert_pay, sample_payments)
-
-            sample_debtors=[(1001,'Pedro Faleiro Rocha','TQI','Fevereiro',11.00,'Pendente',''),(1001,'Pedro Faleiro Rocha','TQI','Março',11.00,'Pendente',''),(1001,'Pedro Faleiro Rocha','TQI','Maio',390.10,'Pendente','Pagamento atrasado'),(1002,'Isis Silva Pinheiro Aires','SB','Janeiro',270.18,'Em Negociação','Combinado pagar dia 30'),(1002,'Isis Silva Pinheiro Aires','SB','Abril',10.00,'Pendente',''),(1003,'Pedro Motteran Thomaz Vi','FLY1','Fevereiro',329.46,'Pendente',''), (1004, 'chuleto', 'TO1', 'Janeiro', 10.00, 'Pendente', '')]
-
-            insert_debt="INSERT INTO student_debtors (id, student_name, course, month, amount, status, comment) VALUES (%s,%s,%s,%s,%s,%s,%s) ON CONFLICT (id, month) DO UPDATE SET status=EXCLUDED.status, amount=EXCLUDED.amount, comment=EXCLUDED.comment"; cursor.executemany(insert_debt, sample_debtors)
-            conn.commit(); conn.close(); messagebox.showinfo("Sucesso", "Dados de exemplo carregados.")
+            setup_schema(get_pool()) # Re-run setup just in case
+            load_sample_rows(self.payments_repo, self.debtors_repo)
+        def done(_):
+            self.payment_search.clear(); self.debtor_search.clear()
+            messagebox.showinfo("Sucesso", "Dados de exemplo carregados.")
             self.load_payment_data(); self.load_debtor_data() # Reload both tabs
-        except Exception as e:
-            import traceback; print(traceback.format_exc())
-            messagebox.showerror("Database Error", f"Error loading sample data: {str(e)}")
-        finally:
-             # Ensure connection is closed even if errors occurred during inserts
-             if 'conn' in locals() and conn and not conn.closed:
-                 conn.rollback()
-                 conn.close()
-
+        self.jobs.submit(work, on_done=done, on_error=lambda e: self.report_error("Database Error", "Error loading sample data", e),
+                         write=True, label="Carregando dados de exemplo...")
 
     # --- Event Handlers ---
     def on_payment_select(self, event):
         selected_items = self.payments_tree.selection();
+        if self.payment_rows.is_virtual and self.payment_rows.is_reselection(selected_items):
+            return # Virtual grid re-rendered after scrolling; keep the form (and any edits) as they are
         if not selected_items:
             self.clear_payments_form(); self.selected_student_info = None
-            # Disable status buttons only if they exist
-            if hasattr(self, 'month_status_buttons'):
-                for btn in self.month_status_buttons.values(): btn.config(state=tk.DISABLED)
+            self.set_status_buttons_enabled(False)
             return
-        item = selected_items[0]; values = self.payments_tree.item(item, 'values')
-        if not values or len(values) < len(self.payments_tree['columns']):
+        student = self.payment_rows.record_at(selected_items[0]) # The row's StudentPayment: numbers, not display text
+        if student is None:
              messagebox.showerror("Erro", "Erro ao ler dados da linha (incompleta)."); self.clear_payments_form(); return
-        try:
-            self.id_var.set(values[0]); self.payment_day_var.set(values[1]); self.student_name_var.set(values[2]); self.course_var.set(values[3])
-            # Parse and reformat to handle potential marks in the value
-            self.discount_var.set(self.format_currency(self.parse_currency(values[4])))
-            for i, month_code in enumerate(self.month_codes_ordered):
-                value_index = i + 5
-                if value_index < len(values):
-                    # Parse and reformat to handle potential marks in the value
-                    self.month_vars[month_code].set(self.format_currency(self.parse_currency(values[value_index])))
-                else: self.month_vars[month_code].set("0,00")
-            self.selected_student_info = {'id': int(values[0]), 'name': values[2], 'course': values[3]}
-            # Enable status buttons only if they exist
-            if hasattr(self, 'month_status_buttons'):
-                for btn in self.month_status_buttons.values(): btn.config(state=tk.NORMAL)
-        except (IndexError, ValueError, AttributeError) as e:
-             messagebox.showerror("Erro", f"Erro ao processar dados: {e}"); self.clear_payments_form()
-             self.selected_student_info = None;
-             if hasattr(self, 'month_status_buttons'):
-                 [btn.config(state=tk.DISABLED) for btn in self.month_status_buttons.values()]
+        self.id_var.set(student.id); self.payment_day_var.set(student.payment_day if student.payment_day is not None else ""); self.student_name_var.set(student.student_name); self.course_var.set(student.course)
+        self.discount_var.set(self.format_currency(student.discount))
+        for month_code, amount in zip(self.month_codes_ordered, student.months):
+            self.month_vars[month_code].set(self.format_currency(amount))
+        self.selected_student_info = student
+        self.set_status_buttons_enabled(True)
 
 
     def on_debtor_select(self, event):
         """Handles selection changes in the debtors Treeview."""
         selected_items = self.debtors_tree.selection()
+        if self.debtor_rows.is_virtual and self.debtor_rows.is_reselection(selected_items):
+            return # Virtual grid re-rendered after scrolling; keep the form as it is
         if not selected_items:
             self.clear_debtor_form()
             return
 
-        item = selected_items[0]
-        values = self.debtors_tree.item(item, 'values')
-
-        if not values or len(values) < 7:
+        debt = self.debtor_rows.record_at(selected_items[0])
+        if debt is None:
             messagebox.showerror("Erro", "Erro ao ler dados da linha de devedor selecionada.")
             self.clear_debtor_form()
             return
-
-        try:
-            self.debtor_amount_var.set(values[4])
-            self.debtor_status_var.set(values[5])
-            self.debtor_comment_var.set(values[6])
-        except IndexError:
-             messagebox.showerror("Erro", "Dados incompletos na linha de devedor selecionada.")
-             self.clear_debtor_form()
+        self.debtor_amount_var.set(self.format_currency(debt.amount))
+        self.debtor_status_var.set(debt.status)
+        self.debtor_comment_var.set(debt.comment)
+        self.selected_debtor_info = debt
 
 
     def handle_status_button_click(self, month_code):
-        """Handles clicks on the monthly status buttons (Pagamentos Tab)."""
-        print(f"\n--- handle_status_button_click START ({month_code}) ---") # DEBUG START
+        """Handles clicks on the monthly status buttons (Pagamentos Tab).
+
+        With several rows selected, or "todos" checked, the month is marked for all of
+        them at once (see handle_batch_status)."""
+        if self.status_all_var.get():
+            self.handle_batch_status(month_code, student_ids=None); return
+        selected_ids = self.selected_student_ids()
+        if len(selected_ids) > 1:
+            self.handle_batch_status(month_code, student_ids=selected_ids); return
         if not self.selected_student_info:
             messagebox.showwarning("Aviso", "Nenhum aluno selecionado.", icon='warning')
-            print("DEBUG: Nenhum aluno selecionado.") # DEBUG
             return
 
-        student_id = self.selected_student_info['id']; student_name = self.selected_student_info['name']; course = self.selected_student_info['course']; month_name_full = self.month_names_map[month_code]
-        amount = 0.0
-        conn_check, cursor_check = None, None # Initialize for finally block
-
-        print(f"DEBUG: Checking base amount for Aluno ID: {student_id}, Mês: {month_name_full}") # DEBUG
-        try:
-            conn_check, cursor_check = self.connect_to_db();
-            if not conn_check: raise Exception("Falha DB Check.")
-            # Fetch the specific month's value directly
-            cursor_check.execute(f"SELECT {month_code} FROM student_payments WHERE id = %s", (student_id,)); result = cursor_check.fetchone();
-            if result is None: raise Exception(f"Aluno ID {student_id} não encontrado.")
-            # Use parse_currency to handle potential Decimal type from DB
-            amount = self.parse_currency(result[0])
-            print(f"DEBUG: Base amount fetched: {amount}") # DEBUG
-        except Exception as e:
-             messagebox.showerror("Erro DB", f"Erro buscar valor base: {e}");
-             print(f"DEBUG: Erro ao buscar valor base: {e}") # DEBUG
-             import traceback; print(traceback.format_exc()) # DEBUG
-             return
-        finally:
-             if conn_check: conn_check.close() # Ensure connection is closed
-
+        # The row's current record (patched by refresh_student_rows after every save) has the month's amount
+        student = self.payment_rows.record(self.selected_student_info.id) or self.selected_student_info
+        student_id = student.id; student_name = student.student_name; month_name_full = self.month_names_map[month_code]
+        amount = student.month_amount(month_code)
         if amount <= 0:
-            print(f"DEBUG: Amount {amount} <= 0 for {month_name_full}. Status não aplicável.") # DEBUG
             messagebox.showinfo("Info", f"Valor para {month_name_full} é {self.format_currency(amount)}. Status não aplicável.")
-            conn_clean, cursor_clean = None, None
-            # ... (bloco para limpar devedor com valor zero - sem prints adicionais aqui por ora) ...
-            # (o print existente 'Cleaned debtor status...' já está lá)
             return
 
         # --- Diálogo com o usuário ---
         base_formatted_value = self.format_currency(amount)
         dialog = StatusChoiceDialog(self.root, f"Aluno: {student_name}\nMês: {month_name_full}\nValor: {base_formatted_value}", ["Pago", "Devedor"])
         result_status_choice = dialog.result
-        print(f"DEBUG: User choice from dialog: {result_status_choice}") # DEBUG
         if result_status_choice is None:
-            print("DEBUG: User cancelled the dialog.") # DEBUG
             return
 
-        # --- Preparação para Atualização do Banco ---
-        db_update_successful = False;
+        # --- Atualização do Banco (em segundo plano) ---
         # Define o status a ser salvo no DB
         new_debtor_status_db = 'Pago' if result_status_choice == 'Pago' else 'Pendente'
-        print(f"DEBUG: Status to be saved in DB: '{new_debtor_status_db}'") # DEBUG
-        print(f"DEBUG: Preparing DB update for ID: {student_id}, Mês: {month_name_full}, Valor: {amount}, Status: {new_debtor_status_db}") # DEBUG
-
-        conn_update, cursor_update = None, None
-        try:
-            conn_update, cursor_update = self.connect_to_db();
-            if not conn_update: raise Exception("Falha DB Update.")
-
-            upsert_query = """INSERT INTO student_debtors (id, student_name, course, month, amount, status, comment) VALUES (%s, %s, %s, %s, %s, %s, '') ON CONFLICT (id, month) DO UPDATE SET status = EXCLUDED.status, amount = EXCLUDED.amount, student_name = EXCLUDED.student_name, course = EXCLUDED.course, comment = COALESCE(student_debtors.comment, '')"""
-            params_tuple = (student_id, student_name, course, month_name_full, amount, new_debtor_status_db)
-
-            print(f"DEBUG: Executing UPSERT query...") # DEBUG
-            print(f"DEBUG: Query Params: {params_tuple}") # DEBUG
-            cursor_update.execute(upsert_query, params_tuple);
-            print(f"DEBUG: UPSERT query executed.") # DEBUG
-
-            print(f"DEBUG: Committing transaction...") # DEBUG
-            conn_update.commit();
-            db_update_successful = True;
-            print(f"DEBUG: Commit successful.") # DEBUG
 
-            # Este print antigo já estava bom:
-            print(f"DB updated via status button for {student_name}, {month_name_full}: Status={new_debtor_status_db}")
-
-        except Exception as e:
-             print(f"DEBUG: EXCEPTION during DB update!") # DEBUG
-             if conn_update:
-                 print("DEBUG: Rolling back transaction...") # DEBUG
-                 conn_update.rollback()
-             messagebox.showerror("Erro DB", f"Erro ao atualizar status: {str(e)}");
-             print(f"DEBUG: Error details: {e}") # DEBUG
-             import traceback; print(traceback.format_exc()) # DEBUG traceback
-        finally:
-             if conn_update:
-                 print("DEBUG: Closing update connection.") # DEBUG
-                 conn_update.close()
-
-        # --- Recarregamento dos Dados ---
-        if db_update_successful:
-            print(f"DEBUG: DB update was successful. Reloading data.") # DEBUG
-            messagebox.showinfo("Sucesso", f"Status de {month_name_full} ({student_name}) atualizado para '{result_status_choice}'.")
-            self.load_payment_data() # Reload payments tab to show marks
-            self.load_debtor_data()  # Reload debtors tab to reflect change
+        def submit(expected):
+            def save(job):
+                # Only written if the month still has the amount/status shown (expected=None: overwrite)
+                with span("marks.apply"):
+                    self.repo_for(self.debtors_repo).upsert_debtor_status(student_id, month_name_full, amount, new_debtor_status_db, expected=expected)
+                    logger.debug("Status of %s for student %s set to %s", month_name_full, student_id, new_debtor_status_db)
+                    return self.fetch_student_rows(student_id, month_name_full)
+
+            def saved(fetched):
+                # --- Atualização das Linhas Afetadas ---
+                messagebox.showinfo("Sucesso", f"Status de {month_name_full} ({student_name}) atualizado para '{result_status_choice}'.")
+                self.refresh_student_rows(student_id, fetched, month_name_full) # Patch the payments row mark and the debtor row
+                current = fetched[0]
+                if current is not None and self.selected_student_info and self.selected_student_info.id == student_id:
+                    self.selected_student_info = current # The form now starts from this status (a later "Atualizar" must not conflict with it)
+
+            self.jobs.submit(save, on_done=saved, on_error=self.save_error_handler("Erro DB", "Erro ao atualizar status", student_id, month_name_full, overwrite=lambda: submit(None)),
+                             write=True, label="Salvando status...")
+        submit(student)
+
+    def handle_batch_status(self, month_code, student_ids=None):
+        """Marks one month as Pago/Devedor for the given students (None = every student listed)
+        with a single set-based statement, then reloads both tabs."""
+        month_name_full = self.month_names_map[month_code]; filter_term = self.payment_filter
+        if student_ids is None:
+            target = "todos os alunos listados" + (f" (busca: '{filter_term}')" if filter_term else "")
         else:
-             print("DEBUG: DB update FAILED. Data not reloaded.") # DEBUG
+            target = f"{len(student_ids)} alunos selecionados"
+        dialog = StatusChoiceDialog(self.root, f"Mês: {month_name_full}\nAplicar a: {target}\n(alunos sem valor no mês são ignorados)", ["Pago", "Devedor"])
+        choice = dialog.result
+        if choice is None: return
+        new_debtor_status_db = 'Pago' if choice == 'Pago' else 'Pendente'
+
+        def save(job):
+            with span("marks.apply_batch"):
+                return self.repo_for(self.debtors_repo).mark_month(month_code, new_debtor_status_db, student_ids=student_ids, filter_term=filter_term)
 
-        print(f"--- handle_status_button_click END ({month_code}) ---") # DEBUG END
+        def saved(count):
+            logger.info("Batch status: %d entries of %s set to %s", count, month_name_full, new_debtor_status_db)
+            self.payment_search.clear(); self.debtor_search.clear()
+            self.load_payment_data(self.payment_filter); self.load_debtor_data(self.debtor_filter)
+            messagebox.showinfo("Sucesso", f"{month_name_full}: {count} alunos marcados como '{choice}'.")
 
+        self.jobs.submit(save, on_done=saved, on_error=lambda e: self.report_error("Erro DB", "Erro ao atualizar status em lote", e),
+                         write=True, label="Salvando status em lote...")
 
     # --- Form Actions (Payments Tab - Minor changes for sync) ---
     def clear_payments_form(self):
         self.id_var.set(""); self.payment_day_var.set(""); self.student_name_var.set(""); self.course_var.set(""); self.discount_var.set("");
         if hasattr(self, 'month_vars'):
             [var.set("") for var in self.month_vars.values()]
-        if hasattr(self, 'payments_tree'):
-             self.payments_tree.selection_set(())
+        if hasattr(self, 'payment_rows'):
+             self.payment_rows.clear_selection()
         self.selected_student_info = None;
-        if hasattr(self, 'month_status_buttons'):
-             [btn.config(state=tk.DISABLED) for btn in self.month_status_buttons.values()]
+        self.set_status_buttons_enabled(False)
 
 
     def validate_payment_form(self, is_update=False):
@@ -859,40 +1317,33 @@ class StudentPaymentApp:
         except AttributeError: messagebox.showerror("Erro Interno", "Erro ao acessar variáveis de mês."); return False
 
 
-        if not is_update:
-             conn, cursor = None, None
-             try:
-                 conn, cursor = self.connect_to_db();
-                 if not conn: return False # Connection error handled in connect_to_db
-                 cursor.execute("SELECT 1 FROM student_payments WHERE id = %s", (id_val,)); exists = cursor.fetchone();
-                 if exists: messagebox.showerror("Erro", f"ID {id_val} já existe no sistema."); return False
-             except Exception as e: messagebox.showerror("Erro DB", f"Erro ao verificar existência do ID: {e}"); return False
-             finally:
-                 if conn: conn.close()
+        # For new students, the ID uniqueness check runs in add_student's background job
         return True
 
+    def student_from_form(self):
+        """Builds a StudentPayment from the (already validated) form fields."""
+        return StudentPayment(
+            id=int(self.id_var.get()), payment_day=int(self.payment_day_var.get()),
+            student_name=self.student_name_var.get().strip(), course=self.course_var.get().strip(),
+            discount=self.parse_currency(self.discount_var.get() or "0,00"),
+            months=tuple(self.parse_currency(self.month_vars[code].get() or "0,00") for code in self.month_codes_ordered))
+
 
     def add_student(self):
         if not self.validate_payment_form(is_update=False): return
-        conn, cursor = None, None
-        try:
-            conn, cursor = self.connect_to_db();
-            if not conn: return
-
-            id_val = int(self.id_var.get()); payment_day = int(self.payment_day_var.get()); student_name = self.student_name_var.get().strip(); course = self.course_var.get().strip(); discount = self.parse_currency(self.discount_var.get() or "0,00"); month_values = {code: self.parse_currency(self.month_vars[code].get() or "0,00") for code in self.month_codes_ordered}
-            insert_values = (id_val, payment_day, student_name, course, discount, month_values["jan"], month_values["feb"], month_values["mar"], month_values["apr"], month_values["may"], month_values["jun"], month_values["jul"], month_values["aug"], month_values["sep"], month_values["oct"], month_values["nov"], month_values["dec"])
-            sql = """INSERT INTO student_payments (id, payment_day, student_name, course, discount, jan, feb, mar, apr, may, jun, jul, aug, sep, oct, nov, dec) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
-            cursor.execute(sql, insert_values); conn.commit()
-            messagebox.showinfo("Sucesso", f"Aluno '{student_name}' adicionado.")
-            self.load_payment_data(); self.load_debtor_data() # Refresh both
+        student = self.student_from_form()
+        def work(job):
+            payments = self.repo_for(self.payments_repo)
+            if payments.exists(student.id): return None
+            payments.add_student(student)
+            return self.fetch_student_rows(student.id)
+        def done(fetched):
+            if fetched is None: messagebox.showerror("Erro", f"ID {student.id} já existe no sistema."); return
+            messagebox.showinfo("Sucesso", f"Aluno '{student.student_name}' adicionado.")
+            self.refresh_student_rows(student.id, fetched) # Insert the new row in place
             self.clear_payments_form()
-        except Exception as e:
-            if conn: conn.rollback();
-            messagebox.showerror("Erro DB", f"Erro ao adicionar aluno: {e}")
-            import traceback; print(traceback.format_exc())
-        finally:
-            if conn: conn.close()
-
+        self.jobs.submit(work, on_done=done, on_error=lambda e: self.report_error("Erro DB", "Erro ao adicionar aluno", e),
+                         write=True, label="Adicionando aluno...")
 
     def update_student(self):
         id_str = self.id_var.get();
@@ -903,16 +1354,11 @@ class StudentPaymentApp:
              student_id_to_update = int(id_str)
         else:
              # If form ID is invalid/empty, try getting from selection
-             selected_items = self.payments_tree.selection()
-             if selected_items:
-                 item = selected_items[0];
-                 try:
-                     values = self.payments_tree.item(item, 'values')
-                     student_id_to_update = int(values[0])
-                     # Populate form with selected student's ID if missing from form
-                     if not self.id_var.get(): self.id_var.set(str(student_id_to_update))
-                 except (IndexError, ValueError, TypeError):
-                     messagebox.showerror("Erro", "Seleção inválida ou dados da linha corrompidos."); return
+             selected = self.selected_records(self.payment_rows)
+             if selected:
+                 student_id_to_update = selected[0].id
+                 # Populate form with selected student's ID if missing from form
+                 if not self.id_var.get(): self.id_var.set(str(student_id_to_update))
              else:
                  # No selection and no valid ID in form
                  messagebox.showerror("Erro", "Selecione um aluno na tabela ou digite um ID válido no campo ID para atualizar."); return
@@ -931,51 +1377,26 @@ class StudentPaymentApp:
              messagebox.showerror("Erro Interno", "ID inválido após validação."); return
 
 
-        conn, cursor = None, None
-        try:
-            conn, cursor = self.connect_to_db();
-            if not conn: return
-
-            # Check if the student ID to be updated actually exists
-            cursor.execute("SELECT 1 FROM student_payments WHERE id = %s", (id_val,));
-            if not cursor.fetchone():
-                messagebox.showerror("Erro", f"ID {id_val} não encontrado no banco de dados para atualização."); return
-
-            # Proceed with update
-            payment_day = int(self.payment_day_var.get()); student_name = self.student_name_var.get().strip(); course = self.course_var.get().strip(); discount = self.parse_currency(self.discount_var.get() or "0,00"); month_values = {code: self.parse_currency(self.month_vars[code].get() or "0,00") for code in self.month_codes_ordered}
-
-            update_sql = """UPDATE student_payments SET payment_day=%s, student_name=%s, course=%s, discount=%s, jan=%s, feb=%s, mar=%s, apr=%s, may=%s, jun=%s, jul=%s, aug=%s, sep=%s, oct=%s, nov=%s, dec=%s WHERE id=%s"""
-            update_values = (payment_day, student_name, course, discount, month_values["jan"], month_values["feb"], month_values["mar"], month_values["apr"], month_values["may"], month_values["jun"], month_values["jul"], month_values["aug"], month_values["sep"], month_values["oct"], month_values["nov"], month_values["dec"], id_val)
-            cursor.execute(update_sql, update_values)
-
-            # Update corresponding entries in student_debtors (or remove if amount becomes zero)
-            for month_code, amount in month_values.items():
-                 month_name = self.month_names_map[month_code]
-                 # Update only existing debtor entries if amount > 0 AND status is not 'Pago'
-                 # Or remove debtor entry if amount is zero
-                 if amount > 0:
-                      # Update details but respect existing status unless it needs creating
-                      # Maybe just update amount, name, course? Status is handled elsewhere.
-                     cursor.execute("""
-                         UPDATE student_debtors
-                         SET student_name=%s, course=%s, amount=%s
-                         WHERE id=%s AND month=%s
-                     """, (student_name, course, amount, id_val, month_name))
-                 else:
-                     # If payment amount becomes 0, remove any corresponding debtor entry
-                     cursor.execute("DELETE FROM student_debtors WHERE id = %s AND month = %s", (id_val, month_name))
-
-            conn.commit()
-            messagebox.showinfo("Sucesso", f"Aluno '{student_name}' (ID: {id_val}) atualizado.")
-            self.load_payment_data(); self.load_debtor_data() # Refresh both
-            self.clear_payments_form()
-
-        except Exception as e:
-            if conn: conn.rollback();
-            messagebox.showerror("Erro DB", f"Erro ao atualizar aluno: {e}")
-            import traceback; print(traceback.format_exc())
-        finally:
-            if conn: conn.close()
+        student = self.student_from_form()
+        # The record the form was filled from: the save fails with a conflict if the row changed since
+        if self.selected_student_info is not None and self.selected_student_info.id == id_val:
+            expected = self.selected_student_info
+        else:
+            expected = self.payment_rows.record(id_val) # ID typed in: the row as currently shown (None = not loaded, no check)
+        def submit(expected):
+            def work(job):
+                # Updates the student and syncs its debtor entries (name/course/amount; zero amounts drop the entry)
+                if not self.repo_for(self.payments_repo).update_student(student, expected=expected): return None
+                return self.fetch_student_rows(id_val)
+            def done(fetched):
+                if fetched is None:
+                    messagebox.showerror("Erro", f"ID {id_val} não encontrado no banco de dados para atualização."); return
+                messagebox.showinfo("Sucesso", f"Aluno '{student.student_name}' (ID: {id_val}) atualizado.")
+                self.refresh_student_rows(id_val, fetched) # Patch the student row and its debtor rows
+                self.clear_payments_form()
+            self.jobs.submit(work, on_done=done, on_error=self.save_error_handler("Erro DB", "Erro ao atualizar aluno", id_val, overwrite=lambda: submit(None)),
+                             write=True, label="Atualizando aluno...")
+        submit(expected)
 
 
     def remove_student(self):
@@ -987,141 +1408,136 @@ class StudentPaymentApp:
             # Try to get name from form if available
             student_name_display = self.student_name_var.get().strip() or f"ID {id_to_remove}"
         else:
-            selected_items = self.payments_tree.selection()
-            if selected_items:
-                item = selected_items[0];
-                try:
-                    values = self.payments_tree.item(item, 'values')
-                    id_to_remove = int(values[0])
-                    student_name_display = values[2] # Get name from selected row
-                except (IndexError, ValueError, TypeError):
-                    messagebox.showerror("Erro", "Seleção inválida ou dados da linha corrompidos."); return
+            selected = self.selected_records(self.payment_rows)
+            if selected:
+                id_to_remove = selected[0].id
+                student_name_display = selected[0].student_name # Get name from selected row
             else:
                  messagebox.showerror("Erro", "Selecione um aluno na tabela ou digite um ID válido para remover."); return
 
         if not messagebox.askyesno("Confirmar", f"Remover '{student_name_display}' (ID: {id_to_remove})?\n\nATENÇÃO: Todos os dados de pagamento E de débitos deste aluno serão REMOVIDOS permanentemente!"):
             return
 
-        conn, cursor = None, None
-        try:
-            conn, cursor = self.connect_to_db();
-            if not conn: return
-            # Deletion from student_payments will cascade to student_debtors due to FOREIGN KEY ON DELETE CASCADE
-            cursor.execute("DELETE FROM student_payments WHERE id = %s", (id_to_remove,));
-            rows_deleted = cursor.rowcount;
-            conn.commit()
-
+        def done(rows_deleted):
             if rows_deleted > 0:
                 messagebox.showinfo("Sucesso", f"Aluno '{student_name_display}' removido com sucesso.");
-                self.load_payment_data(); self.load_debtor_data(); # Refresh tables
+                self.remove_student_rows(id_to_remove) # Drop its rows from both tables
                 self.clear_payments_form(); self.clear_debtor_form() # Clear forms
             else:
                 # This case might occur if the user typed an ID that doesn't exist
                 messagebox.showerror("Erro", f"Aluno ID {id_to_remove} não encontrado no banco de dados.");
-                # Still refresh tables and clear forms in case view was stale
-                self.load_payment_data(); self.load_debtor_data();
+                # Still drop its rows and clear forms in case view was stale
+                self.remove_student_rows(id_to_remove)
                 self.clear_payments_form(); self.clear_debtor_form()
-        except Exception as e:
-            if conn: conn.rollback();
-            messagebox.showerror("Erro DB", f"Erro ao remover aluno: {e}")
-            import traceback; print(traceback.format_exc())
-        finally:
-            if conn: conn.close()
+        # Deletion from students cascades to its student_months rows (FOREIGN KEY ON DELETE CASCADE)
+        self.jobs.submit(lambda job: self.repo_for(self.payments_repo).delete_student(id_to_remove), on_done=done,
+                         on_error=lambda e: self.report_error("Erro DB", "Erro ao remover aluno", e),
+                         write=True, label="Removendo aluno...")
 
 
     def find_next_id(self):
-        conn, cursor = None, None
-        try:
-            conn, cursor = self.connect_to_db();
-            if not conn: return
-            cursor.execute("SELECT id FROM student_payments WHERE id >= 1001 ORDER BY id"); existing_ids = {row[0] for row in cursor.fetchall()};
-            next_id = 1001;
-            while next_id in existing_ids: next_id += 1
-            if next_id <= 9999: self.id_var.set(str(next_id)); messagebox.showinfo("Próximo ID", f"Próximo ID disponível: {next_id}")
+        def done(next_id):
+            if next_id is not None: self.id_var.set(str(next_id)); messagebox.showinfo("Próximo ID", f"Próximo ID disponível: {next_id}")
             else: messagebox.showinfo("Próximo ID", "Não há mais IDs disponíveis na faixa 1001-9999.")
-        except Exception as e: messagebox.showerror("Erro DB", f"Erro ao buscar próximo ID: {e}");
-        finally:
-             if conn: conn.close()
-
+        self.jobs.submit(lambda job: self.repo_for(self.payments_repo).next_free_id(1001, 9999), on_done=done,
+                         on_error=lambda e: self.report_error("Erro DB", "Erro ao buscar próximo ID", e),
+                         group='next-id', label="Buscando próximo ID...")
 
         # --- MODIFICADO para exportar com UNICODES ---
     def export_to_excel(self):
-        """Exports the current view of the Payments table WITH Unicode marks to Excel."""
-        try:
-            # Garante que a árvore de pagamentos existe
-            if not hasattr(self, 'payments_tree'):
-                messagebox.showerror("Erro", "Tabela de pagamentos não inicializada.")
-                return
-
-            # Pede ao usuário o local para salvar o arquivo Excel
-            file_path = filedialog.asksaveasfilename(
-                defaultextension=".xlsx",
-                filetypes=[("Excel files", "*.xlsx"), ("All files", "*.*")],
-                title="Salvar Planilha de Pagamentos"
-            )
-            # Se o usuário cancelar, não faz nada
-            if not file_path:
-                return
-
-            data_to_export = []
-            # Pega os nomes das colunas como definidos nos cabeçalhos da Treeview
-            columns = [self.payments_tree.heading(col)['text'] for col in self.payments_tree['columns']]
-            data_to_export.append(columns)
+        """Exports the current view of the Payments table WITH Unicode marks to Excel.
+
+        Rows are streamed from the database (same filter as the table) straight into a
+        write-only workbook, so large exports use bounded memory. With "Valores numéricos"
+        checked, amounts are numeric R$ cells coloured by status, plus one status column per month."""
+        # Garante que a árvore de pagamentos existe
+        if not hasattr(self, 'payments_tree'):
+            messagebox.showerror("Erro", "Tabela de pagamentos não inicializada.")
+            return
 
-            # Itera sobre cada linha (item) na Treeview de pagamentos
-            for item_id in self.payments_tree.get_children():
-                # Pega os valores da linha diretamente da Treeview.
-                # Estes valores já incluem as marcas ✅/❌ aplicadas por apply_existing_marks.
-                values = list(self.payments_tree.item(item_id, 'values'))
-                data_to_export.append(values)
+        # Pede ao usuário o local para salvar o arquivo Excel
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=".xlsx",
+            filetypes=[("Excel files", "*.xlsx"), ("All files", "*.*")],
+            title="Salvar Planilha de Pagamentos"
+        )
+        # Se o usuário cancelar, não faz nada
+        if not file_path:
+            return
 
-            # Verifica se há dados para exportar (além dos cabeçalhos)
-            if len(data_to_export) <= 1:
+        # Pega os nomes das colunas como definidos nos cabeçalhos da Treeview
+        columns = [self.payments_tree.heading(col)['text'] for col in self.payments_tree['columns']]
+        filter_term, total, numeric = self.payment_filter, len(self.payment_rows), self.numeric_export_var.get()
+
+        def work(job):
+            from exporter import export_rows, export_payments_numeric # openpyxl takes ~0.1 s to import: loaded on first export, not at startup
+            progress = lambda count: job.report(count, total, f"Exportando pagamentos ({count}/{total})...")
+            students = self.repo_for(self.payments_repo).iter_payments(filter_term)
+            with span("export.payments"):
+                if numeric:
+                    # Valores vindos direto do banco (Decimal), sem reinterpretar o texto da tabela
+                    return export_payments_numeric(file_path, columns, students, progress=progress)
+                # Mesmos valores da tabela, já com as marcas ✅/❌ (calculadas na mesma consulta)
+                rows = (self.payment_row_values(student) for student in students)
+                return export_rows(file_path, 'Pagamentos', columns, rows, progress=progress)
+
+        def done(exported):
+            if not exported:
                 messagebox.showinfo("Exportar", "Não há dados na tabela de pagamentos para exportar.")
                 return
-
-            # Cria o DataFrame do Pandas diretamente com os dados coletados (que incluem as marcas)
-            df = pd.DataFrame(data_to_export[1:], columns=data_to_export[0])
-
-            # --- NÃO HÁ LIMPEZA AQUI ---
-            # Os dados são mantidos como strings com as marcas Unicode.
-
-            # Usa o ExcelWriter para salvar o DataFrame no arquivo .xlsx
-            with pd.ExcelWriter(file_path, engine='openpyxl') as writer:
-                df.to_excel(writer, index=False, sheet_name='Pagamentos')
-                # Ajusta a largura das colunas na planilha para melhor visualização
-                worksheet = writer.sheets['Pagamentos']
-                for i, col in enumerate(df.columns):
-                    column_letter = chr(65 + i) # Converte índice da coluna para letra (A, B, C...)
-                    try:
-                        # Calcula o comprimento máximo do conteúdo na coluna (incluindo cabeçalho e marcas)
-                        max_len = max(df[col].astype(str).map(len).max(), len(str(col)))
-                        # Define a largura da coluna com um pequeno preenchimento extra
-                        worksheet.column_dimensions[column_letter].width = max_len + 3
-                    except Exception as width_err:
-                        # Fallback em caso de erro no cálculo da largura
-                        print(f"Aviso: Não foi possível calcular a largura da coluna {col}: {width_err}")
-                        worksheet.column_dimensions[column_letter].width = 15
-
             # Informa o usuário que a exportação foi bem-sucedida
-            messagebox.showinfo("Sucesso", f"Dados de pagamentos (com marcas) exportados para:\n{file_path}")
+            kind = "valores numéricos e status por mês" if numeric else "com marcas"
+            messagebox.showinfo("Sucesso", f"Dados de pagamentos ({kind}) exportados para:\n{file_path}")
+            self.open_exported_file(file_path)
 
-            # Tenta abrir o arquivo Excel gerado automaticamente
-            try:
-                if os.name == 'nt': # Windows
-                    os.startfile(file_path)
-                elif sys.platform == 'darwin': # MacOS
-                    os.system(f'open "{file_path}"')
-                else: # Linux
-                    os.system(f'xdg-open "{file_path}"')
-            except Exception as e:
-                # Informa se não foi possível abrir o arquivo
-                messagebox.showinfo("Arquivo Salvo", f"Não foi possível abrir o arquivo automaticamente:\n{file_path}\nErro: {e}")
+        self.jobs.submit(work, on_done=done, on_progress=self.show_job_progress,
+                         on_error=lambda e: self.report_error("Erro Exportação", "Erro ao exportar Pagamentos", e),
+                         group='export-payments', label="Exportando pagamentos...")
 
+    def open_exported_file(self, file_path):
+        """Tenta abrir o arquivo Excel gerado automaticamente."""
+        try:
+            if os.name == 'nt': # Windows
+                os.startfile(file_path)
+            elif sys.platform == 'darwin': # MacOS
+                os.system(f'open "{file_path}"')
+            else: # Linux
+                os.system(f'xdg-open "{file_path}"')
         except Exception as e:
-            # Captura e mostra qualquer erro inesperado durante a exportação
-            import traceback;
-            messagebox.showerror("Erro Exportação", f"Erro ao exportar Pagamentos:\n{str(e)}\n{traceback.format_exc()}")
+            # Informa se não foi possível abrir o arquivo
+            messagebox.showinfo("Arquivo Salvo", f"Não foi possível abrir o arquivo automaticamente:\n{file_path}\nErro: {e}")
+
+    def import_spreadsheet(self):
+        """Bulk-imports students from a .xlsx/.csv file (same columns as the payments export).
+
+        Valid rows are upserted in one transaction; rejected rows go to an errors file
+        instead of one message box per problem."""
+        if self.offline: # The import writes straight to the server; it is not journaled
+            messagebox.showinfo("Importar Planilha", "Importação indisponível no modo offline (sem conexão com o banco)."); return
+        file_path = filedialog.askopenfilename(
+            filetypes=[("Planilhas", "*.xlsx *.csv"), ("Excel files", "*.xlsx"), ("CSV files", "*.csv"), ("All files", "*.*")],
+            title="Importar Planilha de Alunos"
+        )
+        if not file_path:
+            return
+
+        def work(job):
+            return import_file(file_path, self.payments_repo,
+                               progress=lambda count: job.report(count, None, f"Importando planilha ({count} linhas lidas)..."))
+
+        def done(result):
+            self.payment_search.clear(); self.debtor_search.clear()
+            self.load_payment_data(self.payment_filter); self.load_debtor_data(self.debtor_filter)
+            summary = (f"{result.rows_read} linhas lidas:\n{result.inserted} alunos inseridos, {result.updated} atualizados, "
+                       f"{result.statuses} status de mês aplicados.")
+            if result.errors:
+                messagebox.showwarning("Importação Concluída", f"{summary}\n\n{result.errors} linhas rejeitadas (não importadas). Detalhes em:\n{result.error_file}")
+            else:
+                messagebox.showinfo("Importação Concluída", summary)
+
+        self.jobs.submit(work, on_done=done, on_progress=self.show_job_progress,
+                         on_error=lambda e: self.report_error("Erro Importação", "Erro ao importar planilha", e),
+                         write=True, label="Importando planilha...")
 
     # --- Actions (Debtors Tab - Restored/Modified) ---
     def search_debtors(self):
@@ -1133,24 +1549,21 @@ class StudentPaymentApp:
         self.debtor_status_var.set("Pendente") # Default status
         self.debtor_comment_var.set("")
         self.debtor_amount_var.set("")
-        if hasattr(self, 'debtors_tree'):
-             self.debtors_tree.selection_set(()) # Deselect any row
+        self.selected_debtor_info = None
+        if hasattr(self, 'debtor_rows'):
+             self.debtor_rows.clear_selection() # Deselect any row
 
     def update_debtor_status(self):
         """Updates status, comment, and potentially amount from the Debtors tab form."""
-        selected_items = self.debtors_tree.selection()
-        if not selected_items:
+        selected = self.selected_records(self.debtor_rows)
+        if not selected:
             messagebox.showerror("Erro", "Selecione um registro na lista de devedores para atualizar.")
             return
 
-        item = selected_items[0]
-        values = self.debtors_tree.item(item, 'values')
-        if not values or len(values) < 7:
-            messagebox.showerror("Erro", "Dados incompletos na linha de devedor selecionada."); return
-
+        id_val, month = selected[0].id, selected[0].month # Key of the selected row
+        # Version the form was filled with: the save fails with a conflict if the entry changed since
+        debt = self.selected_debtor_info if self.selected_debtor_info and (self.selected_debtor_info.id, self.selected_debtor_info.month) == (id_val, month) else selected[0]
         try:
-            id_val = int(values[0])
-            month = values[3] # Get month name from the selected row
             new_status = self.debtor_status_var.get() # Get from combobox
             new_comment = self.debtor_comment_var.get().strip() # Get from entry
             # Get amount from entry and parse it using the robust function
@@ -1167,163 +1580,434 @@ class StudentPaymentApp:
             return
 
 
-        conn, cursor = None, None
-        try:
-            conn, cursor = self.connect_to_db()
-            if not conn: return
-
-            # Update the student_debtors table
-            cursor.execute("""
-                UPDATE student_debtors
-                SET status=%s, comment=%s, amount=%s
-                WHERE id=%s AND month=%s
-            """, (new_status, new_comment, new_amount, id_val, month))
-            conn.commit()
-            messagebox.showinfo("Sucesso", f"Registro de débito para ID {id_val}, Mês {month} atualizado.")
-            # Refresh both tabs to ensure consistency
-            self.load_debtor_data()
-            self.load_payment_data() # To update marks on payments tab
-
-        except Exception as e:
-            if conn: conn.rollback()
-            messagebox.showerror("Erro de Banco de Dados", f"Erro ao atualizar registro do devedor: {e}")
-            import traceback; print(traceback.format_exc())
-        finally:
-            if conn: conn.close()
+        def submit(version):
+            def work(job):
+                # Status, comment and amount of the student-month (the amount also shows on the Pagamentos tab)
+                updated = self.repo_for(self.debtors_repo).update_debtor(id_val, month, new_status, new_comment, new_amount, version=version)
+                return updated, self.fetch_student_rows(id_val, month)
+            def done(result):
+                updated, fetched = result
+                if updated: messagebox.showinfo("Sucesso", f"Registro de débito para ID {id_val}, Mês {month} atualizado.")
+                else: messagebox.showerror("Erro", "Registro de débito não encontrado no banco (pode ter sido removido).")
+                # Patch the debtor row (dropped if now 'Pago') and the mark on the payments tab
+                self.refresh_student_rows(id_val, fetched, month)
+            self.jobs.submit(work, on_done=done, on_error=self.save_error_handler("Erro de Banco de Dados", "Erro ao atualizar registro do devedor", id_val, month, overwrite=lambda: submit(None)),
+                             write=True, label="Atualizando devedor...")
+        submit(debt.version)
 
 
     def remove_from_debtors(self):
-        """Removes a selected entry from the student_debtors list/table."""
-        selected_items = self.debtors_tree.selection()
-        if not selected_items:
+        """Removes a selected entry from the debtors list (clears the month's status)."""
+        selected = self.selected_records(self.debtor_rows)
+        if not selected:
             messagebox.showerror("Erro", "Selecione um registro na lista de devedores para remover.")
             return
-
-        item = selected_items[0]
-        values = self.debtors_tree.item(item, 'values')
-        if not values or len(values) < 4:
-             messagebox.showerror("Erro", "Dados incompletos na linha de devedor selecionada."); return
-
-        try:
-            id_val = int(values[0])
-            student_name = values[1]
-            month = values[3]
-        except (IndexError, ValueError, TypeError):
-            messagebox.showerror("Erro", "Não foi possível obter ID e Mês da linha selecionada.")
-            return
+        id_val, student_name, month, version = selected[0].id, selected[0].student_name, selected[0].month, selected[0].version
 
         if not messagebox.askyesno("Confirmar Remoção", f"Tem certeza que deseja remover o registro de débito para:\n\nAluno: {student_name} (ID: {id_val})\nMês: {month}\n\nIsso removerá a marca ❌ e o registro da lista de devedores, mas NÃO afetará o valor registrado na aba Pagamentos."):
             return
 
-        conn, cursor = None, None
-        try:
-            conn, cursor = self.connect_to_db()
-            if not conn: return
-
-            cursor.execute("DELETE FROM student_debtors WHERE id=%s AND month=%s", (id_val, month))
-            rows_deleted = cursor.rowcount
-            conn.commit()
-
+        def submit(version):
+            self.jobs.submit(lambda job: (self.repo_for(self.debtors_repo).delete_debtor(id_val, month, version=version), self.fetch_student_rows(id_val, month)),
+                             on_done=done, on_error=self.save_error_handler("Erro de Banco de Dados", "Erro ao remover registro de débito", id_val, month, overwrite=lambda: submit(None)),
+                             write=True, label="Removendo débito...")
+        def done(result):
+            rows_deleted, fetched = result
             if rows_deleted > 0:
                 messagebox.showinfo("Sucesso", f"Registro de débito para {month} removido com sucesso.")
-                self.load_debtor_data()  # Refresh this tab
-                self.load_payment_data() # Refresh payments tab to remove mark
+                self.refresh_student_rows(id_val, fetched, month) # Drop the row here and the mark on the payments tab
                 self.clear_debtor_form() # Clear form fields
             else:
                 messagebox.showerror("Erro", "Registro de débito não encontrado no banco (pode já ter sido removido).")
                 # Still refresh in case view was stale
-                self.load_debtor_data()
-                self.load_payment_data()
-
-        except Exception as e:
-            if conn: conn.rollback()
-            messagebox.showerror("Erro de Banco de Dados", f"Erro ao remover registro de débito: {e}")
-            import traceback; print(traceback.format_exc())
-        finally:
-            if conn: conn.close()
+                self.refresh_student_rows(id_val, fetched, month)
+        submit(version)
 
 
     
         # --- MODIFICADO para exportar DEVEDORES com valores formatados como texto ---
     def export_debtors_to_excel(self):
-        """Exports the current view of the Debtors table with formatted values as text to Excel."""
-        try:
-            # Garante que a árvore de devedores existe
-            if not hasattr(self, 'debtors_tree'):
-                messagebox.showerror("Erro", "Tabela de devedores não inicializada.")
-                return
+        """Exports the current view of the Debtors table with formatted values as text to Excel (streamed, see export_to_excel)."""
+        # Garante que a árvore de devedores existe
+        if not hasattr(self, 'debtors_tree'):
+            messagebox.showerror("Erro", "Tabela de devedores não inicializada.")
+            return
 
-            # Pede ao usuário o local para salvar o arquivo Excel
-            file_path = filedialog.asksaveasfilename(
-                defaultextension=".xlsx",
-                filetypes=[("Excel files", "*.xlsx"), ("All files", "*.*")],
-                title="Salvar Planilha de Devedores"
-            )
-            # Se o usuário cancelar, não faz nada
-            if not file_path:
-                return
+        # Pede ao usuário o local para salvar o arquivo Excel
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=".xlsx",
+            filetypes=[("Excel files", "*.xlsx"), ("All files", "*.*")],
+            title="Salvar Planilha de Devedores"
+        )
+        # Se o usuário cancelar, não faz nada
+        if not file_path:
+            return
 
-            data_to_export = []
-            # Pega os nomes das colunas como definidos nos cabeçalhos da Treeview
-            columns = [self.debtors_tree.heading(col)['text'] for col in self.debtors_tree['columns']]
-            data_to_export.append(columns) # Adiciona cabeçalhos
-
-            # Itera sobre cada linha (item) na Treeview de devedores
-            for item_id in self.debtors_tree.get_children():
-                # Pega os valores da linha diretamente da Treeview.
-                # Estes valores já estão formatados (Valor com vírgula, Status como texto).
-                values = list(self.debtors_tree.item(item_id, 'values'))
-                if values and len(values) == 7: # Garante que a linha tem a quantidade esperada de colunas
-                     data_to_export.append(values)
-
-            # Verifica se há dados para exportar (além dos cabeçalhos)
-            if len(data_to_export) <= 1:
+        # Pega os nomes das colunas como definidos nos cabeçalhos da Treeview
+        columns = [self.debtors_tree.heading(col)['text'] for col in self.debtors_tree['columns']]
+        filter_term, total, numeric = self.debtor_filter, len(self.debtor_rows), self.numeric_export_var.get()
+        aging, by_aging = self.debtor_aging, self.debtor_by_aging # The rows as listed
+
+        def work(job):
+            from exporter import export_rows, export_debtors_numeric # Loaded on first export (see export_to_excel)
+            progress = lambda count: job.report(count, total, f"Exportando devedores ({count}/{total})...")
+            debts = self.repo_for(self.debtors_repo).iter_open_debtors(filter_term, aging=aging, by_aging=by_aging)
+            with span("export.debtors"):
+                if numeric:
+                    # Valor como número (formato R$) e Status colorido como na tabela
+                    return export_debtors_numeric(file_path, columns, debts, progress=progress)
+                # Valores formatados como na tabela (Valor com vírgula, Status como texto)
+                rows = (self.debtor_row_values(debt)[0] for debt in debts)
+                return export_rows(file_path, 'Devedores', columns, rows, progress=progress)
+
+        def done(exported):
+            if not exported:
                  messagebox.showinfo("Exportar Devedores", "Não há dados na lista de devedores para exportar.")
                  return
-
-            # Cria o DataFrame do Pandas diretamente com os dados coletados (strings formatadas)
-            df = pd.DataFrame(data_to_export[1:], columns=data_to_export[0])
-
-            # --- REMOVIDO O BLOCO DE LIMPEZA do VALOR ---
-            # A coluna 'Valor' será exportada como texto formatado (ex: "270,18")
-            # if 'Valor' in df.columns: df['Valor'] = df['Valor'].apply(lambda x: self.parse_currency(x) if isinstance(x, str) else x) # REMOVIDO
-
-            # Usa o ExcelWriter para salvar o DataFrame no arquivo .xlsx
-            with pd.ExcelWriter(file_path, engine='openpyxl') as writer:
-                df.to_excel(writer, index=False, sheet_name='Devedores')
-                # Ajusta a largura das colunas na planilha para melhor visualização
-                worksheet = writer.sheets['Devedores']
-                for i, col in enumerate(df.columns):
-                    column_letter = chr(65 + i) # Converte índice da coluna para letra (A, B, C...)
-                    try:
-                        # Calcula o comprimento máximo do conteúdo na coluna (incluindo cabeçalho)
-                        max_len = max(df[col].astype(str).map(len).max(), len(str(col)))
-                        # Define a largura da coluna com um pequeno preenchimento extra
-                        worksheet.column_dimensions[column_letter].width = max_len + 3
-                    except Exception as width_err:
-                        # Fallback em caso de erro no cálculo da largura
-                        print(f"Aviso: Não foi possível calcular a largura da coluna {col}: {width_err}")
-                        worksheet.column_dimensions[column_letter].width = 15
-
             # Informa o usuário que a exportação foi bem-sucedida
             messagebox.showinfo("Sucesso", f"Dados de devedores exportados para:\n{file_path}")
+            self.open_exported_file(file_path)
+
+        self.jobs.submit(work, on_done=done, on_progress=self.show_job_progress,
+                         on_error=lambda e: self.report_error("Erro de Exportação", "Ocorreu um erro ao exportar devedores para Excel", e),
+                         group='export-debtors', label="Exportando devedores...")
+
+# --- Helper: Treeview Row Index ---
+class TreeRowIndex:
+    """Maps row keys to Treeview item ids, keeping keys sorted so single rows can be
+    inserted at their ordered position, patched or removed without touching the rest.
+
+    Each row also keeps the repository record it was formatted from: the tree only shows
+    display strings, and selection/marking read the numbers from the record."""
+    is_virtual = False
+
+    def __init__(self, tree, sort_key=lambda key, record: key):
+        self.tree = tree; self.sort_key = sort_key
+        self.items = {}         # key -> tree item id
+        self.records = {}       # key -> record (StudentPayment / DebtorRecord)
+        self.keys_by_item = {}  # tree item id -> key
+        self.sorted_keys = []   # sort_key(key, record) for every row, in display order
+        self.sort_keys = {}     # key -> its sort key, as inserted
+
+    def __contains__(self, key): return key in self.items
+    def __len__(self): return len(self.items)
+    def get(self, key): return self.items.get(key)
+    def record(self, key): return self.records.get(key)
+    def record_at(self, item): return self.records.get(self.keys_by_item.get(item))
+
+    def clear(self):
+        children = self.tree.get_children()
+        if children: self.tree.delete(*children)
+        self.items.clear(); self.records.clear(); self.keys_by_item.clear(); self.sorted_keys.clear(); self.sort_keys.clear()
+
+    def append(self, key, values, tags=(), record=None):
+        """Bulk-load path: rows must arrive already in sort order."""
+        sk = self.sort_key(key, record)
+        self.items[key] = item = self.tree.insert('', 'end', values=values, tags=tags)
+        self.records[key] = record; self.keys_by_item[item] = key
+        self.sorted_keys.append(sk); self.sort_keys[key] = sk
+
+    def upsert(self, key, values, tags=(), record=None):
+        sk = self.sort_key(key, record)
+        item = self.items.get(key)
+        if item is not None:
+            if self.sort_keys[key] == sk:
+                self.records[key] = record
+                self.tree.item(item, values=values, tags=tags); return item
+            self.remove(key) # Moved (e.g. a new due date while ordered by it)
+        self.records[key] = record
+        pos = bisect_left(self.sorted_keys, sk)
+        self.items[key] = item = self.tree.insert('', pos, values=values, tags=tags)
+        self.keys_by_item[item] = key
+        self.sorted_keys.insert(pos, sk); self.sort_keys[key] = sk
+        return item
+
+    def remove(self, key):
+        item = self.items.pop(key, None)
+        if item is None: return False
+        self.records.pop(key, None); self.keys_by_item.pop(item, None)
+        sk = self.sort_keys.pop(key); pos = bisect_left(self.sorted_keys, sk)
+        if pos < len(self.sorted_keys) and self.sorted_keys[pos] == sk: del self.sorted_keys[pos]
+        try: self.tree.delete(item)
+        except tk.TclError: pass
+        return True
 
-            # Tenta abrir o arquivo Excel gerado automaticamente
-            try:
-                if os.name == 'nt': # Windows
-                    os.startfile(file_path)
-                elif sys.platform == 'darwin': # MacOS
-                    os.system(f'open "{file_path}"')
-                else: # Linux
-                    os.system(f'xdg-open "{file_path}"')
-            except Exception as e:
-                # Informa se não foi possível abrir o arquivo
-                messagebox.showinfo("Arquivo Salvo", f"Não foi possível abrir o arquivo automaticamente:\n{file_path}\nErro: {e}")
+    def keys_for(self, first_component):
+        """Keys whose first component is first_component (e.g. every month of one student).
+        A scan: in due-date order a student's rows are not adjacent."""
+        return [key for key in self.items if key[0] == first_component]
+
+    def clear_selection(self):
+        self.tree.selection_set(())
+
+
+# --- Helper: Virtual (Paged) Treeview ---
+class VirtualTreeGrid:
+    """Virtual-scrolling mode for a Treeview: only the rows that fit on screen exist as tree
+    items. Rows are fetched in pages as the user scrolls (keyset pagination when moving
+    forward, OFFSET only for jumps) and the most recently used pages are cached.
+
+    Exposes the same upsert/remove/keys_for/clear interface as TreeRowIndex so the
+    incremental update code does not care which mode a tab is in.
+
+    With a JobRunner, missing pages and recounts are fetched in background jobs: the
+    window shows placeholder rows until they arrive, and a newer scroll position
+    supersedes a fetch that is still running."""
+    is_virtual = True
+    PLACEHOLDER = ("…",)
+
+    def __init__(self, tree, scrollbar, page_size=200, max_cached_pages=20, jobs=None, group=None, sort_key=None):
+        self.tree = tree; self.scrollbar = scrollbar; self.sort_key = sort_key # sort_key(key, record), as in TreeRowIndex
+        self.page_size = page_size; self.max_cached_pages = max_cached_pages
+        self.jobs = jobs; self.group = group or f"grid-{id(self)}"
+        self.generation = 0         # bumped on load/clear/invalidate; results of older fetches are dropped
+        self.page_job = None; self.pending_pages = set()
+        self.fetch_page = None; self.count_rows = None; self.format_row = None
+        self.total = 0; self.offset = 0
+        self.pages = OrderedDict()  # page number -> [(key, values, tags, record), ...] (LRU order)
+        self.cached_pos = {}        # key -> (page number, index in page)
+        self.items = {}             # key -> tree item, only for the rows currently on screen
+        self.keys_by_item = {}
+        self.selected_key = None
+        self.attached = False
+
+    def __contains__(self, key): return key in self.cached_pos
+    def __len__(self): return self.total
+    def get(self, key): return self.items.get(key)
+
+    def record(self, key):
+        """Record of a row in the cached pages (None if its page was evicted or not fetched yet)."""
+        position = self.cached_pos.get(key)
+        if position is None: return None
+        page_no, index = position
+        return self.pages[page_no][index][3]
+
+    def record_at(self, item):
+        key = self.keys_by_item.get(item)
+        return None if key is None else self.record(key)
+
+    # --- Mode switching ---
+    def attach(self):
+        """Takes over the vertical scrollbar, mouse wheel and paging keys of the tree."""
+        if self.attached: return
+        self.attached = True
+        self.tree.configure(yscrollcommand='')
+        self.scrollbar.configure(command=self.on_scrollbar)
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"): self.tree.bind(sequence, self.on_mousewheel)
+        self.tree.bind("<Up>", lambda e: self.on_arrow(-1)); self.tree.bind("<Down>", lambda e: self.on_arrow(1))
+        self.tree.bind("<Prior>", lambda e: self.scroll_by(-self.visible_rows()) or "break")
+        self.tree.bind("<Next>", lambda e: self.scroll_by(self.visible_rows()) or "break")
+        self.tree.bind("<Configure>", lambda e: self.render())
+        self._select_binding = self.tree.bind("<<TreeviewSelect>>", self.on_select, add='+')
+
+    def detach(self):
+        """Gives scrolling back to the Treeview (full materialization mode)."""
+        if not self.attached: return
+        self.attached = False
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>", "<Up>", "<Down>", "<Prior>", "<Next>", "<Configure>"):
+            self.tree.unbind(sequence)
+        # Drop only our <<TreeviewSelect>> handler, keeping the application's one
+        script = self.tree.bind("<<TreeviewSelect>>")
+        self.tree.bind("<<TreeviewSelect>>", "\n".join(line for line in script.splitlines() if self._select_binding not in line))
+        self.tree.deletecommand(self._select_binding)
+        self.scrollbar.configure(command=self.tree.yview)
+        self.tree.configure(yscrollcommand=self.scrollbar.set)
+
+    # --- Data ---
+    def load(self, fetch_page, count_rows, format_row, first_records=(), total=None):
+        """fetch_page(offset, limit, after_key) -> records; format_row(record) -> (key, values, tags).
+
+        Both may be called from a worker thread, so they must not touch Tk."""
+        self.clear()
+        self.fetch_page, self.count_rows, self.format_row = fetch_page, count_rows, format_row
+        self.total = count_rows() if total is None else total
+        # Seed the cache with the complete pages we already have
+        rows = [(*format_row(record), record) for record in first_records]
+        for page_no in range(len(rows) // self.page_size):
+            self._store_page(page_no, rows[page_no * self.page_size:(page_no + 1) * self.page_size])
+        self.render()
+
+    def clear(self):
+        children = self.tree.get_children()
+        if children: self.tree.delete(*children)
+        self.pages.clear(); self.cached_pos.clear(); self.items.clear(); self.keys_by_item.clear()
+        self.total = 0; self.offset = 0; self.selected_key = None
+        self.generation += 1; self.page_job = None; self.pending_pages = set()
+
+    def invalidate(self):
+        """Row set changed (insert/delete): drop cached pages, recount and re-render the current window."""
+        if self.count_rows is None: return
+        self.generation += 1; self.page_job = None; self.pending_pages = set()
+        if self.jobs is None:
+            self.pages.clear(); self.cached_pos.clear()
+            self.total = self.count_rows(); self.render(); return
+        generation = self.generation
+        def recounted(total):
+            if generation != self.generation: return
+            self.pages.clear(); self.cached_pos.clear()
+            self.total = total; self.render()
+        self.jobs.submit(lambda job: self.count_rows(), on_done=recounted, on_error=lambda e: logger.error("Error recounting grid rows: %s", e),
+                         group=f"{self.group}-count", label="Atualizando tabela...")
+
+    def _store_page(self, page_no, rows):
+        self.pages[page_no] = rows
+        for index, row in enumerate(rows): self.cached_pos[row[0]] = (page_no, index)
+        while len(self.pages) > self.max_cached_pages:
+            old_no, old_rows = self.pages.popitem(last=False)
+            for key, *_row in old_rows:
+                if self.cached_pos.get(key, (None,))[0] == old_no: del self.cached_pos[key]
+
+    def _fetch_rows(self, page_nos, after_key, job=None):
+        """Fetches consecutive pages; keyset pagination continues from after_key when it is known."""
+        fetched = []
+        for page_no in page_nos:
+            if job is not None: job.check()
+            rows = [(*self.format_row(record), record) for record in self.fetch_page(page_no * self.page_size, self.page_size, after_key)]
+            fetched.append((page_no, rows))
+            after_key = rows[-1][0] if len(rows) == self.page_size else None
+        return fetched
+
+    def _request_pages(self, page_nos, after_key):
+        """Fetches missing pages in a background job and re-renders when they arrive."""
+        if self.page_job is not None and not self.page_job.cancelled and set(page_nos) <= self.pending_pages:
+            return # Already on its way
+        generation = self.generation
+        def fetched(pages):
+            if generation != self.generation: return
+            if self.page_job is job: self.page_job = None; self.pending_pages = set()
+            for page_no, rows in pages: self._store_page(page_no, rows)
+            self.render()
+        job = self.jobs.submit(lambda job: self._fetch_rows(page_nos, after_key, job), on_done=fetched,
+                               on_error=lambda e: logger.error("Error fetching grid rows: %s", e),
+                               group=self.group, label="Carregando linhas...")
+        self.page_job = job; self.pending_pages = set(page_nos)
+
+    def rows_between(self, start, end):
+        """Rows in [start, end); None for rows whose page is still being fetched."""
+        rows = []
+        if end <= start: return rows
+        page_nos = range(start // self.page_size, (end - 1) // self.page_size + 1)
+        missing = [page_no for page_no in page_nos if page_no not in self.pages]
+        if missing:
+            previous = self.pages.get(missing[0] - 1)
+            after_key = previous[-1][0] if previous and len(previous) == self.page_size else None
+            if self.jobs is None:
+                for page_no, page in self._fetch_rows(missing, after_key): self._store_page(page_no, page)
+            else:
+                self._request_pages(missing, after_key)
+        for page_no in page_nos:
+            page_start = page_no * self.page_size
+            low, high = max(0, start - page_start), min(self.page_size, max(0, end - page_start))
+            page = self.pages.get(page_no)
+            if page is None:
+                rows.extend([None] * (high - low)); continue
+            self.pages.move_to_end(page_no)
+            rows.extend(page[low:high])
+        return rows
+
+    # --- Rendering & scrolling ---
+    def visible_rows(self):
+        children = self.tree.get_children()
+        bbox = self.tree.bbox(children[0]) if children else None
+        height = self.tree.winfo_height()
+        if not bbox or height <= 1: return max(1, int(self.tree.cget('height')))
+        _x, y, _w, row_height = bbox
+        return max(1, (height - y) // max(1, row_height))
+
+    def render(self):
+        if self.fetch_page is None: return
+        visible = self.visible_rows()
+        self.offset = max(0, min(self.offset, self.total - visible))
+        rows = self.rows_between(self.offset, min(self.total, self.offset + visible))
+        children = self.tree.get_children()
+        if children: self.tree.delete(*children)
+        self.items.clear(); self.keys_by_item.clear()
+        for row in rows:
+            if row is None:
+                self.tree.insert('', 'end', values=self.PLACEHOLDER); continue
+            key, values, tags, _record = row
+            item = self.tree.insert('', 'end', values=values, tags=tags)
+            self.items[key] = item; self.keys_by_item[item] = key
+        if self.selected_key in self.items:
+            self.tree.selection_set(self.items[self.selected_key])
+        if self.total:
+            self.scrollbar.set(self.offset / self.total, min(1.0, (self.offset + len(rows)) / self.total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
 
-        except Exception as e:
-            # Captura e mostra qualquer erro inesperado durante a exportação
-            import traceback
-            messagebox.showerror("Erro de Exportação", f"Ocorreu um erro ao exportar devedores para Excel:\n{str(e)}\n\n{traceback.format_exc()}")   
+    def scroll_to(self, offset):
+        offset = max(0, min(int(offset), self.total - self.visible_rows()))
+        if offset != self.offset:
+            self.offset = offset; self.render()
+
+    def scroll_by(self, delta):
+        self.scroll_to(self.offset + delta)
+
+    def on_scrollbar(self, *args):
+        if args[0] == 'moveto': self.scroll_to(float(args[1]) * self.total)
+        elif args[0] == 'scroll':
+            step = self.visible_rows() if args[2] == 'pages' else 1
+            self.scroll_by(int(args[1]) * step)
+
+    def on_mousewheel(self, event):
+        if sys.platform == "win32": delta = int(-1 * (event.delta / 120))
+        elif sys.platform == "darwin": delta = int(-1 * event.delta)
+        else: delta = -1 if event.num == 4 else 1
+        self.scroll_by(delta * 3)
+        return "break" # Don't let the canvas scroll too
+
+    def on_arrow(self, direction):
+        """Arrow keys at the first/last visible row scroll the window by one row."""
+        children = self.tree.get_children()
+        if not children: return "break"
+        edge = children[-1] if direction > 0 else children[0]
+        if self.tree.focus() != edge: return None # Let the Treeview move inside the window
+        self.scroll_by(direction)
+        children = self.tree.get_children()
+        target = children[-1] if direction > 0 else children[0]
+        self.tree.focus(target); self.tree.selection_set(target)
+        return "break"
+
+    # --- Selection ---
+    def on_select(self, event=None):
+        selection = self.tree.selection()
+        if selection and selection[0] in self.keys_by_item: self.selected_key = self.keys_by_item[selection[0]]
+
+    def is_reselection(self, selection):
+        """True for selection events caused by re-rendering (scrolled out, or the same row restored)
+        and for clicks on placeholder rows that are still loading."""
+        if not selection: return self.selected_key is not None
+        if selection[0] not in self.keys_by_item: return True
+        return self.keys_by_item[selection[0]] == self.selected_key
+
+    def clear_selection(self):
+        self.selected_key = None
+        self.tree.selection_set(())
+
+    # --- Incremental updates (same interface as TreeRowIndex) ---
+    def append(self, key, values, tags=(), record=None):
+        """Rows come from load(); a row added later lands at its position in the query order."""
+        return self.upsert(key, values, tags, record)
+
+    def upsert(self, key, values, tags=(), record=None):
+        position = self.cached_pos.get(key)
+        if position is None:
+            self.invalidate(); return self.items.get(key) # New row (or outside the cache): positions shift
+        page_no, index = position
+        if self.sort_key is not None and self.sort_key(key, self.pages[page_no][index][3]) != self.sort_key(key, record):
+            self.invalidate(); return self.items.get(key) # Moved (e.g. a new due date while ordered by it): the window is stale
+        self.pages[page_no][index] = (key, values, tags, record)
+        item = self.items.get(key)
+        if item is not None: self.tree.item(item, values=values, tags=tags)
+        return item
+
+    def remove(self, key):
+        if self.selected_key == key: self.selected_key = None
+        self.invalidate()
+        return True
+
+    def keys_for(self, first_component):
+        return [key for key in self.cached_pos if isinstance(key, tuple) and key[0] == first_component]
 
 
 # --- Helper Dialog Class (Unchanged) ---
@@ -1359,22 +2043,40 @@ class StatusChoiceDialog(simpledialog.Dialog):
 
 # --- Application Exit ---
 def close_app(root_window, app_instance):
-    if messagebox.askyesno("Sair","Tem certeza que deseja sair?"):
+    queue = getattr(app_instance, 'offline_queue', None)
+    pending = f"\n\n{len(queue)} alterações feitas offline ainda não foram enviadas ao servidor. Elas ficam guardadas neste computador e serão enviadas quando o aplicativo se conectar novamente." if queue else ""
+    if messagebox.askyesno("Sair", "Tem certeza que deseja sair?" + pending):
         # Explicitly unbind mousewheel events to prevent errors after destroy
         if hasattr(app_instance, 'canvas'):
              app_instance._bind_mousewheel(False) # Unbind
 
-        if hasattr(app_instance,'conn') and app_instance.conn and not app_instance.conn.closed:
-            try: app_instance.conn.close(); print("DB connection closed.")
-            except Exception as e: print(f"Error closing DB: {e}")
+        if getattr(app_instance, 'change_listener', None) is not None:
+            app_instance.change_listener.stop(); app_instance.change_listener = None
+
+        # Interrupt running loads/exports; pending writes are allowed to finish
+        if hasattr(app_instance, 'jobs'):
+            try: app_instance.jobs.shutdown(wait=True)
+            except Exception as e: logger.error("Error stopping background jobs: %s", e)
+
+        try:
+            pool_summary = close_pool()
+            if pool_summary: logger.info("%s", pool_summary); logger.info("DB connection pool closed.")
+        except Exception as e: logger.error("Error closing DB pool: %s", e)
+
+        # PAGAMENTOS_TRACE=<file>: the whole session's trace is written on exit
+        trace_path = os.environ.get("PAGAMENTOS_TRACE")
+        if trace_path and recorder.tracing:
+            try: logger.info("Trace: %d events written to %s", recorder.dump_trace(trace_path), trace_path)
+            except OSError as e: logger.error("Error writing trace file: %s", e)
         root_window.destroy()
 
 # --- Main Execution ---
 if __name__ == "__main__":
+    configure_logging()
     root = tk.Tk()
     style = ttk.Style(root)
     try: style.theme_use('clam') # Or 'vista', 'xpnative', 'aqua' depending on OS
-    except tk.TclError: print("Clam theme not available, using default.")
+    except tk.TclError: logger.info("Clam theme not available, using default.")
 
     # Apply theme before creating app instance
     root.update_idletasks()
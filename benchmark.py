@@ -0,0 +1,366 @@
+"""Headless benchmark for the repository layer.
+
+Seeds a throw-away schema with N synthetic students (plus debtor entries) and
+drives the same ``PaymentsRepository``/``DebtorsRepository`` methods the GUI
+uses, reporting per-operation latency percentiles. No display is required.
+
+Uso:
+    python benchmark.py --students 10000 --iterations 200
+    python benchmark.py --students 100000 --schema pagamentos_bench --keep
+    python benchmark.py --students 20000 --years 5                   # com histórico de 4 anos
+    python benchmark.py --students 10000 --money                     # formatação de valores, sem banco
+    python benchmark.py --students 100000 --skip-seed --only busca   # só as buscas
+    python benchmark.py --students 100000 --skip-seed --export       # exportação Excel
+    python benchmark.py --students 20000 --startup                   # importação, verificação do schema e primeira tela
+"""
+import argparse
+import datetime
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from decimal import Decimal
+
+from psycopg2.extras import execute_values
+
+from database import DB_CONFIG, ConnectionPool, create_year_partition, setup_schema
+from instrumentation import percentile
+from local_cache import LocalCache
+from money import format_brl
+from repository import MONTH_CODES, MONTH_NAMES, PAYMENT_COLUMNS, DebtorsRepository, PaymentsRepository, StudentPayment, SyncRepository
+
+FIRST_NAMES = ["Ana", "Bruno", "Carla", "Diego", "Eduarda", "Felipe", "Gabriela", "Heitor", "Isis", "João",
+               "Larissa", "Marcos", "Natália", "Otávio", "Paula", "Rafael", "Sofia", "Tiago", "Vitória", "Pedro"]
+LAST_NAMES = ["Silva", "Souza", "Oliveira", "Santos", "Pereira", "Lima", "Carvalho", "Ferreira", "Rocha", "Almeida",
+              "Gomes", "Martins", "Araújo", "Barbosa", "Ribeiro", "Costa", "Pinheiro", "Aires", "Faleiro", "Thomaz"]
+COURSES = ["TQI", "SB", "FLY1", "FLY2", "TO1", "TO2", "KIDS", "TEENS", "ADV", "CONV"]
+FIRST_ID = 1001
+
+
+def make_pool(schema, maxconn=4):
+    """Pool whose connections only see ``schema`` (created on demand), so real data is never touched."""
+    bootstrap = ConnectionPool(minconn=0, maxconn=1, **DB_CONFIG)
+    with bootstrap.connection() as conn, conn.cursor() as cur:
+        cur.execute(f'CREATE SCHEMA IF NOT EXISTS "{schema}"')
+    bootstrap.closeall()
+    # public stays on the path so extensions installed there (pg_trgm operator classes) resolve
+    return ConnectionPool(minconn=1, maxconn=maxconn, options=f"-c search_path={schema},public", **DB_CONFIG)
+
+
+def seed(pool, students, debtor_ratio=0.15, rng=None, year=None, years=1):
+    """Replaces the schema's data with ``students`` synthetic rows for ``year`` (default: the current one)
+    and the ``years - 1`` before it (history partitions); ~debtor_ratio of student-months get a status.
+    Returns (students, student-months with a status)."""
+    rng = rng or random.Random(42)
+    year = year or datetime.date.today().year
+    seeded_years = range(year - years + 1, year + 1)
+    student_rows, month_rows, debtors = [], [], 0
+    for offset in range(students):
+        student_id = FIRST_ID + offset
+        name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {rng.choice(LAST_NAMES)}"
+        base = Decimal(rng.randrange(15000, 45000)) / 100
+        student_rows.append((student_id, rng.choice((5, 10, 15, 20, 25)), name, rng.choice(COURSES), Decimal("0.00")))
+        for seeded_year in seeded_years:
+            for month in range(1, 13):
+                if rng.random() <= 0.1:
+                    continue  # no amount that month
+                status = None
+                if rng.random() < debtor_ratio:
+                    status = rng.choice(("Pago", "Pago", "Pendente", "Em Negociação")); debtors += 1
+                month_rows.append((student_id, seeded_year, month, base, status, ""))
+
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("TRUNCATE students CASCADE")
+        for seeded_year in seeded_years:
+            create_year_partition(cur, seeded_year)
+        execute_values(cur, "INSERT INTO students (id, payment_day, student_name, course, discount) VALUES %s", student_rows, page_size=5000)
+        execute_values(cur, "INSERT INTO student_months (student_id, year, month, amount, status, comment) VALUES %s",
+                       month_rows, page_size=5000)
+        cur.execute("ANALYZE students")
+        cur.execute("ANALYZE student_months")
+    return len(student_rows), debtors
+
+
+def run_benchmarks(pool, students, iterations, rng=None, only=None):
+    """Times each repository operation ``iterations`` times; returns {operation: [seconds, ...]}.
+
+    ``only`` restricts the run to operations whose name contains that text.
+    """
+    rng = rng or random.Random(7)
+    payments, debtors = PaymentsRepository(pool), DebtorsRepository(pool)
+    cache = LocalCache(payments.year, repo=SyncRepository(pool))  # memory only; the first sync is the full read
+    last_id = FIRST_ID + students - 1
+    scratch_id = last_id + 1  # never seeded, used for add/delete round-trips
+
+    def random_id():
+        return rng.randint(FIRST_ID, last_id)
+
+    def random_month():
+        return rng.choice(MONTH_CODES)
+
+    def update_student():
+        student = payments.get_student(random_id())
+        payments.update_student(student._replace(course=rng.choice(COURSES)))
+
+    def update_student_checked():
+        # As the GUI saves a form: checked against the record it was filled from, one month changed
+        student = payments.get_student(random_id())
+        months = list(student.months); months[rng.randrange(12)] = Decimal(rng.choice(("100.00", "250.00", "0.00")))
+        payments.update_student(student._replace(course=rng.choice(COURSES), months=tuple(months)), expected=student)
+
+    def add_and_delete():
+        payments.add_student(StudentPayment(scratch_id, 10, "Aluno Benchmark", "TQI", Decimal("0.00"), (Decimal("100.00"),) * 12))
+        payments.delete_student(scratch_id)
+
+    def page_walk():
+        # Same access pattern as the virtual grid scrolling forward: one OFFSET jump, then keyset pages
+        offset = rng.randrange(0, max(1, students - 1000))
+        page = payments.list_payments_page(limit=200, offset=offset)
+        for _ in range(4):
+            page = payments.list_payments_page(limit=200, after_id=page[-1].id) if page else page
+
+    def upsert_status():
+        student_id, code = random_id(), random_month()
+        debtors.upsert_debtor_status(student_id, MONTH_NAMES[code], Decimal("100.00"), rng.choice(("Pago", "Pendente")))
+
+    # Full-table reads are much slower; run them fewer times so large seeds finish in reasonable time
+    full_scan_iterations = max(3, iterations // 20)
+    operations = [
+        ("list_payments (todos, com marcas)", lambda: payments.list_payments(), full_scan_iterations),
+        ("list_open_debtors (todos)", lambda: debtors.list_open_debtors(), full_scan_iterations),
+        ("list_payments (busca nome)", lambda: payments.list_payments(rng.choice(LAST_NAMES).lower()[:4]), iterations),
+        ("list_payments (busca sem acento)", lambda: payments.list_payments(rng.choice(("joao", "natalia", "araujo", "vitoria"))), iterations),
+        ("list_payments (busca rara)", lambda: payments.list_payments(f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {rng.choice(LAST_NAMES)}"), iterations),
+        ("list_payments_page (5 páginas)", page_walk, iterations),
+        ("count_payments", lambda: payments.count_payments(), iterations),
+        ("list_payments (busca id)", lambda: payments.list_payments(str(random_id())), iterations),
+        ("list_open_debtors (busca nome)", lambda: debtors.list_open_debtors(rng.choice(FIRST_NAMES)[:3]), iterations),
+        ("devedores por atraso (90+)", lambda: debtors.list_open_debtors_page(limit=FIRST_LOAD_ROWS, aging="90+", by_aging=True), iterations),
+        ("count_open_debtors (31–60)", lambda: debtors.count_open_debtors(aging="31–60"), iterations),
+        ("devedores por atraso (cache local)", lambda: (cache.sync(), cache.list_open_debtors_page(limit=FIRST_LOAD_ROWS, aging="90+", by_aging=True)), iterations),
+        ("Mostrar Todos (Postgres)", lambda: payments.list_payments_page(limit=FIRST_LOAD_ROWS), iterations),
+        ("Mostrar Todos (cache local)", lambda: (cache.sync(), cache.list_payments_page(limit=FIRST_LOAD_ROWS)), iterations),
+        ("busca nome (cache local)", lambda: (cache.sync(), cache.list_payments(rng.choice(LAST_NAMES).lower()[:4])), iterations),
+        ("LocalCache.sync (sem alterações)", cache.sync, iterations),
+        ("get_month_amount", lambda: payments.get_month_amount(random_id(), random_month()), iterations),
+        ("exists", lambda: payments.exists(random_id()), iterations),
+        ("next_free_id", lambda: payments.next_free_id(FIRST_ID, FIRST_ID + students + 10), iterations),
+        ("upsert_debtor_status", upsert_status, iterations),
+        ("mark_month (200 selecionados)", lambda: debtors.mark_month(random_month(), rng.choice(("Pago", "Pendente")),
+                                                                     student_ids=rng.sample(range(FIRST_ID, last_id + 1), min(200, students))), iterations),
+        ("mark_month (todos)", lambda: debtors.mark_month(random_month(), rng.choice(("Pago", "Pendente"))), full_scan_iterations),
+        ("update_debtor", lambda: debtors.update_debtor(random_id(), MONTH_NAMES[random_month()], "Pendente", "bench", Decimal("1.00")), iterations),
+        ("update_student", update_student, iterations),
+        ("update_student (versionado)", update_student_checked, iterations),
+        ("add_student + delete_student", add_and_delete, iterations),
+    ]
+
+    results = {}
+    for name, operation, count in operations:
+        if only and only not in name:
+            continue
+        operation()  # warm-up (plans, caches)
+        samples = []
+        for _ in range(count):
+            started = time.perf_counter()
+            operation()
+            samples.append(time.perf_counter() - started)
+        results[name] = samples
+    return results
+
+
+def run_export_benchmark(pool, trace_memory=False):
+    """Streams the whole payments grid into a temporary .xlsx; returns (rows, seconds, peak MiB, file MiB).
+
+    With ``trace_memory`` the peak is what tracemalloc sees allocated during the export
+    (tracing makes the export several times slower); otherwise peak MiB is None.
+    """
+    from exporter import export_rows
+    payments = PaymentsRepository(pool)
+    headers = list(PAYMENT_COLUMNS) + [f"{code}_status" for code in MONTH_CODES]
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        if trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        rows = ((*student[:5], *student.months, *student.statuses) for student in payments.iter_payments())
+        count = export_rows(path, "Pagamentos", headers, rows)
+        elapsed = time.perf_counter() - started
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+        return count, elapsed, peak, os.path.getsize(path) / 2**20
+    finally:
+        os.remove(path)
+
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+FIRST_LOAD_ROWS = 2001  # the GUI's first query: VIRTUAL_GRID_THRESHOLD + 1 rows
+# Runs the desktop app in a fresh interpreter and prints, in seconds since start, when the
+# modules were imported, when the window was mapped and when the first payment rows were in the tree
+_FIRST_PAINT_PROBE = """
+import json, time
+started = time.perf_counter()
+import tkinter as tk
+import Sistema_de_pagamentos_escola_de_idioma as gui
+marks = {"import": time.perf_counter() - started}
+root = tk.Tk()
+root.bind("<Map>", lambda event: marks.setdefault("window", time.perf_counter() - started) if event.widget is root else None)
+app = gui.StudentPaymentApp(root)
+def poll():
+    if len(app.payment_rows) and "window" in marks or time.perf_counter() - started > 60:
+        marks["data"] = time.perf_counter() - started
+        if app.change_listener is not None: app.change_listener.stop()
+        app.jobs.shutdown(); root.destroy(); return
+    root.after(5, poll)
+root.after(0, poll)
+root.mainloop()
+print(json.dumps(marks))
+"""
+
+
+def _run_python(code, env=None):
+    """Runs ``code`` in a new interpreter (cold imports) from the app directory; returns its stdout."""
+    result = subprocess.run([sys.executable, "-c", code], cwd=APP_DIR, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f"exit {result.returncode}")
+    return result.stdout
+
+
+def run_startup_benchmark(pool, schema, runs=5):
+    """Cold-start costs of the desktop app and the CLI. Returns (results for format_report, note).
+
+    Module imports are timed in a fresh interpreter per run. The schema check at launch is
+    compared with the full setup_schema it replaces, then the first grid query. Window and
+    first-data times need a display; without one they are skipped and ``note`` says so.
+    """
+    import json
+    results = {}
+    for module in ("Sistema_de_pagamentos_escola_de_idioma", "cli"):
+        code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+        results[f"import {module[:28]}"] = [float(_run_python(code).split()[-1]) for _ in range(runs)]
+    for name, force in (("verificação do schema (início)", False), ("setup_schema completo", True)):
+        samples = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            setup_schema(pool, force=force)
+            samples.append(time.perf_counter() - started)
+        results[name] = samples
+    payments = PaymentsRepository(pool)
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        payments.list_payments_page(limit=FIRST_LOAD_ROWS)
+        samples.append(time.perf_counter() - started)
+    results["primeira consulta da grade"] = samples
+    env = dict(os.environ, PGOPTIONS=f"-c search_path={schema},public")
+    try:
+        marks = [json.loads(_run_python(_FIRST_PAINT_PROBE, env=env).splitlines()[-1]) for _ in range(runs)]
+    except RuntimeError as e:
+        return results, f"Janela/primeiros dados não medidos ({e})"
+    results["janela exibida (processo novo)"] = [m["window"] for m in marks]
+    results["primeiros dados na tabela"] = [m["data"] for m in marks]
+    return results, None
+
+
+def _float_format(value):
+    """The grid's formatting before money.py: every cell through float."""
+    if value is None: return "0,00"
+    return f"{float(value):.2f}".replace('.', ',')
+
+
+def run_money_benchmark(students, refreshes=5, rng=None):
+    """Formats a synthetic payments grid (discount + 12 months per student) ``refreshes`` times with
+    the float path, the uncached Decimal formatter and the cached ``format_brl``.
+
+    Returns ({path: cells per second}, float drift of the grid total in R$). No database needed.
+    """
+    rng = rng or random.Random(42)
+    cells = []
+    for _ in range(students):
+        base = Decimal(rng.randrange(15000, 45000)) / 100
+        cells.append(Decimal("0.00"))
+        cells.extend(base if rng.random() > 0.1 else Decimal("0.00") for _ in range(12))
+    paths = {"float (anterior)": _float_format, "Decimal sem cache": format_brl.__wrapped__, "Decimal com cache": format_brl}
+    format_brl.cache_clear()
+    throughput = {}
+    for name, formatter in paths.items():
+        started = time.perf_counter()
+        for _ in range(refreshes):
+            for value in cells:
+                formatter(value)
+        throughput[name] = len(cells) * refreshes / (time.perf_counter() - started)
+    float_total = 0.0
+    for value in cells:
+        float_total += float(value)
+    return throughput, abs(Decimal(repr(float_total)) - sum(cells))
+
+
+def format_report(results):
+    header = f"{'operação':<36} {'n':>5} {'média':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'máx':>9}  (ms)"
+    lines = [header, "-" * len(header)]
+    for name, samples in results.items():
+        ms = [s * 1000 for s in samples]
+        lines.append(f"{name:<36} {len(ms):>5} {statistics.fmean(ms):>9.2f} {percentile(ms, 50):>9.2f} "
+                     f"{percentile(ms, 95):>9.2f} {percentile(ms, 99):>9.2f} {max(ms):>9.2f}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark headless da camada de dados (repository.py).")
+    parser.add_argument("--students", type=int, default=10000, help="quantidade de alunos sintéticos (padrão: 10000)")
+    parser.add_argument("--iterations", type=int, default=200, help="repetições por operação (padrão: 200)")
+    parser.add_argument("--schema", default="pagamentos_bench", help="schema isolado usado pelo benchmark")
+    parser.add_argument("--years", type=int, default=1, help="anos semeados, o atual e os anteriores (padrão: 1)")
+    parser.add_argument("--skip-seed", action="store_true", help="reaproveita os dados já semeados no schema")
+    parser.add_argument("--keep", action="store_true", help="não remove o schema ao final")
+    parser.add_argument("--only", help="roda só as operações cujo nome contém este texto (ex.: busca)")
+    parser.add_argument("--export", action="store_true", help="mede a exportação Excel em streaming da tabela inteira (em vez das operações)")
+    parser.add_argument("--money", action="store_true", help="mede só a formatação de valores (float x Decimal com cache), sem banco")
+    parser.add_argument("--export-memory", action="store_true", help="com --export, mede o pico de memória (tracemalloc, mais lento)")
+    parser.add_argument("--startup", action="store_true", help="mede a partida do aplicativo: importações, verificação do schema, primeira consulta e, com display, a primeira tela")
+    parser.add_argument("--runs", type=int, default=5, help="repetições de cada medida com --startup (padrão: 5)")
+    args = parser.parse_args(argv)
+
+    if args.money:
+        throughput, drift = run_money_benchmark(args.students)
+        for name, cells_per_second in throughput.items():
+            print(f"{name:<20} {cells_per_second / 1e6:>6.2f} milhões de células/s")
+        print(f"Diferença do total somado em float: R$ {drift:f}")
+        return
+
+    pool = make_pool(args.schema)
+    try:
+        trigram = setup_schema(pool)
+        print("Índices de busca por nome: " + ("trigram (pg_trgm)" if trigram else "indisponíveis (pg_trgm ausente), busca sem índice"))
+        if not args.skip_seed:
+            started = time.perf_counter()
+            n_students, n_debtors = seed(pool, args.students, years=args.years)
+            print(f"Semeados {n_students} alunos e {n_debtors} registros de débito em {time.perf_counter() - started:.1f}s")
+        if args.startup:
+            results, note = run_startup_benchmark(pool, args.schema, runs=args.runs)
+            print(format_report(results))
+            if note: print(note)
+        elif not args.export:
+            print(format_report(run_benchmarks(pool, args.students, args.iterations, only=args.only)))
+        else:
+            count, elapsed, peak, size = run_export_benchmark(pool, trace_memory=args.export_memory)
+            memory = f", pico de memória Python {peak:.1f} MiB" if peak is not None else ""
+            print(f"Exportação Excel (streaming): {count} linhas em {elapsed:.1f}s ({count / elapsed:.0f} linhas/s){memory}, "
+                  f"arquivo {size:.1f} MiB")
+        print(pool.format_stats())
+        if not args.keep:
+            with pool.connection() as conn, conn.cursor() as cur:
+                cur.execute(f'DROP SCHEMA "{args.schema}" CASCADE')
+    finally:
+        pool.closeall()
+
+
+if __name__ == "__main__":
+    main()
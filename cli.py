@@ -0,0 +1,246 @@
+"""Command-line interface for reports and batch jobs (no Tkinter, no display needed).
+
+Uses the same repository / importer / exporter code paths as the GUI, so a
+nightly export from cron produces the same files as the buttons. openpyxl is
+only imported by the commands that write or read .xlsx files.
+
+Uso:
+    python cli.py export-debtors --formato xlsx --saida devedores.xlsx
+    python cli.py export-debtors --saida atrasados.csv --atraso 90+ --por-atraso
+    python cli.py export-payments --formato csv --saida pagamentos.csv --ano 2025
+    python cli.py import alunos.xlsx --erros erros.csv
+    python cli.py mark-month mar Pago --ids 1001,1002
+    python cli.py summary --por curso
+    python cli.py setup-schema
+
+Exit codes: 0 success; 1 error (nothing written, or the import was rolled back);
+2 invalid arguments; 3 import done but some rows were rejected.
+"""
+import argparse
+import csv
+import datetime
+import os
+import sys
+import tempfile
+
+import psycopg2
+
+from database import PoolError, close_pool, ensure_year_partition, get_pool, setup_schema
+from importer import HEADER_ALIASES, STATUS_BY_FOLDED, ImportFormatError, import_file
+from money import format_brl
+from repository import (AGING_RANGES, MONTH_CODES, MONTH_NAMES, DebtorsRepository, PaymentsRepository, SummaryRepository, fold_name,
+                        format_overdue)
+
+# Same headings as the tables of the GUI (and the columns importer.py expects back)
+MONTH_HEADINGS = ("JAN", "FEV", "MAR", "ABR", "MAI", "JUN", "JUL", "AGO", "SET", "OUT", "NOV", "DEZ")
+PAYMENT_HEADERS = ("ID", "Dia", "Aluno", "Curso", "Desc.") + MONTH_HEADINGS
+DEBTOR_HEADERS = ("ID", "Aluno", "Curso", "Mês", "Valor", "Status", "Atraso (dias)", "Comentário")
+SUMMARY_HEADERS = ("Faturado", "Recebido", "Em Aberto", "Pendências")
+
+EXIT_OK, EXIT_ERROR, EXIT_USAGE, EXIT_REJECTED_ROWS = 0, 1, 2, 3
+
+
+def _progress(label):
+    """Progress lines on stderr when it is a terminal (cron logs stay quiet)."""
+    if not sys.stderr.isatty():
+        return None
+    return lambda count: print(f"  {count} {label}...", file=sys.stderr, flush=True)
+
+
+def _write_csv(file_path, headers, rows):
+    """';'-separated UTF-8 CSV with BRL amounts, as Excel in pt-BR opens it. Returns the row count.
+
+    Rows go to a temp file next to file_path that replaces it only after the last row: a failed
+    export (database error halfway through the rows) leaves no partial file and an old one intact.
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    count = 0
+    try:
+        with os.fdopen(fd, "w", newline="", encoding="utf-8-sig") as f:
+            writer = csv.writer(f, delimiter=";")
+            writer.writerow(headers)
+            for row in rows:
+                writer.writerow(row); count += 1
+        umask = os.umask(0); os.umask(umask)
+        os.chmod(temp_path, 0o666 & ~umask)  # mkstemp creates it 0600; give it the mode open() would
+        os.replace(temp_path, file_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return count
+
+
+# --- Commands (each returns an exit code) ---
+def export_payments(args):
+    students = PaymentsRepository(year=args.ano).iter_payments(args.busca)
+    if args.formato == "xlsx":
+        from exporter import export_payments_numeric
+        count = export_payments_numeric(args.saida, PAYMENT_HEADERS, students, progress=_progress("alunos exportados"))
+    else:
+        # Amounts and "Status <mês>" columns: the layout importer.py reads back
+        headers = PAYMENT_HEADERS + tuple(f"Status {month}" for month in MONTH_HEADINGS)
+        count = _write_csv(args.saida, headers, (
+            (s.id, s.payment_day, s.student_name, s.course, format_brl(s.discount))
+            + tuple(format_brl(amount) for amount in s.months)
+            + tuple(status if amount else "" for amount, status in zip(s.months, s.statuses))
+            for s in students))
+    print(f"{count} alunos exportados para {args.saida}" if count else "Nenhum aluno para exportar.")
+    return EXIT_OK
+
+
+def export_debtors(args):
+    debts = DebtorsRepository(year=args.ano).iter_open_debtors(args.busca, aging=args.atraso, by_aging=args.por_atraso, reference=args.data)
+    if args.formato == "xlsx":
+        from exporter import export_debtors_numeric
+        count = export_debtors_numeric(args.saida, DEBTOR_HEADERS, debts, progress=_progress("débitos exportados"), reference=args.data)
+    else:
+        count = _write_csv(args.saida, DEBTOR_HEADERS, (
+            (d.id, d.student_name, d.course, d.month, format_brl(d.amount), d.status, format_overdue(d.due, args.data), d.comment)
+            for d in debts))
+    print(f"{count} débitos em aberto exportados para {args.saida}" if count else "Nenhum débito em aberto para exportar.")
+    return EXIT_OK
+
+
+def import_students(args):
+    ensure_year_partition(get_pool(), args.ano)
+    result = import_file(args.file, payments_repo=PaymentsRepository(year=args.ano), error_path=args.erros,
+                         progress=_progress("linhas lidas"))
+    print(f"{result.rows_read} linhas lidas: {result.inserted} alunos inseridos, {result.updated} atualizados, "
+          f"{result.statuses} status de mês aplicados.")
+    if result.errors:
+        print(f"{result.errors} linhas rejeitadas; detalhes em {result.error_file}")
+        return EXIT_REJECTED_ROWS
+    return EXIT_OK
+
+
+def mark_month(args):
+    count = DebtorsRepository(year=args.ano).mark_month(args.month, args.status, student_ids=args.ids, filter_term=args.busca)
+    print(f"{MONTH_NAMES[args.month]} de {args.ano}: {count} alunos marcados como '{args.status}'.")
+    return EXIT_OK
+
+
+def summary(args):
+    repo = SummaryRepository(year=args.ano)
+    rows = (repo.by_course() if args.por == "curso" else repo.by_month()) + [repo.total()]
+    values = [(row.label, format_brl(row.billed), format_brl(row.received), format_brl(row.outstanding), str(row.open_count))
+              for row in rows]
+    headers = ("Curso" if args.por == "curso" else "Mês",) + SUMMARY_HEADERS
+    if args.csv:
+        writer = csv.writer(sys.stdout, delimiter=";", lineterminator="\n")
+        writer.writerow(headers); writer.writerows(values)
+        return EXIT_OK
+    widths = [max(len(str(cell)) for cell in column) for column in zip(headers, *values)]
+    print(f"Resumo de {args.ano}")
+    for line in [headers] + values:
+        print("  ".join(cell.ljust(width) if i == 0 else cell.rjust(width) for i, (cell, width) in enumerate(zip(line, widths))))
+    return EXIT_OK
+
+
+def check_schema(args):
+    # Full run: the app itself only checks the version at launch (see database.setup_schema)
+    trigram = setup_schema(get_pool(), force=True)
+    ensure_year_partition(get_pool(), args.ano)
+    print(f"Tabelas verificadas (partição de {args.ano} pronta); busca por nome " + ("com índice trigram." if trigram else "sem índice (pg_trgm indisponível)."))
+    return EXIT_OK
+
+
+# --- Argument parsing ---
+def _month_code(text):
+    """'mar', 'Março', 'marco' or '3' -> 'mar'."""
+    if text.isascii() and text.isdigit() and 1 <= int(text) <= 12:
+        return MONTH_CODES[int(text) - 1]
+    code = HEADER_ALIASES.get(fold_name(text).strip())
+    if code not in MONTH_CODES:
+        raise argparse.ArgumentTypeError(f"mês inválido: {text!r} (ex.: jan, fev, março ou 3)")
+    return code
+
+
+def _status(text):
+    status = STATUS_BY_FOLDED.get(fold_name(text).strip())
+    if status is None:
+        raise argparse.ArgumentTypeError(f"status inválido: {text!r} (use {', '.join(STATUS_BY_FOLDED.values())})")
+    return status
+
+
+def _id_list(text):
+    try:
+        return [int(part) for part in text.split(",") if part.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"lista de IDs inválida: {text!r} (ex.: 1001,1002)") from None
+
+
+def _aging(text):
+    """'0-30', '0–30', '90+' or 'a vencer' -> the AGING_RANGES label."""
+    key = lambda label: fold_name(label).strip().replace("–", "-").replace(" ", "-")
+    labels = {key(label): label for label in AGING_RANGES}
+    label = labels.get(key(text))
+    if label is None:
+        raise argparse.ArgumentTypeError(f"faixa de atraso inválida: {text!r} (use {', '.join(labels)})")
+    return label
+
+
+def _date(text):
+    try:
+        return datetime.date.fromisoformat(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"data inválida: {text!r} (use AAAA-MM-DD)") from None
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cli.py", description="Relatórios e tarefas em lote do sistema de pagamentos (sem interface gráfica).")
+    commands = parser.add_subparsers(dest="command", required=True, metavar="comando")
+    year = argparse.ArgumentParser(add_help=False)
+    year.add_argument("--ano", type=int, default=datetime.date.today().year, help="ano dos dados (padrão: o atual)")
+
+    for name, function, what in (("export-payments", export_payments, "os pagamentos"), ("export-debtors", export_debtors, "os débitos em aberto")):
+        command = commands.add_parser(name, parents=[year], help=f"exporta {what} para .xlsx ou .csv")
+        command.add_argument("--saida", "--out", required=True, help="arquivo a gerar")
+        command.add_argument("--formato", "--format", choices=("xlsx", "csv"), help="padrão: pela extensão da saída")
+        command.add_argument("--busca", help="exporta só os alunos que correspondem à busca (nome ou ID), como na tela")
+        if name == "export-debtors":
+            command.add_argument("--atraso", type=_aging, help="só a faixa de atraso: a-vencer, 0-30, 31-60, 61-90 ou 90+")
+            command.add_argument("--por-atraso", action="store_true", help="ordena pelo vencimento (mais atrasados primeiro) em vez do ID")
+            command.add_argument("--data", type=_date, help="data de referência do atraso, AAAA-MM-DD (padrão: hoje)")
+        command.set_defaults(function=function)
+
+    command = commands.add_parser("import", parents=[year], help="importa alunos e pagamentos de uma planilha (.xlsx ou .csv)")
+    command.add_argument("file", help="planilha a importar")
+    command.add_argument("--erros", help="arquivo CSV para as linhas rejeitadas (padrão: <arquivo>_erros.csv)")
+    command.set_defaults(function=import_students)
+
+    command = commands.add_parser("mark-month", parents=[year], help="marca um mês como Pago/Pendente/Em Negociação para vários alunos")
+    command.add_argument("month", type=_month_code, help="mês (jan, fev, março, 3...)")
+    command.add_argument("status", type=_status, help="Pago, Pendente ou 'Em Negociação'")
+    targets = command.add_mutually_exclusive_group()
+    targets.add_argument("--ids", type=_id_list, help="IDs separados por vírgula (padrão: todos os alunos)")
+    targets.add_argument("--busca", help="alunos que correspondem à busca (nome ou ID)")
+    command.set_defaults(function=mark_month)
+
+    command = commands.add_parser("summary", parents=[year], help="mostra os totais do ano (faturado, recebido, em aberto)")
+    command.add_argument("--por", choices=("mes", "curso"), default="mes", help="quebra por mês (padrão) ou por curso")
+    command.add_argument("--csv", action="store_true", help="saída em CSV (;) em vez de tabela")
+    command.set_defaults(function=summary)
+
+    command = commands.add_parser("setup-schema", parents=[year], help="cria/migra as tabelas e refaz os índices (ex.: após instalar o pg_trgm)")
+    command.set_defaults(function=check_schema)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if getattr(args, "saida", None) and args.formato is None:
+        args.formato = "csv" if os.path.splitext(args.saida)[1].lower() in (".csv", ".txt") else "xlsx"
+    try:
+        return args.function(args)
+    except (ImportFormatError, OSError) as e:
+        print(f"Erro: {e}", file=sys.stderr)
+    except (psycopg2.Error, PoolError) as e:
+        print(f"Erro de banco de dados: {str(e).strip()}", file=sys.stderr)
+    finally:
+        close_pool()
+    return EXIT_ERROR
+
+
+if __name__ == "__main__":
+    sys.exit(main())
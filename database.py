@@ -0,0 +1,688 @@
+"""Shared PostgreSQL connection pool used by every data-access path of the app.
+
+Opening a new ``psycopg2.connect`` per operation costs a TCP + auth handshake
+each time. The pool keeps a bounded set of connections open, health-checks
+idle ones before handing them out, transparently reconnects broken ones and
+keeps counters (hits, misses, wait times) so we can see how it behaves.
+"""
+import datetime
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import psycopg2
+
+logger = logging.getLogger("pagamentos.database")
+
+# Identifies this process's connections (application_name), so change notifications
+# caused by our own writes can be told apart from other clients' (see notifications.py)
+CLIENT_ID = f"pagamentos-{uuid.uuid4().hex[:12]}"
+
+# VERIFIQUE ESTAS CREDENCIAIS (podem ser sobrescritas por variáveis de ambiente)
+DB_CONFIG = {
+    "host": os.environ.get("PAGAMENTOS_DB_HOST", "localhost"),
+    "database": os.environ.get("PAGAMENTOS_DB_NAME", "postgres"),
+    "user": os.environ.get("PAGAMENTOS_DB_USER", "postgres"),
+    "password": os.environ.get("PAGAMENTOS_DB_PASSWORD", "123"),
+    "client_encoding": "utf8",
+    "application_name": CLIENT_ID,
+    # An unreachable server fails fast instead of after the OS TCP timeout (the app then works offline)
+    "connect_timeout": int(os.environ.get("PAGAMENTOS_DB_CONNECT_TIMEOUT", "5")),
+}
+
+
+class PoolError(Exception):
+    """Raised when no connection can be obtained from the pool."""
+
+
+def is_connection_error(error):
+    """True if ``error`` means the server could not be reached (or the connection dropped),
+    as opposed to an error in the statement itself or a cancelled query."""
+    if isinstance(error, psycopg2.InterfaceError):
+        return True
+    if isinstance(error, psycopg2.OperationalError):
+        # Connection failures carry no SQLSTATE; class 08 and the shutdown codes come from the server
+        return error.pgcode is None or error.pgcode.startswith("08") or error.pgcode in ("57P01", "57P02", "57P03")
+    return False
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of psycopg2 connections with health checks."""
+
+    def __init__(self, minconn=1, maxconn=5, timeout=10.0, health_check_interval=30.0, **conn_kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Pool requires 0 <= minconn <= maxconn and maxconn >= 1")
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.conn_kwargs = conn_kwargs or dict(DB_CONFIG)
+
+        self._lock = threading.Condition()
+        self._idle = []          # list of (conn, last_used_monotonic)
+        self._in_use = {}        # id(conn) -> (conn, ident of the thread that checked it out)
+        self._size = 0           # open connections (idle + in use)
+        self._closed = False
+        self._stats = {
+            "checkouts": 0, "hits": 0, "misses": 0, "waits": 0,
+            "wait_time_total": 0.0, "wait_time_max": 0.0, "timeouts": 0,
+            "health_checks": 0, "health_check_failures": 0, "reconnects": 0, "discarded": 0,
+        }
+
+        for _ in range(minconn):
+            conn = self._connect()
+            with self._lock:
+                self._size += 1
+                self._idle.append((conn, time.monotonic()))
+
+    # --- Internals ---
+    def _connect(self):
+        return psycopg2.connect(**self.conn_kwargs)
+
+    def _is_healthy(self, conn, last_used):
+        """Cheap check for recently used connections, SELECT 1 for stale ones."""
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        with self._lock:
+            self._stats["health_checks"] += 1
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            if not conn.closed:
+                conn.close()
+        except psycopg2.Error:
+            pass
+
+    # --- Public API ---
+    def getconn(self):
+        """Check out a connection, waiting up to ``timeout`` seconds if all are busy."""
+        started = time.monotonic()
+        waited = False
+        with self._lock:
+            while True:
+                if self._closed:
+                    raise PoolError("Connection pool is closed")
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    conn, last_used = None, None
+                    self._size += 1  # reserve the slot before connecting outside the lock
+                    break
+                remaining = self.timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolError(f"Timed out after {self.timeout:.1f}s waiting for a database connection")
+                waited = True
+                self._lock.wait(remaining)
+
+            wait_time = time.monotonic() - started
+            self._stats["checkouts"] += 1
+            if waited:
+                self._stats["waits"] += 1
+                self._stats["wait_time_total"] += wait_time
+                self._stats["wait_time_max"] = max(self._stats["wait_time_max"], wait_time)
+
+        if conn is not None:
+            if self._is_healthy(conn, last_used):
+                with self._lock:
+                    self._stats["hits"] += 1
+                    self._in_use[id(conn)] = (conn, threading.get_ident())
+                return conn
+            # Stale/broken connection: replace it, keeping the reserved slot
+            self._close_quietly(conn)
+            with self._lock:
+                self._stats["health_check_failures"] += 1
+                self._stats["reconnects"] += 1
+
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._lock:
+                self._size -= 1
+                self._lock.notify()
+            raise
+        with self._lock:
+            self._stats["misses"] += 1
+            self._in_use[id(conn)] = (conn, threading.get_ident())
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """Return a connection to the pool; broken or discarded ones are closed."""
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        with self._lock:
+            self._in_use.pop(id(conn), None)
+            if discard or conn.closed or self._closed:
+                self._size -= 1
+                self._stats["discarded"] += 1
+                self._close_quietly(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._lock.notify()
+
+    @contextmanager
+    def connection(self):
+        """Context manager: commits on success, rolls back on error, always returns the connection."""
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+            conn.commit()
+        except psycopg2.extensions.QueryCanceledError:
+            # Interrupted on purpose (see cancel_queries); the connection itself is fine
+            if not conn.closed:
+                conn.rollback()
+            raise
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True  # connection is likely dead; next checkout reconnects
+            raise
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def cancel_queries(self, thread_ident):
+        """Ask the server to cancel whatever the connections held by ``thread_ident`` are running.
+
+        The interrupted statement raises ``QueryCanceledError`` in that thread.
+        """
+        with self._lock:
+            targets = [conn for conn, owner in self._in_use.values() if owner == thread_ident]
+        for conn in targets:
+            try:
+                conn.cancel()
+            except psycopg2.Error:
+                pass
+        return len(targets)
+
+    def stats(self):
+        """Snapshot of pool counters, including derived hit rate and average wait."""
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["size"] = self._size
+            snapshot["idle"] = len(self._idle)
+            snapshot["in_use"] = len(self._in_use)
+            snapshot["maxconn"] = self.maxconn
+        checkouts = snapshot["checkouts"]
+        snapshot["hit_rate"] = snapshot["hits"] / checkouts if checkouts else 0.0
+        snapshot["wait_time_avg"] = snapshot["wait_time_total"] / snapshot["waits"] if snapshot["waits"] else 0.0
+        return snapshot
+
+    def format_stats(self):
+        s = self.stats()
+        return (f"Pool: {s['size']}/{s['maxconn']} conexões ({s['in_use']} em uso, {s['idle']} livres) | "
+                f"checkouts={s['checkouts']} hit_rate={s['hit_rate']:.1%} reconexões={s['reconnects']} | "
+                f"esperas={s['waits']} média={s['wait_time_avg'] * 1000:.1f}ms máx={s['wait_time_max'] * 1000:.1f}ms")
+
+    def closeall(self):
+        with self._lock:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._close_quietly(conn)
+                self._size -= 1
+            self._idle.clear()
+            self._lock.notify_all()
+
+
+# --- Shared pool for the whole process ---
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide pool, creating it on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool._closed:
+            _pool = ConnectionPool(
+                minconn=int(os.environ.get("PAGAMENTOS_DB_POOL_MIN", "1")),
+                maxconn=int(os.environ.get("PAGAMENTOS_DB_POOL_MAX", "5")),
+                **DB_CONFIG,
+            )
+        return _pool
+
+
+def close_pool():
+    """Close the shared pool (if any) and return its final stats summary."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            return None
+        summary = _pool.format_stats()
+        _pool.closeall()
+        _pool = None
+        return summary
+
+
+# --- Schema ---
+# Case/accent folding used by the name search ("José" matches "jose"). Plain SQL instead of the
+# unaccent extension so it is always available and IMMUTABLE (indexable);
+# repository.fold_name is the Python mirror.
+ACCENTED_CHARS = "áàâãäåéèêëíìîïóòôõöúùûüýÿçñ"
+PLAIN_CHARS = "aaaaaaeeeeiiiiooooouuuuyycn"
+
+# Version 1 was the original layout (student_payments with jan..dec columns, student_debtors
+# keyed by month name); it had no schema_version table. Version 2 normalized it into students +
+# student_months. Version 3 partitions student_months by year; version 4 adds month_summary;
+# version 5 adds the change notifications; version 6 the row versions; version 7 the change log;
+# version 8 the due_date function (debt aging).
+SCHEMA_VERSION = 8
+SCHEMA_LOCK_KEY = 0x70616773  # pg_advisory_xact_lock key: one app instance migrates at a time
+
+LEGACY_MONTH_NAMES = ("Janeiro", "Fevereiro", "Março", "Abril", "Maio", "Junho",
+                      "Julho", "Agosto", "Setembro", "Outubro", "Novembro", "Dezembro")
+
+SCHEMA_STATEMENTS = (
+    "CREATE TABLE IF NOT EXISTS schema_version (version INT NOT NULL)",
+    """
+    CREATE TABLE IF NOT EXISTS students (
+        id INT PRIMARY KEY, payment_day INT, student_name VARCHAR(50) NOT NULL DEFAULT '',
+        course VARCHAR(15) NOT NULL DEFAULT '', discount DECIMAL(10,2) NOT NULL DEFAULT 0
+    )""",
+    f"""
+    CREATE OR REPLACE FUNCTION fold_name(text) RETURNS text
+        LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE
+        AS $$ SELECT translate(lower($1), '{ACCENTED_CHARS}', '{PLAIN_CHARS}') $$""",
+    # Due date of a student-month: its payment_day, or the month's last day for a day the month
+    # lacks (31 in April), or the 1st without one. repository.due_date is the Python mirror.
+    """
+    CREATE OR REPLACE FUNCTION due_date(year INT, month INT, payment_day INT) RETURNS date
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE
+        AS $$ SELECT make_date($1, $2, LEAST(GREATEST(COALESCE($3, 1), 1),
+                                             EXTRACT(DAY FROM make_date($1, $2, 1) + interval '1 month - 1 day')::int)) $$""",
+)
+
+# One row per student-month with a non-zero amount (months without a row are 0,00);
+# status NULL = no mark, otherwise 'Pago', 'Pendente' or 'Em Negociação'. One partition
+# per year (see create_year_partition): queries for a year only touch that year's partition,
+# and its indexes stay the size of one year however much history accumulates.
+MONTHS_TABLE_STATEMENTS = (
+    """
+    CREATE TABLE IF NOT EXISTS student_months (
+        student_id INT NOT NULL REFERENCES students(id) ON DELETE CASCADE,
+        year SMALLINT NOT NULL, month SMALLINT NOT NULL CHECK (month BETWEEN 1 AND 12),
+        amount DECIMAL(10,2) NOT NULL DEFAULT 0, status VARCHAR(20), comment TEXT NOT NULL DEFAULT '',
+        PRIMARY KEY (student_id, year, month)
+    ) PARTITION BY LIST (year)""",
+    # The Devedores tab: open debts of a year in (student, month) order, read straight from this index
+    """
+    CREATE INDEX IF NOT EXISTS student_months_open_idx ON student_months (year, student_id, month)
+        WHERE status IN ('Pendente', 'Em Negociação')""",
+    # Month-range queries across students ("everything due in March-May")
+    "CREATE INDEX IF NOT EXISTS student_months_period_idx ON student_months (year, month, status)",
+)
+
+# Version 2 -> 3: the plain student_months table (and its index names) are moved aside, the
+# partitioned table is created in its place and the rows are copied year by year.
+UNPARTITIONED_RENAME_STATEMENTS = (
+    "ALTER TABLE student_months RENAME TO student_months_unpartitioned",
+    "ALTER INDEX student_months_pkey RENAME TO student_months_unpartitioned_pkey",
+    "ALTER INDEX IF EXISTS student_months_open_idx RENAME TO student_months_unpartitioned_open_idx",
+    "ALTER INDEX IF EXISTS student_months_period_idx RENAME TO student_months_unpartitioned_period_idx",
+)
+UNPARTITIONED_COPY_STATEMENTS = (
+    """
+    INSERT INTO student_months (student_id, year, month, amount, status, comment)
+    SELECT student_id, year, month, amount, status, comment FROM student_months_unpartitioned""",
+    "DROP TABLE student_months_unpartitioned",
+)
+
+# Totals per (year, month, course), kept current by triggers on student_months (statement-level,
+# so a bulk import or a batch status change applies one aggregated delta per statement) and on
+# students (course changes and deletions). The summary panel reads this table instead of
+# aggregating student_months: at most 12 rows per course and year.
+SUMMARY_TABLE_STATEMENTS = (
+    """
+    CREATE TABLE IF NOT EXISTS month_summary (
+        year SMALLINT NOT NULL, month SMALLINT NOT NULL, course VARCHAR(15) NOT NULL,
+        billed DECIMAL(12,2) NOT NULL DEFAULT 0,       -- every amount of the month
+        received DECIMAL(12,2) NOT NULL DEFAULT 0,     -- status 'Pago'
+        outstanding DECIMAL(12,2) NOT NULL DEFAULT 0,  -- status 'Pendente' or 'Em Negociação'
+        open_count INT NOT NULL DEFAULT 0,             -- student-months outstanding
+        PRIMARY KEY (year, month, course)
+    )""",
+)
+_SUMMARY_UPSERT = """
+        INSERT INTO month_summary AS t (year, month, course, billed, received, outstanding, open_count)
+        SELECT d.year, d.month, {course}, SUM(d.sign * d.amount),
+               COALESCE(SUM(d.sign * d.amount) FILTER (WHERE d.status = 'Pago'), 0),
+               COALESCE(SUM(d.sign * d.amount) FILTER (WHERE d.status IN ('Pendente', 'Em Negociação')), 0),
+               COALESCE(SUM(d.sign) FILTER (WHERE d.status IN ('Pendente', 'Em Negociação')), 0)
+        FROM {source} GROUP BY 1, 2, 3
+        ON CONFLICT (year, month, course) DO UPDATE SET
+            billed = t.billed + EXCLUDED.billed, received = t.received + EXCLUDED.received,
+            outstanding = t.outstanding + EXCLUDED.outstanding, open_count = t.open_count + EXCLUDED.open_count"""
+SUMMARY_TRIGGER_STATEMENTS = (
+    """
+    CREATE OR REPLACE FUNCTION month_summary_clear() RETURNS trigger LANGUAGE plpgsql AS $fn$
+    BEGIN
+        DELETE FROM month_summary;
+        RETURN NULL;
+    END $fn$""",
+    # student_months changes: +new rows -old rows, priced at the student's course. Rows deleted by the
+    # cascade of a student deletion find no student and are skipped (students_summary_delete did them).
+    f"""
+    CREATE OR REPLACE FUNCTION month_summary_sync() RETURNS trigger LANGUAGE plpgsql AS $fn$
+    DECLARE
+        rows text := CASE TG_OP
+            WHEN 'INSERT' THEN 'SELECT 1 AS sign, * FROM new_rows'
+            WHEN 'DELETE' THEN 'SELECT -1 AS sign, * FROM old_rows'
+            ELSE 'SELECT 1 AS sign, * FROM new_rows UNION ALL SELECT -1, * FROM old_rows' END;
+    BEGIN
+        EXECUTE format($q${_SUMMARY_UPSERT.format(course="s.course", source="(%s) d JOIN students s ON s.id = d.student_id")}$q$, rows);
+        RETURN NULL;
+    END $fn$""",
+    # A student's months moved between courses (sign -1 under the old course, +1 under the new)
+    f"""
+    CREATE OR REPLACE FUNCTION month_summary_student(p_id INT, p_course TEXT, p_sign INT) RETURNS void LANGUAGE sql AS $fn$
+    {_SUMMARY_UPSERT.format(course="p_course", source="(SELECT p_sign AS sign, m.* FROM student_months m WHERE m.student_id = p_id) d")}
+    $fn$""",
+    """
+    CREATE OR REPLACE FUNCTION students_summary_sync() RETURNS trigger LANGUAGE plpgsql AS $fn$
+    BEGIN
+        PERFORM month_summary_student(OLD.id, OLD.course, -1);
+        IF TG_OP = 'UPDATE' THEN
+            PERFORM month_summary_student(NEW.id, NEW.course, 1);
+            RETURN NEW;
+        END IF;
+        RETURN OLD;
+    END $fn$""",
+    "DROP TRIGGER IF EXISTS month_summary_insert ON student_months",
+    "CREATE TRIGGER month_summary_insert AFTER INSERT ON student_months REFERENCING NEW TABLE AS new_rows "
+    "FOR EACH STATEMENT EXECUTE FUNCTION month_summary_sync()",
+    "DROP TRIGGER IF EXISTS month_summary_update ON student_months",
+    "CREATE TRIGGER month_summary_update AFTER UPDATE ON student_months REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows "
+    "FOR EACH STATEMENT EXECUTE FUNCTION month_summary_sync()",
+    "DROP TRIGGER IF EXISTS month_summary_delete ON student_months",
+    "CREATE TRIGGER month_summary_delete AFTER DELETE ON student_months REFERENCING OLD TABLE AS old_rows "
+    "FOR EACH STATEMENT EXECUTE FUNCTION month_summary_sync()",
+    "DROP TRIGGER IF EXISTS month_summary_truncate ON student_months",
+    "CREATE TRIGGER month_summary_truncate AFTER TRUNCATE ON student_months "
+    "FOR EACH STATEMENT EXECUTE FUNCTION month_summary_clear()",
+    "DROP TRIGGER IF EXISTS students_summary_course ON students",
+    "CREATE TRIGGER students_summary_course BEFORE UPDATE OF course ON students "
+    "FOR EACH ROW WHEN (OLD.course IS DISTINCT FROM NEW.course) EXECUTE FUNCTION students_summary_sync()",
+    "DROP TRIGGER IF EXISTS students_summary_delete ON students",
+    "CREATE TRIGGER students_summary_delete BEFORE DELETE ON students FOR EACH ROW EXECUTE FUNCTION students_summary_sync()",
+)
+# Every statement that changes students or student_months sends one notification on
+# CHANGES_CHANNEL: {"origin": application_name of the writer, "schema": schema of the tables,
+# "ids": [student ids] or null (too many to list, or TRUNCATE: reload everything),
+# "years": [years touched] ([] = all)}.
+# NOTIFY is transactional: listeners only hear about committed changes.
+# The same trigger records the (student, year) pairs in change_log (see CHANGE_LOG_STATEMENTS).
+CHANGES_CHANNEL = "pagamentos_changes"
+NOTIFY_MAX_IDS = 500  # keeps the payload well under Postgres' 8000-byte limit
+NOTIFY_TRIGGER_STATEMENTS = (
+    f"""
+    CREATE OR REPLACE FUNCTION notify_changes() RETURNS trigger LANGUAGE plpgsql AS $fn$
+    DECLARE
+        id_column text := CASE TG_TABLE_NAME WHEN 'students' THEN 'id' ELSE 'student_id' END;
+        year_column text := CASE TG_TABLE_NAME WHEN 'students' THEN 'NULL::smallint' ELSE 'year' END;
+        rows text := CASE TG_OP
+            WHEN 'INSERT' THEN 'SELECT * FROM new_rows'
+            WHEN 'DELETE' THEN 'SELECT * FROM old_rows'
+            ELSE 'SELECT * FROM new_rows UNION ALL SELECT * FROM old_rows' END;
+        ids int[];
+        years int[];
+    BEGIN
+        IF TG_OP <> 'TRUNCATE' THEN
+            EXECUTE format('SELECT array_agg(DISTINCT %I), array_agg(DISTINCT %s) FROM (%s) r', id_column, year_column, rows)
+                INTO ids, years;
+            IF ids IS NULL THEN
+                RETURN NULL;  -- the statement changed no rows
+            END IF;
+            EXECUTE format('INSERT INTO change_log (student_id, year) SELECT DISTINCT %I, %s FROM (%s) r', id_column, year_column, rows);
+        ELSE
+            INSERT INTO change_log (student_id, year) VALUES (NULL, NULL);
+        END IF;
+        PERFORM pg_notify('{CHANGES_CHANNEL}', json_build_object(
+            'origin', current_setting('application_name'),
+            'schema', TG_TABLE_SCHEMA,
+            'ids', CASE WHEN cardinality(ids) <= {NOTIFY_MAX_IDS} THEN ids END,
+            'years', COALESCE(array_remove(years, NULL), '{{}}'))::text);
+        RETURN NULL;
+    END $fn$""",
+) + tuple(
+    statement
+    for table in ("students", "student_months")
+    for event, referencing in (("INSERT", "NEW TABLE AS new_rows"), ("UPDATE", "OLD TABLE AS old_rows NEW TABLE AS new_rows"),
+                               ("DELETE", "OLD TABLE AS old_rows"), ("TRUNCATE", None))
+    for statement in (
+        f"DROP TRIGGER IF EXISTS {table}_notify_{event.lower()} ON {table}",
+        f"CREATE TRIGGER {table}_notify_{event.lower()} AFTER {event} ON {table} "
+        + (f"REFERENCING {referencing} " if referencing else "") + "FOR EACH STATEMENT EXECUTE FUNCTION notify_changes()",
+    )
+)
+
+# Row versions for optimistic concurrency: every insert or update of a students or student_months
+# row gives it a new value from one sequence, so a client can tell whether a row it read has
+# changed since (a deleted and re-inserted row never gets its old version back). The trigger
+# catches every writer, not just the repository.
+ROW_VERSION_STATEMENTS = (
+    "CREATE SEQUENCE IF NOT EXISTS row_version_seq",
+    "ALTER TABLE students ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT nextval('row_version_seq')",
+    "ALTER TABLE student_months ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT nextval('row_version_seq')",
+    """
+    CREATE OR REPLACE FUNCTION bump_row_version() RETURNS trigger LANGUAGE plpgsql AS $fn$
+    BEGIN
+        NEW.version := nextval('row_version_seq');
+        RETURN NEW;
+    END $fn$""",
+) + tuple(
+    statement
+    for table in ("students", "student_months")
+    for statement in (
+        f"DROP TRIGGER IF EXISTS {table}_version ON {table}",
+        f"CREATE TRIGGER {table}_version BEFORE UPDATE ON {table} FOR EACH ROW EXECUTE FUNCTION bump_row_version()",
+    )
+)
+
+# Change log for local replicas (local_cache.py): which students (and years) each transaction
+# changed, under its transaction id. A replica remembers the oldest transaction still running
+# when it last read (its sync point) and later re-reads only the students logged at or after
+# it. Entries older than CHANGE_LOG_RETENTION_DAYS are pruned (prune_change_log);
+# change_log_horizon records how far back the log still reaches.
+CHANGE_LOG_RETENTION_DAYS = 30
+CHANGE_LOG_STATEMENTS = (
+    """
+    CREATE TABLE IF NOT EXISTS change_log (
+        xact BIGINT NOT NULL DEFAULT txid_current(),
+        student_id INT,   -- NULL: every student (TRUNCATE)
+        year SMALLINT,    -- NULL: the students row, i.e. every year
+        changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )""",
+    "CREATE INDEX IF NOT EXISTS change_log_xact_idx ON change_log (xact)",
+    "CREATE INDEX IF NOT EXISTS change_log_changed_at_idx ON change_log (changed_at)",
+    "CREATE TABLE IF NOT EXISTS change_log_horizon (pruned_before BIGINT NOT NULL)",
+    # Changes made before the log existed were never recorded
+    "INSERT INTO change_log_horizon SELECT txid_current() WHERE NOT EXISTS (SELECT 1 FROM change_log_horizon)",
+)
+
+# Recomputes month_summary from scratch (schema upgrade; also a repair tool if it is ever doubted)
+SUMMARY_REBUILD_STATEMENTS = (
+    "DELETE FROM month_summary",
+    _SUMMARY_UPSERT.format(course="s.course", source="(SELECT 1 AS sign, m.* FROM student_months m) d JOIN students s ON s.id = d.student_id"),
+)
+
+# Substring name search ("%term%") can only use an index through pg_trgm
+TRIGRAM_STATEMENTS = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS students_name_trgm_idx ON students USING gin (fold_name(student_name) gin_trgm_ops)",
+)
+
+_LEGACY_AMOUNTS = "ARRAY[p.jan, p.feb, p.mar, p.apr, p.may, p.jun, p.jul, p.aug, p.sep, p.oct, p.nov, p.dec]"
+_LEGACY_NAMES = "ARRAY[" + ", ".join(f"'{name}'" for name in LEGACY_MONTH_NAMES) + "]"
+# Version 1 -> 2. Legacy data has no year; it is filed under the year given to setup_schema.
+# The old tables are kept, renamed, as a backup.
+LEGACY_MIGRATION_STATEMENTS = (
+    """
+    INSERT INTO students (id, payment_day, student_name, course, discount)
+    SELECT id, payment_day, COALESCE(student_name, ''), COALESCE(course, ''), COALESCE(discount, 0) FROM student_payments""",
+    # A debtor entry's own amount wins over the base amount (it was editable on the Devedores tab)
+    f"""
+    INSERT INTO student_months (student_id, year, month, amount, status, comment)
+    SELECT p.id, %(year)s, m.month, COALESCE(d.amount, m.amount, 0), d.status, COALESCE(d.comment, '')
+    FROM student_payments p
+    CROSS JOIN LATERAL unnest({_LEGACY_AMOUNTS}) WITH ORDINALITY AS m(amount, month)
+    LEFT JOIN student_debtors d ON d.id = p.id AND d.month = ({_LEGACY_NAMES})[m.month]
+    WHERE m.amount > 0 OR d.id IS NOT NULL""",
+    "ALTER TABLE student_debtors RENAME TO legacy_student_debtors",
+    "ALTER TABLE student_payments RENAME TO legacy_student_payments",
+)
+
+
+def create_year_partition(cur, year):
+    """Creates the student_months partition of ``year`` if missing (keys and indexes are inherited)."""
+    year = int(year)
+    cur.execute(f"CREATE TABLE IF NOT EXISTS student_months_{year} PARTITION OF student_months FOR VALUES IN ({year})")
+
+
+def ensure_year_partition(pool, year):
+    """Makes ``year`` writable: rows of a year without a partition are rejected by Postgres."""
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_KEY,))
+        create_year_partition(cur, year)
+
+
+def partition_years(pool):
+    """Years that have a student_months partition, ascending (read from the catalog, no table scan)."""
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'student_months'::regclass""")
+        return sorted(int(re.search(r"\d+", bound).group()) for bound, in cur.fetchall())
+
+
+def prune_change_log(pool, max_age_days=CHANGE_LOG_RETENTION_DAYS):
+    """Deletes change_log entries older than ``max_age_days``; returns how many.
+
+    Replicas last synced before the newest deleted entry reload in full (see change_log_horizon).
+    """
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            WITH pruned AS (DELETE FROM change_log WHERE changed_at < now() - make_interval(days => %s) RETURNING xact),
+            horizon AS (UPDATE change_log_horizon SET pruned_before = GREATEST(pruned_before, (SELECT MAX(xact) + 1 FROM pruned))
+                        WHERE EXISTS (SELECT 1 FROM pruned))
+            SELECT COUNT(*) FROM pruned""", (max_age_days,))
+        return cur.fetchone()[0]
+
+
+def _schema_version(cur):
+    cur.execute("SELECT MAX(version) FROM schema_version")
+    version = cur.fetchone()[0]
+    if version is None:
+        cur.execute("SELECT to_regclass('student_payments') IS NOT NULL")
+        version = 1 if cur.fetchone()[0] else 0  # 0 = empty database
+    return version
+
+
+def _schema_state(pool, year):
+    """None if setup_schema has work to do, else whether the trigram indexes exist.
+
+    Read-only catalog lookups (no lock, no DDL): the check made at every launch.
+    """
+    with pool.connection() as conn, conn.cursor() as cur:
+        # Qualified with current_schema(), where setup_schema creates them: a bare name would
+        # also find another schema's tables further down the search_path (e.g. public's)
+        cur.execute("SELECT to_regclass(format('%%I.schema_version', current_schema())) IS NOT NULL, "
+                    "to_regclass(format('%%I.%%I', current_schema(), %s::text)) IS NOT NULL, "
+                    "to_regclass(format('%%I.students_name_trgm_idx', current_schema())) IS NOT NULL", (f"student_months_{year}",))
+        has_version_table, has_partition, trigram = cur.fetchone()
+        if not (has_version_table and has_partition):
+            return None
+        cur.execute("SELECT MAX(version) FROM schema_version")
+        version = cur.fetchone()[0]
+    return trigram if version is not None and version >= SCHEMA_VERSION else None
+
+
+def setup_schema(pool, legacy_year=None, force=False):
+    """Create the application tables, functions and indexes, migrating older layouts.
+
+    A database in an older layout is migrated in the same transaction; rows of the
+    original layout are filed under ``legacy_year`` (default: the current year). The
+    current year's partition is always created. Returns True if the trigram name-search
+    indexes are in place; without pg_trgm (not installed, or no permission to create it)
+    search still works, unindexed.
+
+    A database already at SCHEMA_VERSION with the current year's partition is only
+    checked (two catalog queries) unless ``force``; forcing re-runs every CREATE ... IF
+    NOT EXISTS, e.g. to pick up pg_trgm installed after the tables were created.
+    """
+    current_year = datetime.date.today().year
+    if not force:
+        trigram = _schema_state(pool, current_year)
+        if trigram is not None:
+            return trigram
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_KEY,))
+            for statement in SCHEMA_STATEMENTS:
+                cur.execute(statement)
+            version = _schema_version(cur)
+            if version == 2:
+                for statement in UNPARTITIONED_RENAME_STATEMENTS:
+                    cur.execute(statement)
+            for statement in MONTHS_TABLE_STATEMENTS:
+                cur.execute(statement)
+            if version == 1:
+                year = legacy_year or current_year
+                create_year_partition(cur, year)
+                for statement in LEGACY_MIGRATION_STATEMENTS:
+                    cur.execute(statement, {"year": year})
+                cur.execute("SELECT COUNT(*) FROM students")
+                logger.info("Schema migrated to version %s: %s students filed under %s", SCHEMA_VERSION, cur.fetchone()[0], year)
+            elif version == 2:
+                cur.execute("SELECT DISTINCT year FROM student_months_unpartitioned")
+                years = [year for year, in cur.fetchall()]
+                for year in years:
+                    create_year_partition(cur, year)
+                for statement in UNPARTITIONED_COPY_STATEMENTS:
+                    cur.execute(statement)
+                logger.info("Schema migrated to version %s: student_months partitioned by year (%s)", SCHEMA_VERSION, ', '.join(map(str, sorted(years))) or 'no data')
+            create_year_partition(cur, current_year)
+            for statement in SUMMARY_TABLE_STATEMENTS:
+                cur.execute(statement)
+            if version < 4:
+                for statement in SUMMARY_TRIGGER_STATEMENTS + SUMMARY_REBUILD_STATEMENTS:
+                    cur.execute(statement)
+            if version < 7:
+                for statement in CHANGE_LOG_STATEMENTS + NOTIFY_TRIGGER_STATEMENTS:
+                    cur.execute(statement)
+            if version < 6:
+                for statement in ROW_VERSION_STATEMENTS:
+                    cur.execute(statement)
+            if version < SCHEMA_VERSION:
+                cur.execute("DELETE FROM schema_version")
+                cur.execute("INSERT INTO schema_version (version) VALUES (%s)", (SCHEMA_VERSION,))
+            cur.execute("SAVEPOINT trigram_indexes")
+            try:
+                for statement in TRIGRAM_STATEMENTS:
+                    cur.execute(statement)
+            except psycopg2.Error as e:
+                cur.execute("ROLLBACK TO SAVEPOINT trigram_indexes")
+                reason = (e.pgerror or str(e)).strip().splitlines()[0]
+                logger.warning("pg_trgm unavailable, name search will not be indexed (%s)", reason)
+                return False
+            return True
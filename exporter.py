@@ -0,0 +1,151 @@
+"""Streaming Excel export.
+
+Rows are written with openpyxl's write-only workbook, which serializes each row
+to a temporary file as it is appended instead of keeping the sheet in memory;
+combined with rows pulled from a server-side cursor (``iter_payments`` /
+``iter_open_debtors``), memory stays bounded whatever the number of rows.
+
+Write-only sheets emit their column widths before the first row, so widths
+are tracked incrementally over the first ``WIDTH_SAMPLE_ROWS`` rows (held
+back until then) and fixed from that sample.
+
+Two layouts are available: ``export_rows`` writes display strings as shown in
+the tables ("270,18 ✅"); ``export_payments_numeric`` / ``export_debtors_numeric``
+write real numeric cells with a BRL number format, with the status carried in
+its own column and as the cell colour, so sheets work with SUM and pivots.
+"""
+from openpyxl import Workbook
+from openpyxl.cell import Cell, WriteOnlyCell
+from openpyxl.styles import Font, PatternFill
+from openpyxl.utils import get_column_letter
+
+from repository import days_overdue
+
+WIDTH_SAMPLE_ROWS = 1000
+WIDTH_PADDING = 3
+MAX_WIDTH = 60
+
+# Excel renders the format with the reader's own separators (pt-BR: "R$ 1.234,56")
+BRL_FORMAT = '"R$" #,##0.00'
+# Same colours as the status tags of the Devedores table
+STATUS_FILLS = {
+    "Pago": PatternFill("solid", fgColor="C8E6C9"),
+    "Em Negociação": PatternFill("solid", fgColor="FFF9C4"),
+    "Pendente": PatternFill("solid", fgColor="FFCDD2"),
+}
+HEADER_FONT = Font(bold=True)
+
+
+def _display_length(value):
+    """Approximate rendered width of a value (BRL cells are wider than their digits)."""
+    if isinstance(value, Cell):
+        if value.value is None: return 0
+        if value.number_format == BRL_FORMAT: return len(f"R$ {value.value:,.2f}")
+        value = value.value
+    return len(str(value))
+
+
+class SheetStream:
+    """Appends rows to a write-only worksheet, sizing columns from the first rows."""
+
+    def __init__(self, workbook, title, headers, sample_rows=WIDTH_SAMPLE_ROWS, bold_headers=False):
+        self.sheet = workbook.create_sheet(title)
+        self.headers = [self.cell(header, font=HEADER_FONT) for header in headers] if bold_headers else list(headers)
+        self.sample_rows = sample_rows
+        self.widths = [_display_length(header) for header in self.headers]
+        self.pending = []  # rows held back until the widths are known
+        self.count = 0
+
+    def cell(self, value, number_format=None, fill=None, font=None):
+        """A styled cell for this sheet (plain values can be appended as they are)."""
+        cell = WriteOnlyCell(self.sheet, value=value)
+        if number_format: cell.number_format = number_format
+        if fill is not None: cell.fill = fill
+        if font is not None: cell.font = font
+        return cell
+
+    def _track(self, values):
+        for i, value in enumerate(values):
+            if value is None: continue
+            length = _display_length(value)
+            if i >= len(self.widths): self.widths.append(length)
+            elif length > self.widths[i]: self.widths[i] = length
+
+    def _flush_pending(self):
+        if self.pending is None: return
+        for i, width in enumerate(self.widths):
+            self.sheet.column_dimensions[get_column_letter(i + 1)].width = min(width + WIDTH_PADDING, MAX_WIDTH)
+        self.sheet.append(self.headers)
+        for values in self.pending:
+            self.sheet.append(values)
+        self.pending = None
+
+    def append(self, values):
+        values = list(values)
+        self.count += 1
+        if self.pending is not None:
+            self._track(values)
+            self.pending.append(values)
+            if len(self.pending) >= self.sample_rows:
+                self._flush_pending()
+        else:
+            self.sheet.append(values)
+
+    def close(self):
+        self._flush_pending()
+
+
+def export_rows(file_path, sheet_name, headers, rows, progress=None, progress_every=5000, row_builder=None, bold_headers=False):
+    """Streams ``rows`` (iterable of value sequences) into a new .xlsx file.
+
+    ``progress(count)`` is called every ``progress_every`` rows (it may raise to abort,
+    e.g. ``Job.report`` after cancellation). ``row_builder(stream, record)``, if given,
+    turns each record into the values to append (used by the numeric layouts).
+    Returns the number of data rows written; nothing is saved when there are none.
+    """
+    workbook = Workbook(write_only=True)
+    stream = SheetStream(workbook, sheet_name, headers, bold_headers=bold_headers)
+    for values in rows:
+        stream.append(row_builder(stream, values) if row_builder else values)
+        if progress is not None and stream.count % progress_every == 0:
+            progress(stream.count)
+    if stream.count == 0:
+        return 0
+    stream.close()
+    workbook.save(file_path)
+    return stream.count
+
+
+# --- Numeric layouts (values straight from the repository records) ---
+def _money(stream, amount, status=None):
+    if amount is None: return None
+    return stream.cell(amount, number_format=BRL_FORMAT, fill=STATUS_FILLS.get(status))
+
+
+def _payment_row(stream, student):
+    """ID, day, name, course, discount, 12 amounts (coloured by status), then the 12 statuses."""
+    values = [student.id, student.payment_day, student.student_name, student.course, _money(stream, student.discount)]
+    values.extend(_money(stream, amount, status if amount else None) for amount, status in zip(student.months, student.statuses))
+    values.extend(status if amount else None for amount, status in zip(student.months, student.statuses))
+    return values
+
+
+def _debtor_row(stream, debt, reference=None):
+    """ID, name, course, month, amount, status, days overdue (empty before the due date), comment."""
+    days = days_overdue(debt.due, reference) if debt.due is not None else None
+    return [debt.id, debt.student_name, debt.course, debt.month, _money(stream, debt.amount),
+            stream.cell(debt.status, fill=STATUS_FILLS.get(debt.status)), days if days is not None and days >= 0 else None, debt.comment]
+
+
+def export_payments_numeric(file_path, headers, students, progress=None):
+    """Payments sheet with numeric BRL cells; ``headers`` are the 17 table headings
+    (a "Status <month>" column is added per month). ``students``: ``StudentPayment`` iterable."""
+    headers = list(headers) + [f"Status {month}" for month in headers[5:17]]
+    return export_rows(file_path, "Pagamentos", headers, students, progress=progress, row_builder=_payment_row, bold_headers=True)
+
+
+def export_debtors_numeric(file_path, headers, debts, progress=None, reference=None):
+    """Debtors sheet with a numeric BRL "Valor", a coloured status cell and the days overdue on
+    ``reference`` (default today). ``debts``: ``DebtorRecord`` iterable."""
+    return export_rows(file_path, "Devedores", headers, debts, progress=progress,
+                       row_builder=lambda stream, debt: _debtor_row(stream, debt, reference), bold_headers=True)
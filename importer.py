@@ -0,0 +1,289 @@
+"""Bulk import of students and payments from a CSV or XLSX spreadsheet.
+
+The file is read as a stream (openpyxl read-only mode / the csv module) and each
+row is validated with the same rules as the payment form. Valid rows are handed
+to ``PaymentsRepository.import_students``, which COPYs them into a staging table
+and upserts them with a few set-based statements; invalid rows are skipped and
+reported in an errors file (one line per problem), not in message boxes.
+
+The expected columns are the Pagamentos table headings (ID, Dia, Aluno, Curso,
+Desc., JAN..DEZ), optionally followed by "Status <mês>" columns, i.e. the layout
+of both Excel exports; database column names (id, payment_day, ...) and full
+month names are accepted as well. Header matching ignores case and accents.
+
+Uso:
+    python importer.py alunos.xlsx
+    python importer.py alunos.csv --erros erros.csv
+"""
+import argparse
+import codecs
+import csv
+import os
+from typing import NamedTuple, Optional
+
+from database import close_pool
+from money import MAX_AMOUNT, ZERO, parse_brl, to_money
+from repository import MONTH_CODES, MONTH_NAMES, PaymentsRepository, StudentPayment, fold_name
+
+MONTH_SHORT_NAMES = ("jan", "fev", "mar", "abr", "mai", "jun", "jul", "ago", "set", "out", "nov", "dez")
+STATUSES = ("Pago", "Pendente", "Em Negociação")
+NAME_MAX_LENGTH = 50
+COURSE_MAX_LENGTH = 15
+ERROR_HEADERS = ("Linha", "Coluna", "Valor", "Erro")
+
+
+class ImportFormatError(ValueError):
+    """The file cannot be imported at all (unknown type, missing columns)."""
+
+
+class ImportResult(NamedTuple):
+    rows_read: int
+    inserted: int
+    updated: int
+    statuses: int               # debtor entries created/updated from "Status <mês>" columns
+    errors: int                 # rows skipped
+    error_file: Optional[str]   # None when every row was valid
+
+
+def _header_aliases():
+    """Folded heading -> field name (PAYMENT_COLUMNS, or '<code>_status')."""
+    aliases = {"id": "id", "dia": "payment_day", "dia do pagamento": "payment_day", "payment_day": "payment_day",
+               "aluno": "student_name", "nome": "student_name", "nome do aluno": "student_name", "student_name": "student_name",
+               "curso": "course", "course": "course",
+               "desc.": "discount", "desc": "discount", "desconto": "discount", "discount": "discount"}
+    for code, short in zip(MONTH_CODES, MONTH_SHORT_NAMES):
+        for name in (code, short, fold_name(MONTH_NAMES[code])):
+            aliases[name] = code
+            aliases[f"status {name}"] = f"{code}_status"
+        aliases[f"{code}_status"] = f"{code}_status"
+    return aliases
+
+
+HEADER_ALIASES = _header_aliases()
+REQUIRED_FIELDS = ("id", "payment_day", "student_name", "course", "discount") + MONTH_CODES
+STATUS_BY_FOLDED = {fold_name(status): status for status in STATUSES}
+
+
+# --- Readers (yield (line number, values) for non-empty rows, header included) ---
+def _xlsx_rows(file_path):
+    from openpyxl import load_workbook
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        for line, values in enumerate(workbook.worksheets[0].iter_rows(values_only=True), start=1):
+            if any(value not in (None, "") for value in values):
+                yield line, values
+    finally:
+        workbook.close()
+
+
+def _detect_encoding(sample):
+    """utf-8 (with or without BOM) if the sample decodes as such, else cp1252 (Excel's CSV on Windows)."""
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+    except UnicodeDecodeError:
+        return "cp1252"
+    return "utf-8-sig"
+
+
+class _SemicolonDialect(csv.excel):
+    delimiter = ";"  # Excel's CSV in pt-BR locales
+
+
+def _csv_rows(file_path):
+    with open(file_path, "rb") as f:
+        sample = f.read(65536)
+    encoding = _detect_encoding(sample)
+    with open(file_path, newline="", encoding=encoding) as f:
+        try:
+            dialect = csv.Sniffer().sniff(sample.decode(encoding, errors="ignore"), delimiters=";,\t")
+        except csv.Error:
+            dialect = _SemicolonDialect
+        for line, values in enumerate(csv.reader(f, dialect), start=1):
+            if any(value.strip() for value in values):
+                yield line, values
+
+
+def read_rows(file_path):
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension in (".xlsx", ".xlsm"):
+        return _xlsx_rows(file_path)
+    if extension in (".csv", ".txt"):
+        return _csv_rows(file_path)
+    raise ImportFormatError(f"Tipo de arquivo não suportado: {extension or file_path} (use .xlsx ou .csv)")
+
+
+# --- Field parsing (raise ValueError with the message written to the errors file) ---
+def parse_int(value):
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    text = str(value if value is not None else "").strip()
+    if not (text.isascii() and text.isdigit()):
+        raise ValueError("deve ser um número inteiro")
+    return int(text)
+
+
+def parse_amount(value):
+    """Spreadsheet amount -> Decimal with 2 places: numbers as they are, text in BRL
+    ("1.234,56", "R$ 10,00") or plain ("1234.56") notation; the ✅/❌ marks are ignored."""
+    if value is None or value == "":
+        return ZERO
+    if isinstance(value, bool):
+        raise ValueError("valor monetário inválido")
+    amount = parse_brl(value) if isinstance(value, str) else to_money(value)
+    if amount < 0:
+        raise ValueError("valor negativo")
+    if amount > MAX_AMOUNT:
+        raise ValueError("valor muito alto")
+    return amount
+
+
+def parse_status(value):
+    text = str(value if value is not None else "").strip()
+    if not text:
+        return None
+    status = STATUS_BY_FOLDED.get(fold_name(text))
+    if status is None:
+        raise ValueError(f"status inválido (use {', '.join(STATUSES)})")
+    return status
+
+
+def map_headers(header_values):
+    """Field name -> column index; raises ImportFormatError if a required column is missing."""
+    columns = {}
+    for index, heading in enumerate(header_values):
+        field = HEADER_ALIASES.get(fold_name(str(heading if heading is not None else "")).strip())
+        if field is not None and field not in columns:
+            columns[field] = index
+    missing = [field for field in REQUIRED_FIELDS if field not in columns]
+    if missing:
+        raise ImportFormatError(f"Colunas obrigatórias ausentes: {', '.join(missing)}")
+    return columns
+
+
+class RowValidator:
+    """Turns spreadsheet rows into ``StudentPayment``s, collecting per-field errors."""
+
+    def __init__(self, columns, id_range=(1001, 9999)):
+        self.columns = columns
+        self.id_range = id_range
+        self.seen_ids = {}  # id -> line of its first valid row, to reject repeated IDs
+
+    def _value(self, values, field):
+        index = self.columns.get(field)
+        return values[index] if index is not None and index < len(values) else None
+
+    def validate(self, line, values):
+        """Returns (student or None, [(column, value, message), ...])."""
+        errors = []
+
+        def field(name, parse):
+            raw = self._value(values, name)
+            try:
+                return parse(raw)
+            except ValueError as e:
+                errors.append((name, raw, str(e)))
+                return None
+
+        student_id = field("id", parse_int)
+        if student_id is not None:
+            low, high = self.id_range
+            if not low <= student_id <= high:
+                errors.append(("id", student_id, f"deve estar entre {low} e {high}"))
+            elif student_id in self.seen_ids:
+                errors.append(("id", student_id, f"ID repetido (já aparece na linha {self.seen_ids[student_id]})"))
+        payment_day = field("payment_day", parse_int)
+        if payment_day is not None and not 1 <= payment_day <= 31:
+            errors.append(("payment_day", payment_day, "deve estar entre 1 e 31"))
+        name = str(self._value(values, "student_name") or "").strip()
+        if not name:
+            errors.append(("student_name", "", "nome do aluno é obrigatório"))
+        elif len(name) > NAME_MAX_LENGTH:
+            errors.append(("student_name", name, f"mais de {NAME_MAX_LENGTH} caracteres"))
+        course = str(self._value(values, "course") or "").strip()
+        if len(course) > COURSE_MAX_LENGTH:
+            errors.append(("course", course, f"mais de {COURSE_MAX_LENGTH} caracteres"))
+        discount = field("discount", parse_amount)
+        months = tuple(field(code, parse_amount) for code in MONTH_CODES)
+        statuses = tuple(field(f"{code}_status", parse_status) for code in MONTH_CODES)
+        for code, amount, status in zip(MONTH_CODES, months, statuses):
+            if status is not None and amount == 0:
+                errors.append((f"{code}_status", status, "status informado para um mês sem valor"))
+        if errors:
+            return None, errors
+        self.seen_ids[student_id] = line  # Only rows that are imported: a rejected row does not claim its ID
+        return StudentPayment(student_id, payment_day, name, course, discount, months, statuses), []
+
+
+def default_error_path(file_path):
+    base, _ = os.path.splitext(file_path)
+    return f"{base}_erros.csv"
+
+
+def import_file(file_path, payments_repo=None, error_path=None, progress=None, progress_every=1000, id_range=(1001, 9999)):
+    """Imports a CSV/XLSX file of students; see the module docstring for the layout.
+
+    Invalid rows are written to ``error_path`` (default: "<arquivo>_erros.csv" next to the
+    input, created only if needed) and the valid ones are upserted in a single transaction.
+    ``progress(rows_read)`` is called every ``progress_every`` rows (it may raise to abort
+    the import, which then rolls back). Raises ImportFormatError if the file has the wrong type
+    or lacks columns.
+    """
+    payments_repo = payments_repo or PaymentsRepository()
+    error_path = error_path or default_error_path(file_path)
+    rows = read_rows(file_path)
+    header = next(rows, None)
+    if header is None:
+        raise ImportFormatError("Arquivo vazio.")
+    columns = map_headers(header[1])
+    headings = {field: str(header[1][index]) for field, index in columns.items()}  # errors name the file's own columns
+    validator = RowValidator(columns, id_range=id_range)
+    counts = {"read": 0, "errors": 0}
+    error_file = None
+
+    def valid_students():
+        nonlocal error_file
+        for line, values in rows:
+            counts["read"] += 1
+            if progress is not None and counts["read"] % progress_every == 0:
+                progress(counts["read"])
+            student, errors = validator.validate(line, values)
+            if student is not None:
+                yield student
+                continue
+            counts["errors"] += 1
+            if error_file is None:
+                error_file = open(error_path, "w", newline="", encoding="utf-8-sig")
+                writer = csv.writer(error_file, delimiter=";")
+                writer.writerow(ERROR_HEADERS)
+            for column, value, message in errors:
+                writer.writerow((line, headings.get(column, column), "" if value is None else value, message))
+
+    try:
+        inserted, updated, statuses = payments_repo.import_students(valid_students())
+    finally:
+        if error_file is not None:
+            error_file.close()
+    return ImportResult(counts["read"], inserted, updated, statuses, counts["errors"],
+                        error_path if counts["errors"] else None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Importa alunos e pagamentos de uma planilha (.xlsx ou .csv).")
+    parser.add_argument("file", help="planilha a importar")
+    parser.add_argument("--erros", dest="error_path", help="arquivo CSV para as linhas rejeitadas (padrão: <arquivo>_erros.csv)")
+    args = parser.parse_args()
+    try:
+        result = import_file(args.file, error_path=args.error_path,
+                             progress=lambda count: print(f"  {count} linhas lidas...", flush=True))
+    finally:
+        close_pool()
+    print(f"{result.rows_read} linhas lidas: {result.inserted} alunos inseridos, {result.updated} atualizados, "
+          f"{result.statuses} status de mês aplicados.")
+    if result.errors:
+        print(f"{result.errors} linhas rejeitadas; detalhes em {result.error_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""Timing spans, in-memory latency counters, trace files and the app's logger.
+
+``span(name)`` (a context manager) and ``@timed`` (a decorator) time a block
+with ``perf_counter`` and hand the duration to the process-wide ``recorder``,
+which keeps a count, a total and the last ``max_samples`` durations per name,
+enough for the p50/p95 shown on the Desempenho tab. A span costs about a
+microsecond, so they stay on in production.
+
+While tracing is on (``recorder.start_trace()``, or ``PAGAMENTOS_TRACE=<file>``
+for the whole run) every span is also kept as an event, and ``dump_trace``
+writes them in the Chrome trace-event format (open in chrome://tracing or
+https://ui.perfetto.dev) for offline analysis.
+
+Diagnostics go through the standard ``logging`` module under the "pagamentos"
+logger; ``configure_logging`` sets the level from ``PAGAMENTOS_LOG_LEVEL``
+(default WARNING, i.e. debug and info messages are off).
+"""
+import functools
+import inspect
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import NamedTuple
+
+logger = logging.getLogger("pagamentos")
+
+
+def configure_logging(level=None):
+    """Logs to stderr at ``level`` (default: $PAGAMENTOS_LOG_LEVEL, else WARNING)."""
+    level = (level or os.environ.get("PAGAMENTOS_LOG_LEVEL") or "WARNING").upper()
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    logger.setLevel(getattr(logging, level, logging.WARNING))
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of numbers (pct in 0..100)."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class OperationStats(NamedTuple):
+    name: str
+    count: int
+    total: float   # seconds, every call
+    mean: float    # seconds, over the kept samples
+    p50: float
+    p95: float
+    max: float
+
+
+class Recorder:
+    """Thread-safe per-operation counters (and, while tracing, a bounded event list)."""
+
+    def __init__(self, max_samples=1000, max_events=200_000):
+        self.max_samples = max_samples
+        self.max_events = max_events
+        self._lock = threading.Lock()
+        self._counts = {}   # name -> [count, total seconds]
+        self._samples = {}  # name -> deque of the latest durations
+        self._events = None  # list of (name, start, duration, thread id) while tracing
+        self._origin = time.perf_counter()
+
+    def record(self, name, start, duration):
+        with self._lock:
+            counts = self._counts.get(name)
+            if counts is None:
+                counts = self._counts[name] = [0, 0.0]
+                self._samples[name] = deque(maxlen=self.max_samples)
+            counts[0] += 1; counts[1] += duration
+            self._samples[name].append(duration)
+            if self._events is not None and len(self._events) < self.max_events:
+                self._events.append((name, start, duration, threading.get_ident()))
+
+    def stats(self):
+        """OperationStats per name, slowest total first."""
+        with self._lock:
+            snapshot = [(name, counts[0], counts[1], list(self._samples[name])) for name, counts in self._counts.items()]
+        stats = [OperationStats(name, count, total, sum(samples) / len(samples), percentile(samples, 50),
+                                percentile(samples, 95), max(samples))
+                 for name, count, total, samples in snapshot]
+        return sorted(stats, key=lambda s: s.total, reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear(); self._samples.clear()
+
+    @property
+    def tracing(self):
+        return self._events is not None
+
+    def start_trace(self):
+        with self._lock:
+            if self._events is None:
+                self._events = []
+
+    def stop_trace(self):
+        """Stops tracing and returns the events collected."""
+        with self._lock:
+            events, self._events = self._events or [], None
+        return events
+
+    def dump_trace(self, file_path, stop=True):
+        """Writes the events so far as a Chrome trace (JSON); returns how many were written."""
+        with self._lock:
+            events = list(self._events or ())
+        if stop:
+            self.stop_trace()
+        pid = os.getpid()
+        trace = [{"name": name, "cat": name.split(".", 1)[0], "ph": "X", "pid": pid, "tid": tid,
+                  "ts": round((start - self._origin) * 1e6, 1), "dur": round(duration * 1e6, 1)}
+                 for name, start, duration, tid in events]
+        with open(file_path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+        return len(trace)
+
+
+recorder = Recorder()
+if os.environ.get("PAGAMENTOS_TRACE"):
+    recorder.start_trace()
+
+
+@contextmanager
+def span(name):
+    """Times the ``with`` block under ``name`` (recorded even if it raises)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.record(name, start, time.perf_counter() - start)
+
+
+def timed(name=None):
+    """Decorator: times each call under ``name`` (default: the function's qualified name).
+
+    Generator functions are timed until the generator is exhausted or closed.
+    """
+    def decorate(function):
+        label = name or function.__qualname__
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def generator_wrapper(*args, **kwargs):
+                with span(label):
+                    yield from function(*args, **kwargs)
+            return generator_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(label):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,207 @@
+"""Background jobs for the Tk app.
+
+Tkinter is single-threaded: a query that waits on the network or on a lock in
+Postgres freezes the whole window. ``JobRunner`` runs that work on worker
+threads and hands results back to the Tk thread by polling a queue with
+``root.after``, so callbacks may touch widgets freely.
+
+Reads run on a small thread pool; writes go through a single dedicated thread
+so they reach the database in the order the user made them. Jobs submitted
+with a ``group`` supersede the previous job of the same group (e.g. a second
+search while the first is still running): the old job is cancelled, its
+running query is interrupted and its result is discarded.
+"""
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import recorder, span
+
+logger = logging.getLogger("pagamentos.jobs")
+
+
+class JobCancelled(Exception):
+    """Raised inside a job (by ``Job.check``) once it has been cancelled."""
+
+
+class Job:
+    """Handle for one unit of background work."""
+
+    def __init__(self, runner, label="", group=None, write=False):
+        self.runner = runner
+        self.label = label
+        self.group = group
+        self.write = write
+        self.submitted_at = time.monotonic()
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._thread_ident = None  # set while the job is running
+        self.future = None
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check(self):
+        """Call between steps of long jobs: raises JobCancelled if the job was cancelled."""
+        if self._cancelled.is_set():
+            raise JobCancelled(self.label)
+
+    def report(self, done, total=None, message=None):
+        """Report progress (delivered to the job's on_progress callback on the Tk thread)."""
+        self.check()
+        self.runner._results.put(("progress", self, (done, total, message)))
+
+    def cancel(self):
+        """Marks the job as cancelled and interrupts its running query, if any."""
+        if self._cancelled.is_set():
+            return
+        self._cancelled.set()
+        if self.future is not None and self.future.cancel():
+            self.runner._results.put(("cancelled", self, None))  # never started
+            return
+        with self._lock:
+            if self._thread_ident is not None and self.runner.cancel_hook is not None:
+                try:
+                    self.runner.cancel_hook(self._thread_ident)
+                except Exception as e:
+                    logger.warning("Could not interrupt job '%s': %s", self.label, e)
+
+
+class JobRunner:
+    """Runs callables off the Tk thread and delivers their outcome back on it."""
+
+    def __init__(self, root, max_workers=2, poll_interval_ms=40, cancel_hook=None, on_activity=None):
+        self.root = root
+        self.poll_interval_ms = poll_interval_ms
+        # cancel_hook(thread_ident) interrupts the query a worker thread is running
+        self.cancel_hook = cancel_hook
+        # on_activity(active_jobs) is called on the Tk thread whenever the set of running jobs changes
+        self.on_activity = on_activity
+        self._readers = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db-read")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+        self._results = queue.Queue()
+        self._callbacks = {}  # job -> (on_done, on_error, on_progress)
+        self._groups = {}     # group -> latest job
+        self._poll_id = None
+        self._closed = False
+
+    @property
+    def active_jobs(self):
+        return list(self._callbacks)
+
+    def submit(self, work, on_done=None, on_error=None, on_progress=None, group=None, label="", write=False):
+        """Runs ``work(job)`` in the background.
+
+        on_done(result), on_error(exception) and on_progress(done, total, message)
+        are called on the Tk thread; none of them is called for a cancelled job.
+        """
+        if self._closed:
+            raise RuntimeError("JobRunner is shut down")
+        job = Job(self, label=label, group=group, write=write)
+        if group is not None:
+            previous = self._groups.get(group)
+            if previous is not None:
+                previous.cancel()
+            self._groups[group] = job
+        self._callbacks[job] = (on_done, on_error, on_progress)
+        executor = self._writer if write else self._readers
+        job.future = executor.submit(self._run, job, work)
+        self._notify_activity()
+        self._schedule_poll()
+        return job
+
+    def cancel(self, group):
+        job = self._groups.get(group)
+        if job is not None:
+            job.cancel()
+
+    def cancel_all(self, include_writes=False):
+        """Cancels every pending/running job (writes only if include_writes)."""
+        for job in list(self._callbacks):
+            if include_writes or not job.write:
+                job.cancel()
+
+    def shutdown(self, wait=False):
+        """Cancels pending reads and stops the workers; queued writes still run unless wait is False."""
+        self._closed = True
+        self.cancel_all()
+        if self._poll_id is not None:
+            try:
+                self.root.after_cancel(self._poll_id)
+            except Exception:
+                pass
+            self._poll_id = None
+        self._readers.shutdown(wait=wait, cancel_futures=True)
+        self._writer.shutdown(wait=wait)
+
+    # --- Worker side ---
+    def _run(self, job, work):
+        with job._lock:
+            if job.cancelled:
+                self._results.put(("cancelled", job, None))
+                return
+            job._thread_ident = threading.get_ident()
+        waited = time.monotonic() - job.submitted_at
+        recorder.record("jobs.queue_wait", time.perf_counter() - waited, waited)
+        try:
+            with span("jobs.write" if job.write else "jobs.read"):
+                result = work(job)
+            outcome = ("done", job, result)
+        except JobCancelled:
+            outcome = ("cancelled", job, None)
+        except Exception as e:
+            outcome = ("cancelled", job, None) if job.cancelled else ("error", job, e)
+        finally:
+            with job._lock:
+                job._thread_ident = None
+        self._results.put(outcome)
+
+    # --- Tk side ---
+    def _schedule_poll(self):
+        if self._poll_id is None and not self._closed:
+            self._poll_id = self.root.after(self.poll_interval_ms, self._poll)
+
+    def _poll(self):
+        self._poll_id = None
+        changed = False
+        while True:
+            try:
+                kind, job, payload = self._results.get_nowait()
+            except queue.Empty:
+                break
+            on_done, on_error, on_progress = self._callbacks.get(job, (None, None, None))
+            if kind == "progress":
+                if on_progress is not None and not job.cancelled:
+                    on_progress(*payload)
+                continue
+            self._callbacks.pop(job, None)
+            if self._groups.get(job.group) is job:
+                del self._groups[job.group]
+            changed = True
+            try:
+                if job.cancelled or kind == "cancelled":
+                    continue
+                if kind == "done" and on_done is not None:
+                    with span("ui.job_done"):
+                        on_done(payload)
+                elif kind == "error":
+                    if on_error is not None:
+                        on_error(payload)
+                    else:
+                        logger.error("Unhandled error in background job '%s'", job.label, exc_info=payload)
+            except Exception:
+                logger.exception("Error in callback of job '%s'", job.label)
+        if changed:
+            self._notify_activity()
+        if self._callbacks:
+            self._schedule_poll()
+
+    def _notify_activity(self):
+        if self.on_activity is not None:
+            try:
+                self.on_activity(self.active_jobs)
+            except Exception:
+                logger.exception("Error updating job activity indicator")
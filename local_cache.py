@@ -0,0 +1,345 @@
+"""Local read-through replica of one year's payments grid and open debts.
+
+Opening the app, a new search or "Mostrar Todos" used to read the whole grid from
+Postgres every time. ``LocalCache`` keeps the year's rows (payments with their marks,
+open debts with their comments and row versions) in memory and answers the tabs from
+there, in the shapes and order the repositories return. Before a view is served it
+asks the server only for what changed: the ``change_log`` entries since its sync point
+name the students to re-read (see ``repository.SyncRepository``), so a sync with no
+changes is one indexed query and a sync after an edit re-reads that one student.
+
+With a cache directory (``PAGAMENTOS_CACHE_DIR``, default ~/.pagamentos/cache; empty =
+memory only) the replica is also kept in a SQLite file per database and year. The
+first sync starts from that file, so a launch only fetches what changed since the app
+was last used. ``PAGAMENTOS_CACHE=0`` turns the replica off (every view reads Postgres).
+
+While the server is unreachable the replica is what the app shows (see offline.py):
+``load_local`` reads the file without the server, and ``apply_local`` records changes
+made offline; those students are re-read from the server at the next sync.
+"""
+import bisect
+import datetime
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from decimal import Decimal
+
+from database import DB_CONFIG
+from instrumentation import timed
+from repository import (MONTH_CODES, MONTH_INDEX, MONTH_NAMES, DebtorRecord, StudentPayment, SyncRepository, aging_due_range,
+                        due_date, matches_search)
+
+logger = logging.getLogger("pagamentos.local_cache")
+
+CACHE_FORMAT = "1"  # layout of the SQLite file; files in another format are ignored (and rewritten)
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".pagamentos", "cache")
+MAX_VIEWS = 16  # filtered lists kept between changes
+# A delta naming more students than this (or a quarter of the year, if more) is replaced by a full read
+MIN_DELTA_LIMIT = 1000
+
+SQLITE_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+    """CREATE TABLE IF NOT EXISTS payments (
+        id INTEGER PRIMARY KEY, payment_day INTEGER, student_name TEXT, course TEXT, discount TEXT,
+        months TEXT, statuses TEXT, version INTEGER)""",
+    """CREATE TABLE IF NOT EXISTS debts (
+        student_id INTEGER, month INTEGER, student_name TEXT, course TEXT, amount TEXT,
+        status TEXT, comment TEXT, version INTEGER, PRIMARY KEY (student_id, month))""",
+)
+
+
+def cache_directory(directory=None):
+    """Where the SQLite files go ($PAGAMENTOS_CACHE_DIR, default ~/.pagamentos/cache); "" = memory only."""
+    return os.environ.get("PAGAMENTOS_CACHE_DIR", DEFAULT_CACHE_DIR) if directory is None else directory
+
+
+def database_key(conn_kwargs=None):
+    """Short hash naming the database ``conn_kwargs`` points at, for the files kept about it."""
+    conn_kwargs = conn_kwargs or DB_CONFIG
+    # Server, database and search_path (PGOPTIONS) decide which rows the file holds
+    identity = "|".join(str(conn_kwargs.get(key, "")) for key in ("host", "port", "database")) + "|" + os.environ.get("PGOPTIONS", "")
+    return hashlib.sha1(identity.encode()).hexdigest()[:12]
+
+
+def cache_path(year, conn_kwargs=None, directory=None):
+    """SQLite file of ``year`` for the database ``conn_kwargs`` points at; None if disk copies are off."""
+    directory = cache_directory(directory)
+    if not directory:
+        return None
+    return os.path.join(directory, f"replica-{database_key(conn_kwargs)}-{year}.sqlite3")
+
+
+def local_cache_for(year):
+    """The replica the app uses for ``year`` (None when PAGAMENTOS_CACHE=0)."""
+    if os.environ.get("PAGAMENTOS_CACHE", "1") == "0":
+        return None
+    return LocalCache(year, path=cache_path(year))
+
+
+def _meta_value(value):
+    return "" if value is None else repr(value)
+
+
+def _debt_key(debt):
+    return debt.id, MONTH_INDEX[debt.month] + 1
+
+
+def _payment_to_sqlite(s):
+    return (s.id, s.payment_day, s.student_name, s.course, str(s.discount),
+            json.dumps([str(amount) for amount in s.months]), json.dumps(list(s.statuses)), s.version)
+
+
+def _payment_from_sqlite(row):
+    return StudentPayment(row[0], row[1], row[2], row[3], Decimal(row[4]), tuple(map(Decimal, json.loads(row[5]))),
+                          tuple(json.loads(row[6])), row[7])
+
+
+def _debt_to_sqlite(d):
+    return (d.id, MONTH_INDEX[d.month] + 1, d.student_name, d.course, str(d.amount), d.status, d.comment, d.version)
+
+
+def _debt_from_sqlite(row, year, payment_day):
+    # The due date is not stored: it follows from the student's payment_day
+    return DebtorRecord(row[0], row[2], row[3], MONTH_NAMES[MONTH_CODES[row[1] - 1]], Decimal(row[4]), row[5], row[6], row[7],
+                        due_date(year, row[1], payment_day))
+
+
+class LocalCache:
+    """In-memory replica of one year, optionally backed by a SQLite file, kept current by deltas.
+
+    Thread-safe: syncs and reads may run on different background jobs. The read methods
+    mirror the PaymentsRepository / DebtorsRepository ones the tabs use.
+    """
+
+    def __init__(self, year, repo=None, path=None):
+        self.year = year
+        self.repo = repo or SyncRepository(year=year)
+        self.path = path
+        self.since = None       # sync point of the rows held (None = nothing loaded yet)
+        self.synced_at = None   # time.time() of the last sync with the server
+        self._payments = {}     # student id -> StudentPayment
+        self._debts = {}        # student id -> [DebtorRecord] in month order
+        self._views = {}        # (kind, search term, ...) -> (sorted keys, rows); dropped whenever rows change
+        self._local_ids = set() # students changed offline (apply_local), re-read at the next sync
+        self._file_since = None # sync point the SQLite file is at, when _file_current
+        self._file_current = False  # the file held what memory held at the last load/save
+        self._file_checked = False
+        self._lock = threading.Lock()       # the rows
+        self._sync_lock = threading.Lock()  # one sync at a time
+        self.stats = {"file_loads": 0, "full_loads": 0, "deltas": 0, "rows_fetched": 0}
+
+    @property
+    def ready(self):
+        return self.since is not None
+
+    @timed()
+    def sync(self):
+        """Brings the replica up to date; returns the IDs of the students re-read (None = everything).
+
+        The first call starts from the SQLite file, if there is one.
+        """
+        with self._sync_lock:
+            self._load_file_once()
+            delta = None
+            if self.since is not None:
+                delta = self.repo.changes_since(self.since, max_ids=max(MIN_DELTA_LIMIT, len(self._payments) // 4),
+                                                include=sorted(self._local_ids))
+            if delta is None:
+                since, payments, debts = self.repo.snapshot()
+                with self._lock:
+                    self._payments = {student.id: student for student in payments}
+                    self._debts = {}
+                    for debt in debts:
+                        self._debts.setdefault(debt.id, []).append(debt)
+                    self._views.clear(); self._local_ids.clear()
+                    self.since, self.synced_at = since, time.time()
+                self.stats["full_loads"] += 1; self.stats["rows_fetched"] += len(payments) + len(debts)
+                self._save()
+                return None
+            since, ids, payments, debts = delta
+            with self._lock:
+                for student_id in ids:
+                    self._payments.pop(student_id, None); self._debts.pop(student_id, None)
+                for student in payments:
+                    self._payments[student.id] = student
+                for debt in debts:
+                    self._debts.setdefault(debt.id, []).append(debt)
+                if ids:
+                    self._views.clear()
+                self._local_ids.difference_update(ids)
+                self.since, self.synced_at = since, time.time()
+            self.stats["deltas"] += 1; self.stats["rows_fetched"] += len(payments) + len(debts)
+            if ids:
+                self._save(ids)  # an unchanged file stays at its older sync point: it just replays a little more
+            return set(ids)
+
+    def load_local(self):
+        """Makes the SQLite copy (if any) readable without the server; True if it held a sync."""
+        with self._sync_lock:
+            self._load_file_once()
+        return self.ready
+
+    def apply_local(self, changes):
+        """Records changes made while offline: ``changes`` maps student id -> (StudentPayment or
+        None if removed, its open debts). They are saved to the file, and re-read at the next sync."""
+        with self._sync_lock:
+            self._load_file_once()
+            with self._lock:
+                for student_id, (student, debts) in changes.items():
+                    self._payments.pop(student_id, None); self._debts.pop(student_id, None)
+                    if student is not None:
+                        self._payments[student_id] = student
+                    if debts:
+                        self._debts[student_id] = sorted(debts, key=_debt_key)
+                self._views.clear()
+                self._local_ids.update(changes)
+            self._save(list(changes))
+
+    def open_debts(self, student_id):
+        with self._lock:
+            return list(self._debts.get(student_id, ()))
+
+    # --- Reads, shaped like the repositories' ---
+    def _view(self, kind, filter_term, aging=None, by_aging=False, reference=None):
+        """(sorted keys, rows) of the payments or open debts matching ``filter_term``, built once per change.
+
+        Debts can also be narrowed to an aging bucket and ordered by due date, as the repository does;
+        keys are only in order (for ``after_key``) in ID order."""
+        if aging is not None:
+            reference = reference or datetime.date.today()
+        key = (kind, filter_term or "", aging, by_aging, reference if aging is not None else None)
+        with self._lock:
+            view = self._views.get(key)
+            if view is None:
+                if kind == "payments":
+                    rows = [self._payments[student_id] for student_id in sorted(self._payments)]
+                else:
+                    rows = [debt for student_id in sorted(self._debts) for debt in self._debts[student_id]]
+                if filter_term:
+                    rows = [row for row in rows if matches_search(filter_term, row.id, row.student_name)]
+                if aging is not None:
+                    earliest, latest = aging_due_range(aging, reference)
+                    rows = [debt for debt in rows if (earliest is None or debt.due >= earliest) and (latest is None or debt.due <= latest)]
+                if by_aging:
+                    rows.sort(key=lambda debt: debt.due)  # stable: (ID, month) among equal dates, like the query
+                keys = [row.id for row in rows] if kind == "payments" else [_debt_key(debt) for debt in rows]
+                if len(self._views) >= MAX_VIEWS:
+                    self._views.clear()
+                view = self._views[key] = (keys, rows)
+        return view
+
+    def list_payments(self, filter_term=None):
+        return list(self._view("payments", filter_term)[1])
+
+    def count_payments(self, filter_term=None):
+        return len(self._view("payments", filter_term)[1])
+
+    def list_payments_page(self, filter_term=None, limit=200, offset=0, after_id=None):
+        keys, rows = self._view("payments", filter_term)
+        start = bisect.bisect_right(keys, after_id) if after_id is not None else offset
+        return rows[start:start + limit]
+
+    def get_student(self, student_id):
+        with self._lock:
+            return self._payments.get(student_id)
+
+    def list_open_debtors(self, filter_term=None, aging=None, by_aging=False, reference=None):
+        return list(self._view("debts", filter_term, aging, by_aging, reference)[1])
+
+    def count_open_debtors(self, filter_term=None, aging=None, reference=None):
+        return len(self._view("debts", filter_term, aging, False, reference)[1])
+
+    def list_open_debtors_page(self, filter_term=None, limit=200, offset=0, after_key=None, aging=None, by_aging=False, reference=None):
+        keys, rows = self._view("debts", filter_term, aging, by_aging, reference)
+        if after_key is not None and not by_aging:
+            start = bisect.bisect_right(keys, (after_key[0], MONTH_INDEX.get(after_key[1], 12) + 1))
+        else:
+            start = offset
+        return rows[start:start + limit]
+
+    # --- SQLite copy ---
+    def _load_file_once(self):
+        """Loads the file the first time the replica is used (under _sync_lock)."""
+        if not self._file_checked:
+            self._file_checked = True
+            self._load_file()
+
+    def _load_file(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with closing(sqlite3.connect(self.path)) as db:
+                meta = dict(db.execute("SELECT key, value FROM meta"))
+                if meta.get("format") != CACHE_FORMAT or meta.get("year") != str(self.year):
+                    return
+                payments = [_payment_from_sqlite(row) for row in db.execute("SELECT * FROM payments")]
+                payment_days = {student.id: student.payment_day for student in payments}
+                debts = [_debt_from_sqlite(row, self.year, payment_days.get(row[0]))
+                         for row in db.execute("SELECT * FROM debts ORDER BY student_id, month")]
+                # since is empty if the file was only ever written offline
+                since = int(meta["since"]) if meta["since"] else None
+                synced_at = float(meta["synced_at"]) if meta["synced_at"] else None
+                local_ids = set(json.loads(meta.get("local_ids") or "[]"))
+        except (sqlite3.Error, ValueError, KeyError) as e:
+            logger.warning("Ignoring local cache file %s: %s", self.path, e)
+            return
+        with self._lock:
+            self._payments = {student.id: student for student in payments}
+            self._debts = {}
+            for debt in debts:
+                self._debts.setdefault(debt.id, []).append(debt)
+            self._views.clear()
+            self._local_ids = local_ids
+            self.since, self.synced_at = since, synced_at
+        self._file_since, self._file_current = since, True
+        self.stats["file_loads"] += 1
+        logger.info("Local cache: %d students of %s loaded from %s", len(payments), self.year, self.path)
+
+    def _rows(self, ids=None):
+        """(payments, open debts) of the students ``ids`` (None = all), copied under the lock."""
+        with self._lock:
+            if ids is None:
+                return list(self._payments.values()), [debt for debts in self._debts.values() for debt in debts]
+            return ([self._payments[student_id] for student_id in ids if student_id in self._payments],
+                    [debt for student_id in ids for debt in self._debts.get(student_id, ())])
+
+    def _save(self, ids=None):
+        """Writes the replica to the SQLite file: only the students ``ids`` if the file holds
+        everything else as of the previous sync point, otherwise all of it. Runs inside ``sync``."""
+        if not self.path:
+            return
+        since, synced_at, local_ids = self.since, self.synced_at, sorted(self._local_ids)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with closing(sqlite3.connect(self.path, isolation_level=None)) as db:
+                for statement in SQLITE_SCHEMA:
+                    db.execute(statement)
+                db.execute("BEGIN IMMEDIATE")  # another instance saving the same file waits
+                try:
+                    meta = dict(db.execute("SELECT key, value FROM meta"))
+                    if not self._file_current or meta.get("format") != CACHE_FORMAT or meta.get("since") != _meta_value(self._file_since):
+                        ids = None  # never written, or moved on by another instance: write it whole
+                    payments, debts = self._rows(ids)
+                    if ids is None:
+                        db.execute("DELETE FROM payments"); db.execute("DELETE FROM debts")
+                    else:
+                        db.executemany("DELETE FROM payments WHERE id = ?", [(student_id,) for student_id in ids])
+                        db.executemany("DELETE FROM debts WHERE student_id = ?", [(student_id,) for student_id in ids])
+                    db.executemany("INSERT INTO payments VALUES (?, ?, ?, ?, ?, ?, ?, ?)", map(_payment_to_sqlite, payments))
+                    db.executemany("INSERT INTO debts VALUES (?, ?, ?, ?, ?, ?, ?, ?)", map(_debt_to_sqlite, debts))
+                    db.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                   [("format", CACHE_FORMAT), ("year", str(self.year)), ("since", _meta_value(since)),
+                                    ("synced_at", _meta_value(synced_at)), ("local_ids", json.dumps(local_ids))])
+                    db.execute("COMMIT")
+                except BaseException:
+                    if db.in_transaction: db.execute("ROLLBACK")
+                    raise
+            self._file_since, self._file_current = since, True
+        except (OSError, sqlite3.Error) as e:
+            self._file_current = False  # rolled back: the next save writes it whole
+            logger.warning("Could not write local cache file %s: %s", self.path, e)
@@ -0,0 +1,78 @@
+"""Money values: ``Decimal`` with two places from the database to the screen and back.
+
+psycopg2 already returns DECIMAL columns as ``Decimal``; this module keeps them
+that way (no float round-trips, so totals do not drift) and provides the BRL
+text conversions used by the tables, the forms and the display export.
+
+Grid refreshes format the same few hundred distinct amounts over and over
+(most students pay the same fee every month), so ``format_brl`` memoizes its
+results: a repeated amount costs one dictionary lookup.
+"""
+import re
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+
+Money = Decimal
+CENTS = Decimal("0.01")
+ZERO = Decimal("0.00")
+MAX_AMOUNT = Decimal("99999999.99")  # DECIMAL(10,2)
+
+# Marks the tables append to amounts ("270,18 ✅"); ignored when parsing
+_IGNORED_TEXT = ("✅", "❌", "R$", "\xa0", " ")
+# "1.500" is one thousand five hundred in BRL, not 1,50: a lone dot before exactly 3 digits groups thousands
+_THOUSANDS = re.compile(r"[+-]?\d{1,3}\.\d{3}")
+
+
+def to_money(value) -> Money:
+    """Any numeric value (or BRL/plain text) -> Decimal with 2 places; None -> 0,00."""
+    if value is None:
+        return ZERO
+    if isinstance(value, str):
+        return parse_brl(value)
+    if isinstance(value, float):
+        value = repr(value)  # shortest exact repr: 0.1 -> "0.1", not 0.1000000000000000055...
+    amount = Decimal(value)
+    if not amount.is_finite():
+        raise ValueError("valor monetário inválido")
+    try:
+        return amount.quantize(CENTS)
+    except InvalidOperation:
+        raise ValueError("valor monetário inválido") from None
+
+
+@lru_cache(maxsize=16384)
+def format_brl(value) -> str:
+    """Decimal (or None) -> "1234,56", the format of the tables and forms (no thousands separator)."""
+    if not value:
+        return "0,00"  # also None and -0.00
+    return f"{value:.2f}".replace(".", ",")
+
+
+@lru_cache(maxsize=4096)
+def parse_brl(text: str) -> Money:
+    """Amount typed or shown in a table -> Decimal with 2 places.
+
+    Accepts BRL ("1.234,56", "1.500", "R$ 10,00", "270,18 ✅") and plain ("1234.56") notation;
+    an empty text is 0,00. Raises ValueError if the text is not an amount or has more than
+    2 decimal places (nothing is rounded away).
+    """
+    for ignored in _IGNORED_TEXT:
+        text = text.replace(ignored, "")
+    if not text:
+        return ZERO
+    if "," in text:
+        text = text.replace(".", "").replace(",", ".")  # 1.234,56
+    elif text.count(".") > 1 or _THOUSANDS.fullmatch(text):
+        text = text.replace(".", "")  # 1.234.567, 1.500
+    try:
+        amount = Decimal(text)
+    except InvalidOperation:
+        raise ValueError("valor monetário inválido (use o formato 1.234,56)") from None
+    if not amount.is_finite():
+        raise ValueError("valor monetário inválido")
+    if amount.as_tuple().exponent < -2:
+        raise ValueError("valor monetário com mais de 2 casas decimais (use o formato 1.234,56)")
+    try:
+        return amount.quantize(CENTS)
+    except InvalidOperation:
+        raise ValueError("valor monetário inválido") from None
@@ -0,0 +1,128 @@
+"""Live change notifications between app instances (Postgres LISTEN/NOTIFY).
+
+Triggers created by ``database.setup_schema`` send a notification on
+``CHANGES_CHANNEL`` for every statement that changes students or
+student_months, naming the student IDs and years it touched. ``ChangeListener``
+keeps one dedicated connection LISTENing on a background thread and merges
+what arrives until the GUI collects it with ``drain``; the GUI then re-reads
+only those students' rows instead of reloading whole tables.
+
+Notifications caused by this process's own writes (same ``CLIENT_ID``) are
+skipped: the GUI has already patched those rows. So are those from other
+schemas of the same database (e.g. the benchmark's). If the listening connection
+drops, it reconnects and reports "everything changed", since notifications sent
+while it was away are lost.
+"""
+import json
+import logging
+import select
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+from database import CHANGES_CHANNEL, CLIENT_ID, DB_CONFIG
+
+logger = logging.getLogger("pagamentos.notifications")
+
+
+class PendingChanges:
+    """Changes merged since the last ``drain``: student IDs per year, or a full reload."""
+
+    def __init__(self):
+        self.everything = False
+        self.ids_by_year = {}  # year (None = every year) -> set of student ids
+
+    def add(self, ids, years):
+        if ids is None:
+            self.everything = True; return
+        for year in years or (None,):
+            self.ids_by_year.setdefault(year, set()).update(ids)
+
+    def ids_for(self, year):
+        """Student IDs whose rows for ``year`` may have changed."""
+        return self.ids_by_year.get(year, set()) | self.ids_by_year.get(None, set())
+
+    def __bool__(self):
+        return self.everything or bool(self.ids_by_year)
+
+
+class ChangeListener:
+    """Background LISTEN on the change channel; thread-safe ``drain`` for the Tk thread."""
+
+    def __init__(self, conn_kwargs=None, channel=CHANGES_CHANNEL, client_id=CLIENT_ID, retry_interval=5.0):
+        self.conn_kwargs = dict(conn_kwargs or DB_CONFIG)
+        self.conn_kwargs["application_name"] = f"{client_id}-listen"
+        self.channel = channel
+        self.client_id = client_id
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._pending = PendingChanges()
+        self._stop = threading.Event()
+        self._thread = None
+        self.schema = None  # current_schema() of the listening connection, where the app's tables are
+        self.stats = {"received": 0, "own": 0, "reconnects": 0}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="db-listen", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+
+    def drain(self):
+        """Returns the changes merged since the previous call (a falsy PendingChanges if none)."""
+        with self._lock:
+            pending, self._pending = self._pending, PendingChanges()
+        return pending
+
+    def handle(self, payload):
+        """Merges one notification payload (JSON from the notify_changes trigger)."""
+        try:
+            change = json.loads(payload)
+        except ValueError:
+            logger.warning("Ignoring malformed change notification: %s", payload[:200])
+            return
+        with self._lock:
+            self.stats["received"] += 1
+            if change.get("origin") == self.client_id:
+                self.stats["own"] += 1; return
+            if change.get("schema") != self.schema: return
+            self._pending.add(change.get("ids"), change.get("years"))
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.conn_kwargs)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cur:
+            cur.execute("SELECT current_schema()")
+            self.schema = cur.fetchone()[0]
+            cur.execute(f'LISTEN "{self.channel}"')
+        return conn
+
+    def _run(self):
+        conn = None
+        while not self._stop.is_set():
+            try:
+                if conn is None:
+                    conn = self._connect()
+                if select.select([conn], [], [], 1.0) == ([], [], []):
+                    continue  # timeout: check _stop again
+                conn.poll()
+                while conn.notifies:
+                    self.handle(conn.notifies.pop(0).payload)
+            except (psycopg2.Error, OSError) as e:
+                if conn is not None:
+                    logger.warning("Change listener lost its connection (%s); reconnecting in %.0fs", e, self.retry_interval)
+                    try: conn.close()
+                    except psycopg2.Error: pass
+                    conn = None
+                    with self._lock:
+                        self.stats["reconnects"] += 1
+                        self._pending.everything = True  # notifications sent meanwhile are lost
+                self._stop.wait(self.retry_interval)
+        if conn is not None:
+            conn.close()
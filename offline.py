@@ -0,0 +1,406 @@
+"""Offline mode: work from the local replica while the server is unreachable, replay later.
+
+When Postgres cannot be reached the app keeps going on the year's replica (the SQLite
+copy kept by local_cache.py). ``OfflineStore`` stands in for PaymentsRepository and
+DebtorsRepository: reads come from the replica, and every mutation (add / update /
+remove student, month statuses, debtor edits) is first appended to ``OfflineQueue``,
+a SQLite journal next to the replica files, then applied to the replica so the tabs
+show it.
+
+When the connection returns, ``replay`` sends the journal to the server in order,
+``REPLAY_BATCH`` changes at a time (each change is its own transaction; a batch is
+removed from the journal once sent). Changes carry what they were based on: the
+record the edit started from, or the debtor entry's version, exactly as the online
+saves do (see ``ConcurrentUpdateError``). A change the server has moved past is a
+conflict: it stays in the journal, with every later change to the same students, for
+the user to overwrite (``replay(force=True)``) or discard. A second change to a student
+already changed offline is checked against the server as the first one left it.
+
+A connection lost while a change is being committed leaves it in the journal even if
+the server applied it; its replay then reports a conflict, which can be discarded.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from decimal import Decimal
+from typing import List, NamedTuple, Optional, Tuple
+
+import psycopg2
+
+from database import ensure_year_partition, get_pool
+from instrumentation import timed
+from local_cache import cache_directory, database_key
+from repository import (MONTH_CODES, MONTH_INDEX, MONTH_NAMES, NO_STATUSES, OPEN_DEBT_STATUSES, ConcurrentUpdateError,
+                        DebtorRecord, DebtorsRepository, PaymentsRepository, StudentPayment, due_date)
+
+logger = logging.getLogger("pagamentos.offline")
+
+REPLAY_BATCH = 100
+
+QUEUE_SCHEMA = """CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT, year INTEGER NOT NULL, op TEXT NOT NULL, student_ids TEXT NOT NULL,
+    payload TEXT NOT NULL, chained INTEGER NOT NULL, queued_at REAL NOT NULL, conflict TEXT)"""
+
+# How a queued change is named in the conflict dialog
+OP_LABELS = {
+    "add_student": "Adicionar aluno", "update_student": "Atualizar aluno", "delete_student": "Remover aluno",
+    "set_status": "Status do mês", "mark_month": "Marcação em lote", "update_debtor": "Atualizar débito",
+    "delete_debtor": "Remover débito",
+}
+
+
+def _student_to_json(student):
+    if student is None:
+        return None
+    return {"id": student.id, "payment_day": student.payment_day, "student_name": student.student_name,
+            "course": student.course, "discount": str(student.discount), "months": [str(amount) for amount in student.months],
+            "statuses": list(student.statuses), "version": student.version}
+
+
+def _student_from_json(data):
+    if data is None:
+        return None
+    return StudentPayment(data["id"], data["payment_day"], data["student_name"], data["course"], Decimal(data["discount"]),
+                          tuple(map(Decimal, data["months"])), tuple(data["statuses"]), data["version"])
+
+
+def _replace_at(values, index, value):
+    return values[:index] + (value,) + values[index + 1:]
+
+
+def _local_rows(year, student, previous_debts=(), comments=None):
+    """(student, open debts) after a change made offline: one DebtorRecord per month with an
+    open status, keeping the comment and version of the entries it already had."""
+    known = {debt.month: debt for debt in previous_debts}
+    debts = []
+    for number, (code, amount, status) in enumerate(zip(MONTH_CODES, student.months, student.statuses), 1):
+        if status not in OPEN_DEBT_STATUSES:
+            continue
+        month = MONTH_NAMES[code]; old = known.get(month)
+        comment = (comments or {}).get(month, old.comment if old else "")
+        debts.append(DebtorRecord(student.id, student.student_name, student.course, month, amount, status, comment,
+                                  old.version if old else None, due_date(year, number, student.payment_day)))
+    return student, debts
+
+
+class QueuedChange(NamedTuple):
+    seq: int
+    year: int
+    op: str                  # key of OP_LABELS
+    student_ids: Tuple[int, ...]
+    payload: dict
+    chained: bool            # an earlier queued change touched the same students
+    conflict: Optional[str]  # why the last replay did not apply it (None = not tried / pending)
+
+    def describe(self) -> str:
+        ids = ", ".join(map(str, self.student_ids[:5])) + (f" e mais {len(self.student_ids) - 5}" if len(self.student_ids) > 5 else "")
+        month = self.payload.get("month_name") or MONTH_NAMES.get(self.payload.get("month"))
+        return f"{OP_LABELS.get(self.op, self.op)} {ids}" + (f" ({month}/{self.year})" if month else f" ({self.year})")
+
+
+class OfflineQueue:
+    """Durable, ordered journal of the changes made offline (a SQLite file). Thread-safe."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with closing(sqlite3.connect(path)) as db, db:
+            db.execute(QUEUE_SCHEMA)
+            rows = db.execute("SELECT student_ids FROM changes").fetchall()
+        self._count = len(rows)
+        self._touched = {student_id for ids, in rows for student_id in json.loads(ids)}  # students with queued changes
+
+    def __len__(self):
+        return self._count
+
+    def append(self, year, op, student_ids, payload):
+        """Journals one change (committed to disk before returning); returns its sequence number."""
+        with self._lock, closing(sqlite3.connect(self.path)) as db, db:
+            chained = not self._touched.isdisjoint(student_ids)
+            seq = db.execute("INSERT INTO changes (year, op, student_ids, payload, chained, queued_at) VALUES (?, ?, ?, ?, ?, ?)",
+                             (year, op, json.dumps(list(student_ids)), json.dumps(payload), int(chained), time.time())).lastrowid
+            self._count += 1; self._touched.update(student_ids)
+        return seq
+
+    def changes(self, after=0, limit=None):
+        """Queued changes in the order they were made, starting after sequence number ``after``."""
+        with self._lock, closing(sqlite3.connect(self.path)) as db:
+            rows = db.execute("SELECT seq, year, op, student_ids, payload, chained, conflict FROM changes WHERE seq > ? ORDER BY seq LIMIT ?",
+                              (after, -1 if limit is None else limit)).fetchall()
+        return [QueuedChange(seq, year, op, tuple(json.loads(ids)), json.loads(payload), bool(chained), conflict)
+                for seq, year, op, ids, payload, chained, conflict in rows]
+
+    def conflicts(self):
+        return [change for change in self.changes() if change.conflict is not None]
+
+    def remove(self, seqs):
+        """Drops changes (sent, or discarded by the user)."""
+        if not seqs:
+            return
+        with self._lock, closing(sqlite3.connect(self.path)) as db, db:
+            db.executemany("DELETE FROM changes WHERE seq = ?", [(seq,) for seq in seqs])
+            self._count = db.execute("SELECT COUNT(*) FROM changes").fetchone()[0]
+            if not self._count:
+                self._touched.clear()  # later changes are based on server data again
+
+    def set_conflicts(self, conflicts):
+        """Records why the changes {seq: reason} were not applied."""
+        if not conflicts:
+            return
+        with self._lock, closing(sqlite3.connect(self.path)) as db, db:
+            db.executemany("UPDATE changes SET conflict = ? WHERE seq = ?", [(reason, seq) for seq, reason in conflicts.items()])
+
+
+def offline_queue_for(conn_kwargs=None):
+    """The journal for the database ``conn_kwargs`` points at, next to the replica files; None
+    when the local cache is off (PAGAMENTOS_CACHE=0, or no cache directory): no offline mode."""
+    directory = cache_directory()
+    if os.environ.get("PAGAMENTOS_CACHE", "1") == "0" or not directory:
+        return None
+    path = os.path.join(directory, f"queue-{database_key(conn_kwargs)}.sqlite3")
+    try:
+        return OfflineQueue(path)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning("Offline mode unavailable, could not open %s: %s", path, e)
+        return None
+
+
+class OfflineStore:
+    """PaymentsRepository / DebtorsRepository stand-in over a LocalCache while offline.
+
+    Reads are answered by the replica; mutations return what the repository methods
+    return, are journaled in ``queue`` and applied to the replica.
+    """
+
+    def __init__(self, cache, queue):
+        self.cache = cache
+        self.queue = queue
+
+    @property
+    def year(self):
+        return self.cache.year
+
+    def _record(self, op, student_ids, payload, changes):
+        self.queue.append(self.year, op, student_ids, payload)  # the journal first: it is what gets replayed
+        self.cache.apply_local(changes)
+
+    def _student(self, student_id):
+        self.cache.load_local()
+        return self.cache.get_student(student_id)
+
+    # --- Reads ---
+    def list_payments(self, filter_term=None):
+        self.cache.load_local(); return self.cache.list_payments(filter_term)
+
+    def iter_payments(self, filter_term=None, batch_size=None):
+        return iter(self.list_payments(filter_term))
+
+    def count_payments(self, filter_term=None):
+        self.cache.load_local(); return self.cache.count_payments(filter_term)
+
+    def list_payments_page(self, filter_term=None, limit=200, offset=0, after_id=None):
+        self.cache.load_local(); return self.cache.list_payments_page(filter_term, limit, offset, after_id)
+
+    def get_student(self, student_id):
+        return self._student(student_id)
+
+    def exists(self, student_id):
+        return self._student(student_id) is not None
+
+    def is_empty(self):
+        return not self.count_payments()
+
+    def next_free_id(self, low=1001, high=9999):
+        """Smallest ID in [low, high] the replica does not use (the server may know better: a clash is a conflict at replay)."""
+        self.cache.load_local()
+        used = {student.id for student in self.cache.list_payments()}
+        return next((student_id for student_id in range(low, high + 1) if student_id not in used), None)
+
+    def list_open_debtors(self, filter_term=None, aging=None, by_aging=False, reference=None):
+        self.cache.load_local(); return self.cache.list_open_debtors(filter_term, aging, by_aging, reference)
+
+    def iter_open_debtors(self, filter_term=None, batch_size=None, aging=None, by_aging=False, reference=None):
+        return iter(self.list_open_debtors(filter_term, aging, by_aging, reference))
+
+    def count_open_debtors(self, filter_term=None, aging=None, reference=None):
+        self.cache.load_local(); return self.cache.count_open_debtors(filter_term, aging, reference)
+
+    def list_open_debtors_page(self, filter_term=None, limit=200, offset=0, after_key=None, aging=None, by_aging=False, reference=None):
+        self.cache.load_local(); return self.cache.list_open_debtors_page(filter_term, limit, offset, after_key, aging, by_aging, reference)
+
+    def get_debtor(self, student_id, month_name):
+        """The open entry of (student, month), or None (the replica keeps only open debts)."""
+        self.cache.load_local()
+        return next((debt for debt in self.cache.open_debts(student_id) if debt.month == month_name), None)
+
+    # --- Mutations (journaled) ---
+    @timed()
+    def add_student(self, student):
+        student = student._replace(statuses=NO_STATUSES, version=None)
+        self._record("add_student", [student.id], {"student": _student_to_json(student)}, {student.id: _local_rows(self.year, student)})
+
+    @timed()
+    def update_student(self, student, expected=None):
+        current = self._student(student.id)
+        if current is None:
+            return False
+        # As on the server: months at zero lose their status, other statuses are kept
+        statuses = tuple(status if amount > 0 else None for amount, status in zip(student.months, current.statuses))
+        updated = student._replace(statuses=statuses, version=current.version)
+        self._record("update_student", [student.id], {"student": _student_to_json(student), "expected": _student_to_json(expected)},
+                     {student.id: _local_rows(self.year, updated, self.cache.open_debts(student.id))})
+        return True
+
+    @timed()
+    def delete_student(self, student_id):
+        if self._student(student_id) is None:
+            return 0
+        self._record("delete_student", [student_id], {}, {student_id: (None, [])})
+        return 1
+
+    @timed()
+    def upsert_debtor_status(self, student_id, month_name, amount, status, expected=None):
+        current = self._student(student_id)
+        if current is None:
+            return  # removed (offline) since it was shown: nothing to mark
+        i = MONTH_INDEX[month_name]
+        updated = current._replace(months=_replace_at(current.months, i, amount), statuses=_replace_at(current.statuses, i, status))
+        self._record("set_status", [student_id], {"month_name": month_name, "amount": str(amount), "status": status,
+                                                  "expected": _student_to_json(expected)},
+                     {student_id: _local_rows(self.year, updated, self.cache.open_debts(student_id))})
+
+    @timed()
+    def mark_month(self, month_code, status, student_ids=None, filter_term=None):
+        """Marks the month for the students the replica has; journaled with their IDs, so the
+        replay marks these students (not whoever matches the search on the server by then)."""
+        if month_code not in MONTH_CODES:
+            raise ValueError(f"Unknown month code: {month_code!r}")
+        i = MONTH_CODES.index(month_code)
+        if student_ids is None:
+            students = self.list_payments(filter_term)
+        else:
+            students = [student for student in map(self._student, student_ids) if student is not None]
+        students = [student for student in students if student.months[i] > 0]
+        changes = {student.id: _local_rows(self.year, student._replace(statuses=_replace_at(student.statuses, i, status)), self.cache.open_debts(student.id))
+                   for student in students}
+        if changes:
+            expected = {str(student.id): [str(student.months[i]), student.statuses[i]] for student in students}
+            self._record("mark_month", sorted(changes), {"month": month_code, "status": status, "expected": expected}, changes)
+        return len(changes)
+
+    @timed()
+    def update_debtor(self, student_id, month_name, status, comment, amount, version=None):
+        current = self._student(student_id); i = MONTH_INDEX[month_name]
+        if current is None or (current.statuses[i] is None and not current.months[i] > 0):
+            return 0  # no such (student, month) row
+        updated = current._replace(months=_replace_at(current.months, i, amount), statuses=_replace_at(current.statuses, i, status))
+        self._record("update_debtor", [student_id], {"month_name": month_name, "status": status, "comment": comment,
+                                                     "amount": str(amount), "version": version},
+                     {student_id: _local_rows(self.year, updated, self.cache.open_debts(student_id), comments={month_name: comment})})
+        return 1
+
+    @timed()
+    def delete_debtor(self, student_id, month_name, version=None):
+        current = self._student(student_id); i = MONTH_INDEX[month_name]
+        if current is None or current.statuses[i] is None:
+            return 0
+        updated = current._replace(statuses=_replace_at(current.statuses, i, None))
+        self._record("delete_debtor", [student_id], {"month_name": month_name, "version": version},
+                     {student_id: _local_rows(self.year, updated, self.cache.open_debts(student_id))})
+        return 1
+
+
+# --- Replay ---
+class ReplayResult(NamedTuple):
+    applied: int                    # changes sent (or found to be no longer needed)
+    conflicts: List[QueuedChange]   # kept in the queue, to overwrite or discard
+
+
+def _send(change, pool, force):
+    """Writes one queued change to the server; returns why it conflicts (None = done)."""
+    payload, student_id = change.payload, change.student_ids[0]
+    payments, debtors = PaymentsRepository(pool, year=change.year), DebtorsRepository(pool, year=change.year)
+    try:
+        if change.op == "add_student":
+            student = _student_from_json(payload["student"])
+            if not force and payments.exists(student.id):
+                return "o ID já existe no servidor"
+            if not (force and payments.update_student(student)):
+                payments.add_student(student)
+        elif change.op == "update_student":
+            student, expected = _student_from_json(payload["student"]), None if force else _student_from_json(payload["expected"])
+            if expected is not None and change.chained:
+                # Based on an earlier offline change: check against the row as that change left it
+                current = payments.get_student(student_id)
+                if current is None:
+                    return "aluno removido no servidor"
+                expected = expected._replace(version=current.version)
+            if not payments.update_student(student, expected=expected) and not force:
+                return "aluno removido no servidor"
+        elif change.op == "delete_student":
+            payments.delete_student(student_id)
+        elif change.op == "set_status":
+            debtors.upsert_debtor_status(student_id, payload["month_name"], Decimal(payload["amount"]), payload["status"],
+                                         expected=None if force else _student_from_json(payload["expected"]))
+        elif change.op == "mark_month":
+            expected = None if force or "expected" not in payload else {  # journals written before the check have none
+                int(student_id): (Decimal(amount), status) for student_id, (amount, status) in payload["expected"].items()}
+            debtors.mark_month(payload["month"], payload["status"], student_ids=list(change.student_ids), expected=expected)
+        elif change.op in ("update_debtor", "delete_debtor"):
+            month_name, version = payload["month_name"], None if force else payload["version"]
+            if version is not None and change.chained:
+                current = debtors.get_debtor(student_id, month_name)
+                version = current.version if current is not None else version
+            if change.op == "delete_debtor":
+                debtors.delete_debtor(student_id, month_name, version=version)  # 0 rows: already off the list
+            elif not debtors.update_debtor(student_id, month_name, payload["status"], payload["comment"],
+                                           Decimal(payload["amount"]), version=version) and not force:
+                return "registro não existe mais no servidor"
+        else:
+            raise ValueError(f"Unknown queued change: {change.op!r}")
+    except ConcurrentUpdateError:
+        return "alterado em outra estação"
+    except (psycopg2.IntegrityError, psycopg2.DataError) as e:
+        return f"recusado pelo servidor ({e.pgerror or e})".strip()
+    return None
+
+
+@timed("offline.replay")
+def replay(queue, pool=None, force=False, batch_size=REPLAY_BATCH, progress=None):
+    """Sends the journal to the server in order, ``batch_size`` changes at a time.
+
+    Conflicting changes (and later changes to the same students) stay in the journal with
+    their reason; ``force`` writes every change unconditionally instead. ``progress(done,
+    total)`` is called after each batch. A lost connection raises, leaving what was not
+    sent in the journal.
+    """
+    pool = pool or get_pool()
+    total, done, applied, after = len(queue), 0, 0, 0
+    blocked, years = set(), set()
+    while True:
+        batch = queue.changes(after=after, limit=batch_size)
+        if not batch:
+            break
+        sent, conflicts = [], {}
+        try:
+            for change in batch:
+                if change.year not in years:
+                    ensure_year_partition(pool, change.year); years.add(change.year)
+                reason = "depende de uma alteração em conflito" if not force and not blocked.isdisjoint(change.student_ids) else _send(change, pool, force)
+                if reason is None:
+                    sent.append(change.seq)
+                else:
+                    conflicts[change.seq] = reason; blocked.update(change.student_ids)
+        finally:
+            queue.remove(sent); queue.set_conflicts(conflicts)
+        applied += len(sent); done += len(batch); after = batch[-1].seq
+        if progress is not None:
+            progress(done, total)
+    if applied or blocked:
+        logger.info("Offline changes replayed: %d applied, %d in conflict", applied, len(queue))
+    return ReplayResult(applied, queue.conflicts())
@@ -0,0 +1,836 @@
+"""Data-access layer for student payments and debtors.
+
+All SQL used by the application lives here so the query paths can be driven
+(and benchmarked) without Tkinter. Every public method is timed (``@timed``, see
+instrumentation.py) under "<Class>.<method>". Methods raise the underlying psycopg2 /
+``database.PoolError`` exceptions; presenting errors is the caller's job.
+"""
+import calendar
+import csv
+import datetime
+import io
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+import psycopg2
+
+from database import ACCENTED_CHARS, PLAIN_CHARS, get_pool
+from instrumentation import timed
+from money import ZERO, Money, to_money
+
+MONTH_CODES = ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec")
+MONTH_NAMES = {
+    "jan": "Janeiro", "feb": "Fevereiro", "mar": "Março", "apr": "Abril", "may": "Maio", "jun": "Junho",
+    "jul": "Julho", "aug": "Agosto", "sep": "Setembro", "oct": "Outubro", "nov": "Novembro", "dec": "Dezembro",
+}
+MONTH_INDEX = {MONTH_NAMES[code]: i for i, code in enumerate(MONTH_CODES)}  # 'Janeiro' -> 0
+OPEN_DEBT_STATUSES = ("Pendente", "Em Negociação")
+# Debt aging: days past the due date, grouped as on the Devedores tab. Each bucket is a
+# (first, last) range of days overdue; None = unbounded ("A vencer" = not due yet).
+AGING_RANGES = {"A vencer": (None, -1), "0–30": (0, 30), "31–60": (31, 60), "61–90": (61, 90), "90+": (91, None)}
+AGING_BUCKETS = tuple(AGING_RANGES)
+
+PAYMENT_COLUMNS = ("id", "payment_day", "student_name", "course", "discount") + MONTH_CODES
+
+
+NO_STATUSES = (None,) * len(MONTH_CODES)
+
+
+class ConcurrentUpdateError(Exception):
+    """Another client changed the row after it was read; nothing was written."""
+
+    def __init__(self, student_id: int, month_name: Optional[str] = None):
+        self.student_id = student_id
+        self.month_name = month_name
+        super().__init__(f"student {student_id}" + (f", {month_name}" if month_name else "") + " was changed by another client")
+
+
+class StudentPayment(NamedTuple):
+    id: int
+    payment_day: int
+    student_name: str
+    course: str
+    discount: Money
+    months: Tuple[Money, ...]  # 12 base amounts, January first
+    statuses: Tuple[Optional[str], ...] = NO_STATUSES  # debtor status per month (None = no entry)
+    version: Optional[int] = None  # students.version when read (None = not read from the database)
+
+    @classmethod
+    def from_row(cls, row: Sequence) -> "StudentPayment":
+        """Builds from ``PAYMENT_COLUMNS`` order, optionally followed by the 12 month statuses and the version."""
+        statuses = tuple(row[17:29]) if len(row) >= 29 else NO_STATUSES
+        return cls(row[0], row[1], row[2], row[3], row[4], tuple(row[5:17]), statuses, row[29] if len(row) > 29 else None)
+
+    def month_amount(self, month_code: str) -> Money:
+        return self.months[MONTH_CODES.index(month_code)]
+
+    def month_status(self, month_code: str) -> Optional[str]:
+        return self.statuses[MONTH_CODES.index(month_code)]
+
+
+class DebtorRecord(NamedTuple):
+    id: int
+    student_name: str
+    course: str
+    month: str
+    amount: Money
+    status: str
+    comment: str
+    version: Optional[int] = None  # student_months.version when read
+    due: Optional[datetime.date] = None  # due date of the month (see due_date)
+
+
+class SummaryRow(NamedTuple):
+    label: str          # month name, course, or "Total"
+    billed: Money       # every amount
+    received: Money     # status 'Pago'
+    outstanding: Money  # status 'Pendente' or 'Em Negociação'
+    open_count: int     # student-months outstanding
+
+
+_FOLD_TABLE = str.maketrans(ACCENTED_CHARS, PLAIN_CHARS)
+
+
+def fold_name(text: Optional[str]) -> str:
+    """Python mirror of the ``fold_name`` SQL function: lower case, accents stripped."""
+    return (text or "").lower().translate(_FOLD_TABLE)
+
+
+def due_date(year: int, month: int, payment_day: Optional[int]) -> datetime.date:
+    """Python mirror of the ``due_date`` SQL function: the month's ``payment_day``, capped at its last day (1st if None)."""
+    return datetime.date(year, month, min(max(payment_day or 1, 1), calendar.monthrange(year, month)[1]))
+
+
+def days_overdue(due: datetime.date, reference: Optional[datetime.date] = None) -> int:
+    """Days from ``due`` to ``reference`` (default today); negative while not due yet."""
+    return ((reference or datetime.date.today()) - due).days
+
+
+def aging_bucket(days: int) -> str:
+    """The AGING_BUCKETS label of ``days`` overdue."""
+    return next(label for label, (first, last) in AGING_RANGES.items()
+                if (first is None or days >= first) and (last is None or days <= last))
+
+
+def format_overdue(due: Optional[datetime.date], reference: Optional[datetime.date] = None) -> str:
+    """Days overdue as shown on the Devedores tab ("A vencer" before the due date)."""
+    if due is None:
+        return ""
+    days = days_overdue(due, reference)
+    return str(days) if days >= 0 else "A vencer"
+
+
+def aging_due_range(aging: str, reference: Optional[datetime.date] = None) -> Tuple[Optional[datetime.date], Optional[datetime.date]]:
+    """(earliest, latest) due date of the debts in bucket ``aging`` on ``reference`` (None = unbounded)."""
+    try:
+        first, last = AGING_RANGES[aging]
+    except KeyError:
+        raise ValueError(f"Unknown aging bucket: {aging!r}") from None
+    reference = reference or datetime.date.today()
+    return (None if last is None else reference - datetime.timedelta(days=last),
+            None if first is None else reference - datetime.timedelta(days=first))
+
+
+def is_id_term(term: str) -> bool:
+    """True for an ID search: ASCII digits only ("１２" or "²" are not IDs, and int() rejects some of them)."""
+    return term.isascii() and term.isdigit()
+
+
+def _like_pattern(term: str) -> str:
+    """``%term%`` with LIKE wildcards in the term escaped, so "_" and "%" match literally."""
+    return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def _search_clause(filter_term: Optional[str], alias: str = "") -> Tuple[str, list]:
+    """WHERE fragment for the "Buscar por Nome/ID" bars: exact ID or accent/case-insensitive name substring.
+
+    The name form matches the ``fold_name(student_name)`` trigram indexes created by ``setup_schema``.
+    """
+    if not filter_term:
+        return "", []
+    prefix = f"{alias}." if alias else ""
+    if is_id_term(filter_term):
+        return f"{prefix}id = %s", [int(filter_term)]
+    return f"fold_name({prefix}student_name) LIKE %s", [_like_pattern(fold_name(filter_term))]
+
+
+def matches_search(filter_term: Optional[str], student_id: int, student_name: str) -> bool:
+    """Python mirror of ``_search_clause``, used to decide if a changed row belongs in a filtered view."""
+    if not filter_term:
+        return True
+    if is_id_term(filter_term):
+        return student_id == int(filter_term)
+    return fold_name(filter_term) in fold_name(student_name)
+
+
+# Payments grid: one student_months row per (student, year, month) pivoted back into the
+# 12 amount + 12 status columns of the grid, so the whole grid (marks included) comes from a
+# single query. The full grid joins one grouped pass over the year's rows; filtered searches
+# and pages use a LATERAL per-student lookup on the (student_id, year, month) primary key.
+# Both take the year as their first query parameter.
+_MONTH_PIVOT = ", ".join(
+    [f"COALESCE(MAX(amount) FILTER (WHERE month = {i + 1}), 0.00) AS {code}" for i, code in enumerate(MONTH_CODES)]
+    + [f"MAX(status) FILTER (WHERE month = {i + 1}) AS {code}_status" for i, code in enumerate(MONTH_CODES)])
+_GRID_SELECT = (f"SELECT s.id, s.payment_day, s.student_name, s.course, s.discount, "
+                f"{', '.join(f'COALESCE(m.{code}, 0.00)' for code in MONTH_CODES)}, {', '.join(f'm.{code}_status' for code in MONTH_CODES)}, s.version")
+PAYMENTS_GRID_QUERY = f"""{_GRID_SELECT}
+    FROM students s
+    LEFT JOIN (SELECT student_id, {_MONTH_PIVOT} FROM student_months WHERE year = %s GROUP BY student_id) m ON m.student_id = s.id"""
+_MONTHS_LATERAL = f"LEFT JOIN LATERAL (SELECT {_MONTH_PIVOT} FROM student_months x WHERE x.student_id = s.id AND x.year = %s) m ON true"
+PAYMENTS_GRID_LOOKUP_QUERY = f"""{_GRID_SELECT}
+    FROM students s
+    {_MONTHS_LATERAL}"""
+
+# Devedores tab: open debts of a year in (student, month) order, i.e. the order of student_months_open_idx,
+# or oldest due date first (_AGING_ORDER). Aging filters and sorts on the due date: for a reference
+# date, days overdue decrease as it increases, so a bucket is a due-date range (aging_due_range).
+_DUE_DATE = "due_date(m.year, m.month, s.payment_day)"
+_DEBT_COLUMNS = f"m.student_id, s.student_name, s.course, m.month, m.amount, m.status, m.comment, m.version, {_DUE_DATE}"
+_OPEN_DEBTS_QUERY = f"""SELECT {_DEBT_COLUMNS}
+    FROM student_months m JOIN students s ON s.id = m.student_id
+    WHERE m.year = %s AND m.status IN ('{OPEN_DEBT_STATUSES[0]}', '{OPEN_DEBT_STATUSES[1]}')"""
+_ID_ORDER = " ORDER BY m.student_id, m.month"
+_AGING_ORDER = f" ORDER BY {_DUE_DATE}, m.student_id, m.month"
+
+
+def month_number(month_name: str) -> int:
+    """'Janeiro' -> 1 ... 'Dezembro' -> 12 (the ``student_months.month`` value)."""
+    try:
+        return MONTH_INDEX[month_name] + 1
+    except KeyError:
+        raise ValueError(f"Unknown month name: {month_name!r}") from None
+
+
+def _debtor_from_row(row: Sequence) -> DebtorRecord:
+    return DebtorRecord(row[0], row[1], row[2], MONTH_NAMES[MONTH_CODES[row[3] - 1]], row[4], row[5], row[6],
+                        row[7] if len(row) > 7 else None, row[8] if len(row) > 8 else None)
+
+
+class _CopySource:
+    """Read-only file object that feeds ``copy_expert`` CSV lines from an iterator of rows.
+
+    Rows are encoded as they are read, so a COPY of any size holds only one buffer in memory.
+    An exception raised by the iterator aborts the COPY and is kept in ``error``.
+    """
+
+    def __init__(self, rows: Iterable[Sequence]):
+        self._rows = iter(rows)
+        self._out = io.StringIO()
+        self._writer = csv.writer(self._out, lineterminator="\n")
+        self._buffer = ""
+        self.error = None
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._buffer) < size:
+            try:
+                row = next(self._rows, None)
+            except Exception as e:
+                self.error = e
+                raise
+            if row is None:
+                break
+            self._writer.writerow(row)  # None -> empty unquoted field -> NULL
+            self._buffer += self._out.getvalue()
+            self._out.seek(0); self._out.truncate()
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class _Repository:
+    """Base class: uses the given pool, or the shared one (resolved lazily, on first query).
+
+    Month data is read and written for ``year`` (default: the current year).
+    """
+
+    def __init__(self, pool=None, year: Optional[int] = None):
+        self._pool = pool
+        self.year = year or datetime.date.today().year
+
+    @property
+    def pool(self):
+        return self._pool or get_pool()
+
+
+class PaymentsRepository(_Repository):
+    """Queries and mutations on ``students`` and their ``student_months`` amounts."""
+
+    def _grid_query(self, filter_term: Optional[str]) -> Tuple[str, list]:
+        clause, params = _search_clause(filter_term, alias="s")
+        if clause:
+            return PAYMENTS_GRID_LOOKUP_QUERY + " WHERE " + clause, [self.year] + params
+        return PAYMENTS_GRID_QUERY, [self.year]
+
+    @timed()
+    def list_payments(self, filter_term: Optional[str] = None) -> List[StudentPayment]:
+        """Students (optionally filtered) with their per-month amounts and statuses, in one query."""
+        query, params = self._grid_query(filter_term)
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(query + " ORDER BY s.id", params)
+            return [StudentPayment.from_row(row) for row in cur.fetchall()]
+
+    @timed()
+    def iter_payments(self, filter_term: Optional[str] = None, batch_size: int = 5000) -> Iterator[StudentPayment]:
+        """Streams the same rows as ``list_payments`` through a server-side cursor (for exports).
+
+        Only ``batch_size`` rows are in memory at a time; the pooled connection stays
+        checked out until the iterator is exhausted or closed.
+        """
+        query, params = self._grid_query(filter_term)
+        with self.pool.connection() as conn, conn.cursor(name="stream_payments") as cur:
+            cur.itersize = batch_size
+            cur.execute(query + " ORDER BY s.id", params)
+            for row in cur:
+                yield StudentPayment.from_row(row)
+
+    @timed()
+    def count_payments(self, filter_term: Optional[str] = None) -> int:
+        clause, params = _search_clause(filter_term)
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM students" + (" WHERE " + clause if clause else ""), params)
+            return cur.fetchone()[0]
+
+    @timed()
+    def list_payments_page(self, filter_term: Optional[str] = None, limit: int = 200, offset: int = 0,
+                           after_id: Optional[int] = None) -> List[StudentPayment]:
+        """One page of the payments grid in ID order.
+
+        With ``after_id`` the page is found by keyset pagination (``id > after_id``,
+        an index range scan) and ``offset`` is ignored; OFFSET is only used for jumps.
+        """
+        clause, params = _search_clause(filter_term, alias="s")
+        conditions = [clause] if clause else []
+        if after_id is not None:
+            conditions.append("s.id > %s"); params.append(after_id)
+        page = "SELECT * FROM students s"
+        if conditions:
+            page += " WHERE " + " AND ".join(conditions)
+        page += " ORDER BY s.id LIMIT %s"; params.append(limit)
+        if after_id is None and offset:
+            page += " OFFSET %s"; params.append(offset)
+        # The page is cut from students first, so skipped rows are never pivoted
+        query = f"{_GRID_SELECT} FROM ({page}) s {_MONTHS_LATERAL} ORDER BY s.id"
+        params.append(self.year)
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(query, params)
+            return [StudentPayment.from_row(row) for row in cur.fetchall()]
+
+    @timed()
+    def get_student(self, student_id: int) -> Optional[StudentPayment]:
+        """One student with its month statuses (same shape as ``list_payments`` rows)."""
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(PAYMENTS_GRID_LOOKUP_QUERY + " WHERE s.id = %s", (self.year, student_id))
+            row = cur.fetchone()
+        return StudentPayment.from_row(row) if row else None
+
+    @timed()
+    def get_month_amount(self, student_id: int, month_code: str) -> Optional[Money]:
+        """Base amount of one month, or None if the student does not exist."""
+        if month_code not in MONTH_CODES:
+            raise ValueError(f"Unknown month code: {month_code!r}")
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT COALESCE(m.amount, 0.00) FROM students s
+                LEFT JOIN student_months m ON m.student_id = s.id AND m.year = %s AND m.month = %s
+                WHERE s.id = %s""", (self.year, MONTH_CODES.index(month_code) + 1, student_id))
+            row = cur.fetchone()
+        return None if row is None else row[0]
+
+    @timed()
+    def exists(self, student_id: int) -> bool:
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            return self._exists(cur, student_id)
+
+    @staticmethod
+    def _exists(cur, student_id: int) -> bool:
+        cur.execute("SELECT 1 FROM students WHERE id = %s", (student_id,))
+        return cur.fetchone() is not None
+
+    @timed()
+    def is_empty(self) -> bool:
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT 1 FROM students LIMIT 1")
+            return cur.fetchone() is None
+
+    @timed()
+    def year_is_empty(self) -> bool:
+        """True if no student has an amount in ``self.year`` (only that year's partition is read)."""
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT 1 FROM student_months WHERE year = %s LIMIT 1", (self.year,))
+            return cur.fetchone() is None
+
+    @timed()
+    def copy_year_amounts(self, from_year: int) -> int:
+        """Copies the monthly amounts of ``from_year`` into ``self.year`` (statuses and comments are
+        not carried over; months already filled in are kept). Returns the number of months copied."""
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO student_months (student_id, year, month, amount)
+                SELECT student_id, %s, month, amount FROM student_months WHERE year = %s AND amount <> 0
+                ON CONFLICT (student_id, year, month) DO NOTHING""", (self.year, from_year))
+            return cur.rowcount
+
+    def _write_months(self, cur, student: StudentPayment, months: Optional[Sequence[int]] = None) -> None:
+        """Stores the amounts of ``months`` (month numbers; default all 12) in one statement: months
+        with an amount are upserted (status and comment kept, unchanged amounts not rewritten),
+        months at zero lose their row, and with it any status."""
+        months = list(months) if months is not None else list(range(1, 13))
+        if not months:
+            return
+        cur.execute("""
+            WITH wanted AS (SELECT * FROM unnest(%(months)s::smallint[], %(amounts)s::numeric[]) AS t(month, amount)),
+            removed AS (
+                DELETE FROM student_months m USING wanted w
+                WHERE m.student_id = %(id)s AND m.year = %(year)s AND m.month = w.month AND COALESCE(w.amount, 0) <= 0)
+            INSERT INTO student_months (student_id, year, month, amount)
+            SELECT %(id)s, %(year)s, month, amount FROM wanted WHERE amount > 0
+            ON CONFLICT (student_id, year, month) DO UPDATE SET amount = EXCLUDED.amount
+                WHERE student_months.amount <> EXCLUDED.amount""",
+                    {"id": student.id, "year": self.year, "months": months,
+                     "amounts": [student.months[month - 1] for month in months]})
+
+    @timed()
+    def add_student(self, student: StudentPayment) -> None:
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("INSERT INTO students (id, payment_day, student_name, course, discount) VALUES (%s, %s, %s, %s, %s)",
+                        (student.id, student.payment_day, student.student_name, student.course, student.discount))
+            self._write_months(cur, student)
+
+    @timed()
+    def update_student(self, student: StudentPayment, expected: Optional[StudentPayment] = None) -> bool:
+        """Updates a student and its month amounts for the repository's year.
+
+        Months whose amount becomes zero lose their status (as if removed from the
+        debtors list); other statuses are never changed here. Returns False if the ID does not exist.
+
+        With ``expected`` (the record the edit started from, as read by ``list_payments`` or
+        ``get_student``) the update is optimistic: only the months that differ from it are
+        written, and ConcurrentUpdateError is raised, writing nothing, if the student row
+        changed since (another version) or one of those months no longer has the amount and
+        status ``expected`` shows. Without it the update overwrites unconditionally.
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            if expected is None:
+                cur.execute("UPDATE students SET payment_day=%s, student_name=%s, course=%s, discount=%s WHERE id=%s",
+                            (student.payment_day, student.student_name, student.course, student.discount, student.id))
+                if cur.rowcount == 0:
+                    return False
+                self._write_months(cur, student)
+                return True
+            cur.execute("UPDATE students SET payment_day=%s, student_name=%s, course=%s, discount=%s WHERE id=%s AND version=%s",
+                        (student.payment_day, student.student_name, student.course, student.discount, student.id, expected.version))
+            if cur.rowcount == 0:
+                if not self._exists(cur, student.id):
+                    return False
+                raise ConcurrentUpdateError(student.id)
+            changed = [i + 1 for i, (new, old) in enumerate(zip(student.months, expected.months)) if new != old]
+            if changed:
+                # The student row is locked now; lock the changed months too and check they are as read
+                cur.execute("SELECT month, amount, status FROM student_months WHERE student_id=%s AND year=%s AND month = ANY(%s) FOR UPDATE",
+                            (student.id, self.year, changed))
+                current = {month: (amount, status) for month, amount, status in cur.fetchall()}
+                if any(current.get(month, (ZERO, None)) != (expected.months[month - 1], expected.statuses[month - 1]) for month in changed):
+                    raise ConcurrentUpdateError(student.id)
+                self._write_months(cur, student, changed)
+            return True
+
+    @timed()
+    def delete_student(self, student_id: int) -> int:
+        """Deletes a student (month rows of every year cascade). Returns the number of rows removed."""
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM students WHERE id = %s", (student_id,))
+            return cur.rowcount
+
+    @timed()
+    def next_free_id(self, low: int = 1001, high: int = 9999) -> Optional[int]:
+        """Smallest unused ID in [low, high], found with an index-only gap search."""
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT CASE WHEN NOT EXISTS (SELECT 1 FROM students WHERE id = %(low)s) THEN %(low)s
+                       ELSE (SELECT MIN(p.id) + 1 FROM students p
+                             WHERE p.id >= %(low)s AND NOT EXISTS (SELECT 1 FROM students q WHERE q.id = p.id + 1))
+                       END""", {"low": low})
+            next_id = cur.fetchone()[0]
+        return next_id if next_id is not None and next_id <= high else None
+
+    @timed()
+    def import_students(self, students: Iterable[StudentPayment]) -> Tuple[int, int, int]:
+        """Bulk upsert: streams ``students`` with COPY into a temporary staging table, then
+        applies them with set-based statements in the same transaction.
+
+        Existing IDs are overwritten like in ``update_student``. A month status that is not
+        None is applied to that month (months without an amount are skipped); None leaves
+        the current status as it is. IDs must be unique in ``students``.
+        Returns (inserted, updated, statuses applied).
+        """
+        staging_columns = PAYMENT_COLUMNS + tuple(f"{code}_status" for code in MONTH_CODES)
+        staging_definitions = ", ".join(["id INT", "payment_day INT", "student_name VARCHAR(50)", "course VARCHAR(15)", "discount DECIMAL(10,2)"]
+                                        + [f"{code} DECIMAL(10,2)" for code in MONTH_CODES]
+                                        + [f"{code}_status VARCHAR(20)" for code in MONTH_CODES])
+        amounts = "ARRAY[" + ", ".join(f"s.{code}" for code in MONTH_CODES) + "]"
+        statuses = "ARRAY[" + ", ".join(f"s.{code}_status" for code in MONTH_CODES) + "]"
+        rows = ((s.id, s.payment_day, s.student_name, s.course, s.discount) + tuple(s.months) + tuple(s.statuses)
+                for s in students)
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(f"CREATE TEMP TABLE import_payments ({staging_definitions}) ON COMMIT DROP")
+            source = _CopySource(rows)
+            try:
+                cur.copy_expert(f"COPY import_payments ({', '.join(staging_columns)}) FROM STDIN WITH (FORMAT csv)", source)
+            except psycopg2.Error:
+                if source.error is not None:
+                    raise source.error from None  # e.g. JobCancelled from a progress callback
+                raise
+            cur.execute("""
+                WITH upserted AS (
+                    INSERT INTO students (id, payment_day, student_name, course, discount)
+                    SELECT id, payment_day, COALESCE(student_name, ''), COALESCE(course, ''), COALESCE(discount, 0) FROM import_payments
+                    ON CONFLICT (id) DO UPDATE SET payment_day = EXCLUDED.payment_day, student_name = EXCLUDED.student_name,
+                        course = EXCLUDED.course, discount = EXCLUDED.discount
+                    RETURNING (xmax = 0) AS inserted)
+                SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted) FROM upserted""")
+            inserted, updated = cur.fetchone()
+            # Months of overwritten students left without an amount lose their row
+            cur.execute(f"""
+                DELETE FROM student_months m USING import_payments s
+                WHERE m.student_id = s.id AND m.year = %s AND COALESCE(({amounts})[m.month], 0) <= 0""", (self.year,))
+            cur.execute(f"""
+                WITH months AS (
+                    SELECT s.id, m.month, m.amount, m.status
+                    FROM import_payments s CROSS JOIN LATERAL unnest({amounts}, {statuses}) WITH ORDINALITY AS m(amount, status, month)
+                    WHERE m.amount > 0),
+                upserted AS (
+                    INSERT INTO student_months (student_id, year, month, amount, status)
+                    SELECT id, %s, month, amount, status FROM months
+                    ON CONFLICT (student_id, year, month) DO UPDATE SET amount = EXCLUDED.amount,
+                        status = COALESCE(EXCLUDED.status, student_months.status))
+                SELECT COUNT(*) FILTER (WHERE status IS NOT NULL) FROM months""", (self.year,))
+            return inserted, updated, cur.fetchone()[0]
+
+    @timed()
+    def insert_many(self, students: Sequence[StudentPayment]) -> None:
+        """Inserts students with their month amounts, ignoring IDs that already exist."""
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            for student in students:
+                cur.execute("""INSERT INTO students (id, payment_day, student_name, course, discount) VALUES (%s, %s, %s, %s, %s)
+                               ON CONFLICT (id) DO NOTHING""",
+                            (student.id, student.payment_day, student.student_name, student.course, student.discount))
+                if cur.rowcount:
+                    self._write_months(cur, student)
+
+
+class DebtorsRepository(_Repository):
+    """Queries and mutations on the status/comment of ``student_months`` (the debtors list)."""
+
+    def _open_debts(self, filter_term: Optional[str], aging: Optional[str] = None,
+                    reference: Optional[datetime.date] = None) -> Tuple[str, list]:
+        """_OPEN_DEBTS_QUERY narrowed to the search term and aging bucket, and its parameters."""
+        query, params = _OPEN_DEBTS_QUERY, [self.year]
+        clause, search_params = _search_clause(filter_term, alias="s")
+        if clause:
+            query += " AND " + clause; params += search_params
+        if aging is not None:
+            earliest, latest = aging_due_range(aging, reference)
+            if earliest is not None:
+                query += f" AND {_DUE_DATE} >= %s"; params.append(earliest)
+            if latest is not None:
+                query += f" AND {_DUE_DATE} <= %s"; params.append(latest)
+        return query, params
+
+    @timed()
+    def list_open_debtors(self, filter_term: Optional[str] = None, aging: Optional[str] = None, by_aging: bool = False,
+                          reference: Optional[datetime.date] = None) -> List[DebtorRecord]:
+        """Entries with status 'Pendente' or 'Em Negociação', ordered by ID and month.
+
+        ``aging`` keeps one AGING_BUCKETS bucket as of ``reference`` (default today);
+        ``by_aging`` orders by due date instead, most overdue first.
+        """
+        query, params = self._open_debts(filter_term, aging, reference)
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(query + (_AGING_ORDER if by_aging else _ID_ORDER), params)
+            return [_debtor_from_row(row) for row in cur.fetchall()]
+
+    @timed()
+    def iter_open_debtors(self, filter_term: Optional[str] = None, batch_size: int = 5000, aging: Optional[str] = None,
+                          by_aging: bool = False, reference: Optional[datetime.date] = None) -> Iterator[DebtorRecord]:
+        """Streams the same rows as ``list_open_debtors`` through a server-side cursor (for exports)."""
+        query, params = self._open_debts(filter_term, aging, reference)
+        with self.pool.connection() as conn, conn.cursor(name="stream_open_debtors") as cur:
+            cur.itersize = batch_size
+            cur.execute(query + (_AGING_ORDER if by_aging else _ID_ORDER), params)
+            for row in cur:
+                yield _debtor_from_row(row)
+
+    @timed()
+    def count_open_debtors(self, filter_term: Optional[str] = None, aging: Optional[str] = None,
+                           reference: Optional[datetime.date] = None) -> int:
+        query, params = self._open_debts(filter_term, aging, reference)
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM (" + query + ") open_debts", params)
+            return cur.fetchone()[0]
+
+    @timed()
+    def list_open_debtors_page(self, filter_term: Optional[str] = None, limit: int = 200, offset: int = 0,
+                               after_key: Optional[Tuple[int, str]] = None, aging: Optional[str] = None,
+                               by_aging: bool = False, reference: Optional[datetime.date] = None) -> List[DebtorRecord]:
+        """One page of open debts in (ID, month) order; ``after_key`` = (id, month name) of the previous page's last row.
+
+        ``aging``/``by_aging`` as in ``list_open_debtors``; in due-date order pages are read by ``offset``.
+        """
+        query, params = self._open_debts(filter_term, aging, reference)
+        if after_key is not None and not by_aging:
+            query += " AND (m.student_id, m.month) > (%s, %s)"
+            params += [after_key[0], MONTH_INDEX.get(after_key[1], 12) + 1]
+        query += (_AGING_ORDER if by_aging else _ID_ORDER) + " LIMIT %s"; params.append(limit)
+        if (after_key is None or by_aging) and offset:
+            query += " OFFSET %s"; params.append(offset)
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(query, params)
+            return [_debtor_from_row(row) for row in cur.fetchall()]
+
+    @timed()
+    def get_debtor(self, student_id: int, month_name: str) -> Optional[DebtorRecord]:
+        """The (student, month) entry if it has a status, else None."""
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT {_DEBT_COLUMNS}
+                FROM student_months m JOIN students s ON s.id = m.student_id
+                WHERE m.student_id = %s AND m.year = %s AND m.month = %s AND m.status IS NOT NULL""",
+                        (student_id, self.year, month_number(month_name)))
+            row = cur.fetchone()
+        return _debtor_from_row(row) if row else None
+
+    @timed()
+    def upsert_debtor_status(self, student_id: int, month_name: str, amount: Money, status: str,
+                             expected: Optional[StudentPayment] = None) -> None:
+        """Sets the status (and amount) of one (student, month), keeping any existing comment.
+
+        With ``expected`` (the student's record as read), raises ConcurrentUpdateError, writing
+        nothing, if the month no longer has the amount and status it shows.
+        """
+        month = month_number(month_name)
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            if expected is not None:
+                seen_amount, seen_status = expected.months[month - 1], expected.statuses[month - 1]
+                # Compare-and-set: one statement, no read first
+                cur.execute("""
+                    UPDATE student_months SET status = %s, amount = %s
+                    WHERE student_id = %s AND year = %s AND month = %s AND amount = %s AND status IS NOT DISTINCT FROM %s""",
+                            (status, amount, student_id, self.year, month, seen_amount, seen_status))
+                if cur.rowcount == 0 and seen_amount == 0 and seen_status is None:  # there was no row
+                    cur.execute("""
+                        INSERT INTO student_months (student_id, year, month, amount, status) VALUES (%s, %s, %s, %s, %s)
+                        ON CONFLICT (student_id, year, month) DO NOTHING""", (student_id, self.year, month, amount, status))
+                if cur.rowcount == 0:
+                    raise ConcurrentUpdateError(student_id, month_name)
+                return
+            cur.execute("""
+                INSERT INTO student_months (student_id, year, month, amount, status)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (student_id, year, month) DO UPDATE SET status = EXCLUDED.status, amount = EXCLUDED.amount""",
+                        (student_id, self.year, month, amount, status))
+
+    @timed()
+    def mark_month(self, month_code: str, status: str, student_ids: Optional[Sequence[int]] = None,
+                   filter_term: Optional[str] = None, expected: Optional[dict] = None) -> int:
+        """Sets one month's status for many students with a single set-based UPDATE.
+
+        Applies to ``student_ids`` if given, else to every student matching ``filter_term``
+        (None = everyone). Students without an amount for the month have no row and are
+        skipped; existing comments are kept. Returns the number of months marked.
+
+        With ``expected`` ({student id: (amount, status)} of the month as read), applies to those
+        students only, and raises ConcurrentUpdateError, writing nothing, if any of their months
+        no longer has the amount and status it showed.
+        """
+        if month_code not in MONTH_CODES:
+            raise ValueError(f"Unknown month code: {month_code!r}")
+        month = MONTH_CODES.index(month_code) + 1
+        if expected is not None:
+            ids = sorted(expected)
+            with self.pool.connection() as conn, conn.cursor() as cur:
+                # Compare-and-set for the whole batch: one statement, rolled back if any month changed
+                cur.execute("""
+                    UPDATE student_months m SET status = %s
+                    FROM unnest(%s::int[], %s::numeric[], %s::text[]) AS e(student_id, amount, status)
+                    WHERE m.student_id = e.student_id AND m.year = %s AND m.month = %s AND m.amount > 0
+                      AND m.amount = e.amount AND m.status IS NOT DISTINCT FROM e.status
+                    RETURNING m.student_id""",
+                            [status, ids, [expected[i][0] for i in ids], [expected[i][1] for i in ids], self.year, month])
+                missing = set(ids).difference(row[0] for row in cur.fetchall())
+                if missing:
+                    raise ConcurrentUpdateError(min(missing), MONTH_NAMES[month_code])
+                return len(ids)
+        if student_ids is not None:
+            clause, params = "m.student_id = ANY(%s)", [list(student_ids)]
+        else:
+            clause, params = _search_clause(filter_term, alias="s")
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(f"""
+                UPDATE student_months m SET status = %s FROM students s
+                WHERE s.id = m.student_id AND m.year = %s AND m.month = %s AND m.amount > 0{" AND " + clause if clause else ""}""",
+                        [status, self.year, month] + params)
+            return cur.rowcount
+
+    def _check_version(self, cur, student_id: int, month_name: str, version: Optional[int]) -> None:
+        """After a versioned write matched no row: raises ConcurrentUpdateError if the entry still
+        exists (so it has another version); if it is gone the caller reports 0 rows."""
+        if version is None:
+            return
+        cur.execute("SELECT 1 FROM student_months WHERE student_id=%s AND year=%s AND month=%s AND status IS NOT NULL",
+                    (student_id, self.year, month_number(month_name)))
+        if cur.fetchone() is not None:
+            raise ConcurrentUpdateError(student_id, month_name)
+
+    @timed()
+    def update_debtor(self, student_id: int, month_name: str, status: str, comment: str, amount: Money,
+                      version: Optional[int] = None) -> int:
+        """Edits one entry; the amount is the month's amount, so the Pagamentos tab changes with it.
+
+        With ``version`` (the DebtorRecord's), the entry is only written if it is unchanged since
+        it was read; otherwise ConcurrentUpdateError is raised. Returns the number of rows updated.
+        """
+        query = "UPDATE student_months SET status=%s, comment=%s, amount=%s WHERE student_id=%s AND year=%s AND month=%s"
+        params = [status, comment, amount, student_id, self.year, month_number(month_name)]
+        if version is not None:
+            query += " AND version=%s"; params.append(version)
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(query, params)
+            count = cur.rowcount
+            if count == 0:
+                self._check_version(cur, student_id, month_name, version)
+            return count
+
+    @timed()
+    def delete_debtor(self, student_id: int, month_name: str, version: Optional[int] = None) -> int:
+        """Removes the entry from the debtors list: clears status and comment, keeping the month's amount.
+
+        ``version`` works as in ``update_debtor``. Returns the number of entries removed.
+        """
+        query = """UPDATE student_months SET status = NULL, comment = ''
+                   WHERE student_id=%s AND year=%s AND month=%s AND status IS NOT NULL"""
+        params = [student_id, self.year, month_number(month_name)]
+        if version is not None:
+            query += " AND version=%s"; params.append(version)
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(query, params)
+            count = cur.rowcount
+            if count == 0:
+                self._check_version(cur, student_id, month_name, version)
+            return count
+
+    @timed()
+    def insert_many(self, records: Sequence[DebtorRecord]) -> None:
+        """Upserts debtor entries (status, amount and comment are overwritten)."""
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.executemany("""
+                INSERT INTO student_months (student_id, year, month, amount, status, comment)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (student_id, year, month) DO UPDATE SET status=EXCLUDED.status, amount=EXCLUDED.amount, comment=EXCLUDED.comment""",
+                            [(r.id, self.year, month_number(r.month), r.amount, r.status, r.comment) for r in (DebtorRecord(*record) for record in records)])
+
+
+class SyncRepository(_Repository):
+    """Reads for local replicas (local_cache.py): all of ``year``, or the students changed since a sync point.
+
+    A sync point is the oldest transaction still running when the data was read: every
+    change committed later is in ``change_log`` under a transaction id at or above it, so a
+    delta taken from there misses nothing (changes already seen may come again, harmlessly).
+    Each call reads from a single REPEATABLE READ snapshot.
+    """
+
+    @staticmethod
+    def _begin(cur) -> int:
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        cur.execute("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+        return cur.fetchone()[0]
+
+    @timed()
+    def snapshot(self) -> Tuple[int, List[StudentPayment], List[DebtorRecord]]:
+        """(sync point, every payments grid row, every open debt), in the tabs' order."""
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            since = self._begin(cur)
+            cur.execute(PAYMENTS_GRID_QUERY + " ORDER BY s.id", (self.year,))
+            payments = [StudentPayment.from_row(row) for row in cur.fetchall()]
+            cur.execute(_OPEN_DEBTS_QUERY + _ID_ORDER, (self.year,))
+            return since, payments, [_debtor_from_row(row) for row in cur.fetchall()]
+
+    @timed()
+    def changes_since(self, since: int, max_ids: Optional[int] = None,
+                      include: Sequence[int] = ()) -> Optional[Tuple[int, List[int], List[StudentPayment], List[DebtorRecord]]]:
+        """(new sync point, IDs changed since ``since``, their payments rows, their open debts).
+
+        ``include`` adds IDs to re-read whether or not they changed on the server (e.g. students
+        the replica changed offline). IDs without a payments row were deleted. None if the log no longer reaches back to
+        ``since`` (pruned), a table was truncated since, or more than ``max_ids`` students
+        changed (re-reading them one by one would be slower): take a new ``snapshot``.
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            new_since = self._begin(cur)
+            cur.execute("""
+                SELECT (SELECT MAX(pruned_before) FROM change_log_horizon) > %(since)s
+                    OR EXISTS (SELECT 1 FROM change_log WHERE xact >= %(since)s AND student_id IS NULL)""", {"since": since})
+            if cur.fetchone()[0]:
+                return None
+            cur.execute("SELECT DISTINCT student_id FROM change_log WHERE xact >= %s AND (year = %s OR year IS NULL) ORDER BY 1",
+                        (since, self.year))
+            ids = sorted({student_id for student_id, in cur.fetchall()} | set(include))
+            if max_ids is not None and len(ids) > max_ids:
+                return None
+            if not ids:
+                return new_since, [], [], []
+            cur.execute(PAYMENTS_GRID_LOOKUP_QUERY + " WHERE s.id = ANY(%s) ORDER BY s.id", (self.year, ids))
+            payments = [StudentPayment.from_row(row) for row in cur.fetchall()]
+            cur.execute(_OPEN_DEBTS_QUERY + " AND m.student_id = ANY(%s)" + _ID_ORDER, (self.year, ids))
+            return new_since, ids, payments, [_debtor_from_row(row) for row in cur.fetchall()]
+
+
+class SummaryRepository(_Repository):
+    """Financial totals of ``year`` read from ``month_summary`` (kept current by database triggers)."""
+
+    _TOTALS = "SUM(billed), SUM(received), SUM(outstanding), SUM(open_count)"
+
+    @timed()
+    def by_month(self) -> List[SummaryRow]:
+        """One row per month with amounts, January first."""
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(f"SELECT month, {self._TOTALS} FROM month_summary WHERE year = %s GROUP BY month HAVING SUM(billed) <> 0 ORDER BY month",
+                        (self.year,))
+            return [SummaryRow(MONTH_NAMES[MONTH_CODES[month - 1]], *row) for month, *row in cur.fetchall()]
+
+    @timed()
+    def by_course(self) -> List[SummaryRow]:
+        """One row per course with amounts in the year, by course name."""
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(f"SELECT course, {self._TOTALS} FROM month_summary WHERE year = %s GROUP BY course HAVING SUM(billed) <> 0 ORDER BY course",
+                        (self.year,))
+            return [SummaryRow(*row) for row in cur.fetchall()]
+
+    @timed()
+    def total(self) -> SummaryRow:
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(f"SELECT {self._TOTALS} FROM month_summary WHERE year = %s", (self.year,))
+            billed, received, outstanding, open_count = cur.fetchone()
+            return SummaryRow("Total", billed or ZERO, received or ZERO, outstanding or ZERO, open_count or 0)
+
+
+# --- Sample data (offered by the GUI when the database is empty) ---
+SAMPLE_PAYMENTS = [
+    (1001, 10, "Pedro Faleiro Rocha", "TQI", 0.00, 10.00, 11.00, 11.00, 0.00, 390.10, 390.55, 0, 0, 0, 0, 0, 0),
+    (1002, 20, "Isis Silva Pinheiro Aires", "SB", 20.00, 270.18, 270.18, 270.18, 10.00, 0, 0, 0, 0, 0, 0, 0, 0),
+    (1003, 10, "Pedro Motteran Thomaz Vi", "FLY1", 20.00, 329.46, 329.46, 329.46, 0, 0, 0, 10.00, 0, 0, 0, 0, 0),
+    (1004, 10, "chuleto", "TO1", 0.00, 10.00, 10.00, 10.00, 10.00, 10.00, 10.00, 10.00, 10.00, 10.00, 10.00, 10.00, 10.00),
+]
+SAMPLE_DEBTORS = [
+    (1001, 'Pedro Faleiro Rocha', 'TQI', 'Fevereiro', 11.00, 'Pendente', ''),
+    (1001, 'Pedro Faleiro Rocha', 'TQI', 'Março', 11.00, 'Pendente', ''),
+    (1001, 'Pedro Faleiro Rocha', 'TQI', 'Maio', 390.10, 'Pendente', 'Pagamento atrasado'),
+    (1002, 'Isis Silva Pinheiro Aires', 'SB', 'Janeiro', 270.18, 'Em Negociação', 'Combinado pagar dia 30'),
+    (1002, 'Isis Silva Pinheiro Aires', 'SB', 'Abril', 10.00, 'Pendente', ''),
+    (1003, 'Pedro Motteran Thomaz Vi', 'FLY1', 'Fevereiro', 329.46, 'Pendente', ''),
+    (1004, 'chuleto', 'TO1', 'Janeiro', 10.00, 'Pendente', ''),
+]
+
+
+def load_sample_data(payments: PaymentsRepository, debtors: DebtorsRepository) -> None:
+    payments.insert_many([StudentPayment.from_row(row[:4] + tuple(map(to_money, row[4:]))) for row in SAMPLE_PAYMENTS])
+    debtors.insert_many([DebtorRecord(*row)._replace(amount=to_money(row[4])) for row in SAMPLE_DEBTORS])
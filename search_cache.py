@@ -0,0 +1,77 @@
+"""Client-side result cache for the "Buscar por Nome/ID" bars.
+
+Search-as-you-type issues a query per pause in typing, and most of them are
+answerable without the database: the same term was searched a moment ago
+(LRU hit), or the new term extends one whose complete result is cached
+("silv" -> "silva"), in which case filtering that result in memory gives
+exactly what the server would return. Matching uses ``repository.matches_search``,
+the Python mirror of the SQL search clause, so both paths agree.
+
+Only complete results may be stored (not the first page of a virtual grid), and
+the cache must be cleared whenever the underlying rows change. Entries also
+expire after ``max_age`` seconds, bounding staleness from other users' changes.
+"""
+import time
+from collections import OrderedDict
+
+from repository import fold_name, is_id_term, matches_search
+
+
+class SearchCache:
+    """LRU of recent search results with refinement of cached supersets."""
+
+    def __init__(self, id_and_name, max_entries=32, max_age=60.0):
+        self.id_and_name = id_and_name  # row -> (student id, student name)
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries = OrderedDict()    # normalized term -> list of rows
+        self.stored_at = {}             # normalized term -> time.monotonic() of the database read
+        self.stats = {"hits": 0, "refinements": 0, "misses": 0}
+
+    @staticmethod
+    def normalize(filter_term):
+        """Cache key: digits as typed (ID search), names folded like the SQL search ('' = all rows)."""
+        term = (filter_term or "").strip()
+        return term if is_id_term(term) else fold_name(term)
+
+    def lookup(self, filter_term):
+        """Rows for filter_term if they can be answered from memory, else None."""
+        key = self.normalize(filter_term)
+        self._expire()
+        rows = self.entries.get(key)
+        if rows is not None:
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return rows
+
+        # Any cached result whose term is contained in the new one is a superset of the answer
+        # (ID searches are exact, so only the unfiltered list can answer them)
+        bases = [base for base in self.entries
+                 if base == "" or (not is_id_term(base) and not is_id_term(key) and base in key)]
+        if not bases:
+            self.stats["misses"] += 1
+            return None
+        base = max(bases, key=len)  # longest term = smallest superset
+        term = (filter_term or "").strip()
+        rows = [row for row in self.entries[base] if matches_search(term, *self.id_and_name(row))]
+        self.stats["refinements"] += 1
+        self.store(filter_term, rows, stored_at=self.stored_at[base])  # as fresh as its base, no fresher
+        return rows
+
+    def store(self, filter_term, rows, stored_at=None):
+        """Caches the complete result of a search."""
+        key = self.normalize(filter_term)
+        self.entries[key] = list(rows)
+        self.entries.move_to_end(key)
+        self.stored_at[key] = time.monotonic() if stored_at is None else stored_at
+        while len(self.entries) > self.max_entries:
+            old_key, _ = self.entries.popitem(last=False)
+            del self.stored_at[old_key]
+
+    def _expire(self):
+        oldest_allowed = time.monotonic() - self.max_age
+        for key in [key for key, stored_at in self.stored_at.items() if stored_at < oldest_allowed]:
+            del self.entries[key]; del self.stored_at[key]
+
+    def clear(self):
+        self.entries.clear(); self.stored_at.clear()
@@ -0,0 +1,48 @@
+import datetime
+
+import pytest
+
+from repository import AGING_BUCKETS, aging_bucket, aging_due_range, days_overdue, due_date, format_overdue
+
+D = datetime.date
+
+
+@pytest.mark.parametrize("year, month, payment_day, expected", [
+    (2025, 3, 10, D(2025, 3, 10)),
+    (2025, 2, 31, D(2025, 2, 28)),   # capped at the last day of the month
+    (2024, 2, 31, D(2024, 2, 29)),
+    (2025, 4, None, D(2025, 4, 1)),  # no payment day: the 1st
+    (2025, 4, 0, D(2025, 4, 1)),
+])
+def test_due_date(year, month, payment_day, expected):
+    assert due_date(year, month, payment_day) == expected
+
+
+def test_days_overdue():
+    assert days_overdue(D(2025, 3, 10), D(2025, 3, 10)) == 0
+    assert days_overdue(D(2025, 3, 10), D(2025, 4, 9)) == 30
+    assert days_overdue(D(2025, 3, 10), D(2025, 3, 1)) == -9
+
+
+@pytest.mark.parametrize("days, bucket", [(-1, "A vencer"), (0, "0–30"), (30, "0–30"), (31, "31–60"),
+                                          (60, "31–60"), (61, "61–90"), (90, "61–90"), (91, "90+"), (5000, "90+")])
+def test_aging_bucket(days, bucket):
+    assert aging_bucket(days) == bucket
+
+
+def test_aging_due_range_agrees_with_aging_bucket():
+    reference = D(2025, 6, 15)
+    for bucket in AGING_BUCKETS:
+        earliest, latest = aging_due_range(bucket, reference)
+        for offset in range(-5, 200):
+            due = reference - datetime.timedelta(days=offset)
+            inside = (earliest is None or due >= earliest) and (latest is None or due <= latest)
+            assert inside == (aging_bucket(days_overdue(due, reference)) == bucket)
+    with pytest.raises(ValueError):
+        aging_due_range("120+", reference)
+
+
+def test_format_overdue():
+    assert format_overdue(None) == ""
+    assert format_overdue(D(2025, 3, 10), D(2025, 3, 9)) == "A vencer"
+    assert format_overdue(D(2025, 3, 10), D(2025, 5, 1)) == "52"
@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+from cli import _write_csv
+
+
+def _failing_rows():
+    yield (1, "Ana", "10,00")
+    raise RuntimeError("conexão perdida")
+
+
+def test_write_csv(tmp_path):
+    target = tmp_path / "pagamentos.csv"
+    assert _write_csv(str(target), ("ID", "Aluno", "Valor"), [(1, "Ana", "10,00"), (2, "Bia", "1.500,00")]) == 2
+    assert target.read_text(encoding="utf-8-sig").splitlines() == ["ID;Aluno;Valor", "1;Ana;10,00", "2;Bia;1.500,00"]
+    assert os.listdir(tmp_path) == ["pagamentos.csv"]
+
+
+def test_failed_export_writes_nothing(tmp_path):
+    target = tmp_path / "pagamentos.csv"
+    with pytest.raises(RuntimeError):
+        _write_csv(str(target), ("ID", "Aluno", "Valor"), _failing_rows())
+    assert os.listdir(tmp_path) == []
+
+
+def test_failed_export_keeps_the_old_file(tmp_path):
+    target = tmp_path / "pagamentos.csv"
+    target.write_text("antigo", encoding="utf-8")
+    with pytest.raises(RuntimeError):
+        _write_csv(str(target), ("ID", "Aluno", "Valor"), _failing_rows())
+    assert target.read_text(encoding="utf-8") == "antigo"
+    assert os.listdir(tmp_path) == ["pagamentos.csv"]
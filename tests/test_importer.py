@@ -0,0 +1,56 @@
+from decimal import Decimal
+
+import pytest
+
+from importer import ImportFormatError, RowValidator, map_headers
+
+MONTHS = ("JAN", "FEV", "MAR", "ABR", "MAI", "JUN", "JUL", "AGO", "SET", "OUT", "NOV", "DEZ")
+HEADER = ("ID", "Dia", "Aluno", "Curso", "Desc.") + MONTHS + tuple(f"Status {month}" for month in MONTHS)
+
+
+def row(student_id="1001", day="10", name="Ana Silva", course="Inglês", jan="", jan_status=""):
+    return (student_id, day, name, course, "0") + (jan,) + ("",) * 11 + (jan_status,) + ("",) * 11
+
+
+@pytest.fixture
+def validator():
+    return RowValidator(map_headers(HEADER))
+
+
+def test_valid_row(validator):
+    student, errors = validator.validate(2, row(jan="1.500", jan_status="pago"))
+    assert errors == []
+    assert (student.id, student.payment_day, student.student_name) == (1001, 10, "Ana Silva")
+    assert student.months[0] == Decimal("1500.00") and student.statuses[0] == "Pago"
+
+
+def test_field_errors(validator):
+    student, errors = validator.validate(2, row(student_id="１００１", day="32", name="", jan="12,345", jan_status="Talvez"))
+    assert student is None
+    assert {column for column, _, _ in errors} == {"id", "payment_day", "student_name", "jan", "jan_status"}
+
+
+def test_repeated_id(validator):
+    validator.validate(2, row())
+    student, errors = validator.validate(3, row())
+    assert student is None
+    assert errors == [("id", 1001, "ID repetido (já aparece na linha 2)")]
+
+
+def test_rejected_row_does_not_claim_its_id(validator):
+    _, errors = validator.validate(2, row(day="0"))
+    assert errors
+    student, errors = validator.validate(3, row())  # the corrected row, further down the file
+    assert errors == [] and student.id == 1001
+    _, errors = validator.validate(4, row())
+    assert errors == [("id", 1001, "ID repetido (já aparece na linha 3)")]
+
+
+def test_id_range(validator):
+    _, errors = validator.validate(2, row(student_id="42"))
+    assert errors == [("id", 42, "deve estar entre 1001 e 9999")]
+
+
+def test_missing_columns():
+    with pytest.raises(ImportFormatError):
+        map_headers(("ID", "Aluno"))
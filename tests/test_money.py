@@ -0,0 +1,44 @@
+from decimal import Decimal
+
+import pytest
+
+from money import ZERO, format_brl, parse_brl, to_money
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("1.500", "1500.00"),        # a lone dot before 3 digits groups thousands (BRL)
+    ("1.234,56", "1234.56"),
+    ("12.50", "12.50"),          # otherwise a dot is the decimal point
+    ("1.000.000", "1000000.00"),
+    ("-1.500", "-1500.00"),
+    ("270,18 ✅", "270.18"),
+    ("R$ 10,00", "10.00"),
+    ("0.5", "0.50"),
+    ("", "0.00"),
+])
+def test_parse_brl(text, expected):
+    assert parse_brl(text) == Decimal(expected)
+
+
+@pytest.mark.parametrize("text", ["1,234", "1234.567", "12,505", "abc", "1,2,3", "NaN"])
+def test_parse_brl_rejects_instead_of_rounding(text):
+    with pytest.raises(ValueError):
+        parse_brl(text)
+
+
+def test_format_brl():
+    assert format_brl(Decimal("1234.5")) == "1234,50"
+    assert format_brl(None) == "0,00"
+    assert format_brl(Decimal("-0.00")) == "0,00"
+
+
+def test_format_parse_round_trip():
+    for amount in (Decimal("0.01"), Decimal("99.90"), Decimal("1500.00"), Decimal("99999999.99")):
+        assert parse_brl(format_brl(amount)) == amount
+
+
+def test_to_money():
+    assert to_money(None) == ZERO
+    assert to_money(0.1) == Decimal("0.10")
+    assert to_money(3) == Decimal("3.00")
+    assert to_money("1.500") == Decimal("1500.00")
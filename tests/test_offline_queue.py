@@ -0,0 +1,53 @@
+from offline import OfflineQueue
+
+
+def make_queue(tmp_path):
+    return OfflineQueue(str(tmp_path / "cache" / "queue-test.sqlite3"))
+
+
+def test_append_and_read_back_in_order(tmp_path):
+    queue = make_queue(tmp_path)
+    first = queue.append(2025, "set_status", [1001], {"month_name": "Março", "amount": "10.00", "status": "Pago"})
+    second = queue.append(2025, "mark_month", [1002, 1003], {"month": "mar", "status": "Pendente"})
+    assert len(queue) == 2 and second > first
+    changes = queue.changes()
+    assert [(c.seq, c.op, c.student_ids) for c in changes] == [(first, "set_status", (1001,)), (second, "mark_month", (1002, 1003))]
+    assert changes[0].payload["amount"] == "10.00" and changes[0].conflict is None
+    assert [c.seq for c in queue.changes(after=first)] == [second]
+    assert [c.seq for c in queue.changes(limit=1)] == [first]
+
+
+def test_chained_changes(tmp_path):
+    queue = make_queue(tmp_path)
+    queue.append(2025, "update_student", [1001], {})
+    queue.append(2025, "mark_month", [1002, 1001], {})
+    queue.append(2025, "delete_student", [1004], {})
+    assert [c.chained for c in queue.changes()] == [False, True, False]
+
+
+def test_journal_survives_reopening(tmp_path):
+    queue = make_queue(tmp_path)
+    queue.append(2025, "add_student", [1001], {"student": None})
+    reopened = make_queue(tmp_path)
+    assert len(reopened) == 1
+    reopened.append(2025, "delete_student", [1001], {})
+    assert reopened.changes()[-1].chained  # students touched before reopening are still known
+
+
+def test_conflicts_and_remove(tmp_path):
+    queue = make_queue(tmp_path)
+    seqs = [queue.append(2025, "delete_student", [student_id], {}) for student_id in (1001, 1002, 1003)]
+    queue.set_conflicts({seqs[1]: "alterado em outra estação"})
+    assert [(c.seq, c.conflict) for c in queue.conflicts()] == [(seqs[1], "alterado em outra estação")]
+    queue.remove([seqs[0], seqs[2]])
+    assert len(queue) == 1 and [c.seq for c in queue.changes()] == [seqs[1]]
+    queue.remove([seqs[1]])
+    assert len(queue) == 0
+    queue.append(2025, "delete_student", [1002], {})
+    assert not queue.changes()[0].chained  # an empty journal starts over from the server's data
+
+
+def test_describe(tmp_path):
+    queue = make_queue(tmp_path)
+    queue.append(2025, "mark_month", list(range(1001, 1008)), {"month": "mar", "status": "Pago"})
+    assert "1001, 1002, 1003, 1004, 1005 e mais 2 (Março/2025)" in queue.changes()[0].describe()
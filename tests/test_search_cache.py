@@ -0,0 +1,61 @@
+import pytest
+
+from repository import _search_clause, is_id_term, matches_search
+from search_cache import SearchCache
+
+ROWS = [(1, "Ana Silva"), (2, "João Silveira"), (12, "Bia Souza"), (123, "Álvaro Silva")]
+
+
+def make_cache(**kwargs):
+    return SearchCache(lambda row: row, **kwargs)
+
+
+@pytest.mark.parametrize("term, is_id", [("12", True), ("007", True), ("", False), ("12a", False),
+                                         ("１２", False), ("²", False), ("١٢", False)])
+def test_is_id_term(term, is_id):
+    assert is_id_term(term) is is_id
+
+
+def test_unicode_digits_are_a_name_search():
+    # isdigit() is True for these, but they are not IDs: the SQL, the Python mirror and the cache key agree
+    for term in ("１２", "²"):
+        clause, params = _search_clause(term)
+        assert clause.startswith("fold_name(")
+        assert not matches_search(term, 12, "Bia Souza")
+        assert SearchCache.normalize(term) != "12"
+
+
+def test_matches_search():
+    assert matches_search(None, 1, "Ana")
+    assert matches_search("12", 12, "Bia Souza")
+    assert not matches_search("12", 123, "Álvaro Silva")
+    assert matches_search("ALVARO", 123, "Álvaro Silva")
+    assert _search_clause("12") == ("id = %s", [12])
+
+
+def test_hit_and_refinement():
+    cache = make_cache()
+    assert cache.lookup("silv") is None
+    cache.store("Silv", [row for row in ROWS if matches_search("silv", *row)])
+    assert cache.lookup(" SILV ") == [ROWS[0], ROWS[1], ROWS[3]]
+    assert cache.lookup("silva") == [ROWS[0], ROWS[3]]
+    assert cache.stats == {"hits": 1, "refinements": 1, "misses": 1}
+
+
+def test_id_searches_refine_only_from_the_full_list():
+    cache = make_cache()
+    cache.store("1", [ROWS[0]])
+    assert cache.lookup("12") is None          # "1" does not contain the result for ID 12
+    cache.store("", ROWS)
+    assert cache.lookup("12") == [ROWS[2]]
+
+
+def test_lru_and_expiry(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("search_cache.time.monotonic", lambda: now[0])
+    cache = make_cache(max_entries=2, max_age=10.0)
+    cache.store("ana", [ROWS[0]]); cache.store("bia", [ROWS[2]]); cache.store("joao", [ROWS[1]])
+    assert list(cache.entries) == ["bia", "joao"]
+    now[0] = 111.0
+    assert cache.lookup("bia") is None
+    assert not cache.entries
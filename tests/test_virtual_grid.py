@@ -0,0 +1,82 @@
+"""Virtual grids paging from the local replica (no display or database needed: Tk and the server are faked)."""
+from types import SimpleNamespace
+
+from local_cache import LocalCache
+from money import ZERO
+from repository import StudentPayment
+from Sistema_de_pagamentos_escola_de_idioma import StudentPaymentApp, VirtualTreeGrid
+
+
+class FakeTree:
+    def __init__(self):
+        self.rows = {}; self.next_id = 0
+
+    def get_children(self): return tuple(self.rows)
+    def delete(self, *items):
+        for item in items: del self.rows[item]
+    def insert(self, parent, index, values=(), tags=()):
+        self.next_id += 1; item = f"I{self.next_id}"; self.rows[item] = values
+        return item
+    def item(self, item, values=(), tags=()): self.rows[item] = values
+    def selection_set(self, items): pass
+    def bbox(self, item): return None
+    def winfo_height(self): return 1
+    def cget(self, option): return 10
+
+
+class FakeServer:
+    """SyncRepository stand-in: every write bumps the sync point and logs the student."""
+
+    def __init__(self, ids):
+        self.students = {student_id: self.student(student_id) for student_id in ids}
+        self.point = 1; self.log = []
+
+    @staticmethod
+    def student(student_id):
+        return StudentPayment(student_id, 10, f"Aluno {student_id}", "Inglês", ZERO, (ZERO,) * 12)
+
+    def write(self, student_id, student):
+        if student is None: self.students.pop(student_id)
+        else: self.students[student_id] = student
+        self.point += 1; self.log.append((self.point, student_id))
+
+    def snapshot(self):
+        return self.point, sorted(self.students.values()), []
+
+    def changes_since(self, since, max_ids=None, include=()):
+        ids = sorted({student_id for point, student_id in self.log if point > since} | set(include))
+        return self.point, ids, [self.students[i] for i in ids if i in self.students], []
+
+
+def make_grid(server):
+    cache = LocalCache(2025, repo=server); cache.sync()
+    app = SimpleNamespace(offline=False, offline_store=None, local_cache=cache)
+    reads = StudentPaymentApp.page_reads(app, repo=None)
+    grid = VirtualTreeGrid(FakeTree(), SimpleNamespace(set=lambda first, last: None), page_size=5)
+    grid.load(fetch_page=lambda offset, limit, after_key: reads().list_payments_page(None, limit, offset, after_key),
+              count_rows=lambda: reads().count_payments(None),
+              format_row=lambda student: (student.id, (student.id, student.student_name), ()))
+    return grid
+
+
+def shown(grid):
+    return [values[0] for values in grid.tree.rows.values()]
+
+
+def test_invalidate_shows_rows_inserted_and_deleted_on_the_server():
+    server = FakeServer(range(1001, 1021))
+    grid = make_grid(server)
+    assert len(grid) == 20 and shown(grid)[:3] == [1001, 1002, 1003]
+    server.write(1000, server.student(1000)); server.write(1002, None)
+    grid.invalidate()
+    assert len(grid) == 20 and shown(grid)[:3] == [1000, 1001, 1003]
+
+
+def test_refetched_page_has_the_values_written_since():
+    server = FakeServer(range(1001, 1021))
+    grid = make_grid(server)
+    server.write(1001, server.student(1001)._replace(student_name="Renomeado"))
+    grid.upsert(1001, (1001, "Renomeado"), record=server.students[1001])
+    grid.pages.clear(); grid.cached_pos.clear()  # the page was evicted
+    grid.render()
+    assert grid.tree.rows[grid.get(1001)] == (1001, "Renomeado")